@@ -18,6 +18,11 @@ os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
 
 http_application = get_asgi_application()
 
+# web worker 启动后在后台预加载UNet模型(UNET_WARMUP_ON_START)
+from unet_service.apps import start_warmup
+
+start_warmup()
+
 from application.routing import websocket_urlpatterns
 
 application = ProtocolTypeRouter({
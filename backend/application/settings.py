@@ -395,6 +395,82 @@ SYSTEM_CONFIG = {}
 # 字典配置
 DICTIONARY_CONFIG = {}
 
+# ================================================= #
+# ****************** UNet预测服务配置 ****************** #
+# ================================================= #
+# 可用模型: 名称 -> checkpoint路径 或 {"path", "version", "n_classes", "bilinear", "backend"}
+# backend: eager(默认, checkpoint) / torchscript / onnx(manage.py export_unet 导出的模型, onnx需要安装onnxruntime)
+# eager 后端的 path 也可以是 manage.py export_unet --format flat 转换的扁平checkpoint(.flat), 加载时直接映射权重
+# precision: fp32(默认) / int8 / bf16, 低精度需先通过 manage.py calibrate_precision 的精度检查, 否则以fp32运行
+# 未配置默认模型时使用 UNetPredictor 的默认checkpoint路径
+UNET_MODELS = locals().get("UNET_MODELS", {})
+UNET_DEFAULT_MODEL = locals().get("UNET_DEFAULT_MODEL", "default")
+# 常驻内存的模型权重总预算(MB), 超出时按LRU淘汰, None 表示不限制
+UNET_MODEL_MEMORY_BUDGET_MB = locals().get("UNET_MODEL_MEMORY_BUDGET_MB", 1024)
+# 检查checkpoint文件是否变化的间隔(秒), 文件变化后重新计算版本并重新加载模型
+UNET_MODEL_REVALIDATE_SECONDS = locals().get("UNET_MODEL_REVALIDATE_SECONDS", 2)
+# web worker 和 celery worker 启动时预加载模型
+UNET_WARMUP_ON_START = locals().get("UNET_WARMUP_ON_START", False)
+UNET_WARMUP_MODELS = locals().get("UNET_WARMUP_MODELS", [UNET_DEFAULT_MODEL])
+# 微批处理: 在 UNET_BATCH_MAX_WAIT_MS 毫秒窗口内收集最多 UNET_BATCH_MAX_SIZE 张同尺寸图片合并推理
+UNET_BATCH_ENABLED = locals().get("UNET_BATCH_ENABLED", True)
+UNET_BATCH_MAX_SIZE = locals().get("UNET_BATCH_MAX_SIZE", 8)
+UNET_BATCH_MAX_WAIT_MS = locals().get("UNET_BATCH_MAX_WAIT_MS", 10)
+# 大图分块推理: 网络输入像素数超过 UNET_TILE_MIN_PIXELS 时按分块推理, 峰值内存由分块大小决定
+UNET_TILE_SIZE = locals().get("UNET_TILE_SIZE", 512)
+UNET_TILE_OVERLAP = locals().get("UNET_TILE_OVERLAP", 64)
+UNET_TILE_BATCH_SIZE = locals().get("UNET_TILE_BATCH_SIZE", 4)
+UNET_TILE_MIN_PIXELS = locals().get("UNET_TILE_MIN_PIXELS", 2048 * 2048)
+# ZIP批量预测流水线: 解码和编码保存线程数, 以及同时在途的最大图片数
+UNET_PIPELINE_DECODE_WORKERS = locals().get("UNET_PIPELINE_DECODE_WORKERS", 2)
+UNET_PIPELINE_ENCODE_WORKERS = locals().get("UNET_PIPELINE_ENCODE_WORKERS", 2)
+UNET_PIPELINE_MAX_IN_FLIGHT = locals().get("UNET_PIPELINE_MAX_IN_FLIGHT", 32)
+# 压缩包中内容相同的图片只预测一次, 重复的图片复用第一次出现的图片的结果
+UNET_PIPELINE_DEDUPE = locals().get("UNET_PIPELINE_DEDUPE", True)
+# 预测结果缓存: 以图片内容、checkpoint摘要和预测参数为键, 结果保存在 media/UNET_RESULT_CACHE_PREFIX 下
+# 超过 UNET_RESULT_CACHE_TTL 秒或总大小超过 UNET_RESULT_CACHE_MAX_MB 时淘汰最旧的结果,
+# 每写入 UNET_RESULT_CACHE_EVICT_INTERVAL 个结果淘汰一次, 也可用 unet_service.tasks.evict_prediction_cache 定时淘汰
+UNET_RESULT_CACHE_ENABLED = locals().get("UNET_RESULT_CACHE_ENABLED", True)
+UNET_RESULT_CACHE_PREFIX = locals().get("UNET_RESULT_CACHE_PREFIX", "unet_cache")
+UNET_RESULT_CACHE_TTL = locals().get("UNET_RESULT_CACHE_TTL", 7 * 24 * 3600)
+UNET_RESULT_CACHE_MAX_MB = locals().get("UNET_RESULT_CACHE_MAX_MB", 1024)
+UNET_RESULT_CACHE_EVICT_INTERVAL = locals().get("UNET_RESULT_CACHE_EVICT_INTERVAL", 100)
+# 结果图片格式: auto 像素值与checkpoint中的mask_values一致(二值为1-bit PNG);
+# palette 输出P模式PNG, 像素为类别序号, 颜色由调色板给出
+UNET_MASK_IMAGE_MODE = locals().get("UNET_MASK_IMAGE_MODE", "auto")
+# logits上采样方式: exact 全部类别插值到原图尺寸后取argmax; fast 在网络分辨率上决定类别,
+# 一到两个类别时结果与 exact 相同, 多类别时边界会有误差, 可用 manage.py compare_upsample 评估
+UNET_UPSAMPLE_MODE = locals().get("UNET_UPSAMPLE_MODE", "exact")
+# output_format=polygons 时多边形简化允许的最大偏差(像素), 0 表示不简化
+UNET_POLYGON_TOLERANCE = locals().get("UNET_POLYGON_TOLERANCE", 1.0)
+# 连通域分析(POST /api/unet/components/)默认的最小面积(像素)和邻域(4或8), 需要安装 opencv-python-headless
+UNET_COMPONENT_MIN_AREA = locals().get("UNET_COMPONENT_MIN_AREA", 0)
+UNET_COMPONENT_CONNECTIVITY = locals().get("UNET_COMPONENT_CONNECTIVITY", 8)
+# 预测请求准入控制(按进程): 同时执行 UNET_ADMISSION_MAX_CONCURRENT 个预测请求, 最多 UNET_ADMISSION_MAX_QUEUE 个
+# 请求排队等待 UNET_ADMISSION_QUEUE_TIMEOUT 秒, 每个用户(匿名请求按IP)同时最多 UNET_ADMISSION_PER_USER 个请求(0不限制),
+# 超出时返回429和 Retry-After
+UNET_ADMISSION_ENABLED = locals().get("UNET_ADMISSION_ENABLED", True)
+UNET_ADMISSION_MAX_CONCURRENT = locals().get("UNET_ADMISSION_MAX_CONCURRENT", 2)
+UNET_ADMISSION_MAX_QUEUE = locals().get("UNET_ADMISSION_MAX_QUEUE", 8)
+UNET_ADMISSION_QUEUE_TIMEOUT = locals().get("UNET_ADMISSION_QUEUE_TIMEOUT", 10)
+UNET_ADMISSION_PER_USER = locals().get("UNET_ADMISSION_PER_USER", 2)
+# web服务前面的可信反向代理层数, 大于0时匿名请求按代理追加到 X-Forwarded-For 的地址统计配额, 0 表示只用 REMOTE_ADDR
+UNET_ADMISSION_TRUSTED_PROXIES = locals().get("UNET_ADMISSION_TRUSTED_PROXIES", 0)
+# 独立推理进程池(python manage.py run_inference_pool): 开启后web和celery worker不加载模型,
+# 通过本地unix socket把推理交给进程池, 进程池内各进程共享一份权重
+UNET_INFERENCE_POOL_ENABLED = locals().get("UNET_INFERENCE_POOL_ENABLED", False)
+UNET_INFERENCE_POOL_ADDRESS = locals().get("UNET_INFERENCE_POOL_ADDRESS", os.path.join(BASE_DIR, "unet_inference.sock"))
+# 连接认证密钥, 默认使用 SECRET_KEY
+UNET_INFERENCE_POOL_AUTHKEY = locals().get("UNET_INFERENCE_POOL_AUTHKEY", None)
+UNET_INFERENCE_POOL_TIMEOUT = locals().get("UNET_INFERENCE_POOL_TIMEOUT", 300)
+# 推理进程数和每个进程的intra-op线程数(None 表示平均分配CPU), 以及是否把进程绑定到互不重叠的CPU核
+UNET_INFERENCE_WORKERS = locals().get("UNET_INFERENCE_WORKERS", 2)
+UNET_INFERENCE_THREADS = locals().get("UNET_INFERENCE_THREADS", None)
+UNET_INFERENCE_PIN_CPUS = locals().get("UNET_INFERENCE_PIN_CPUS", False)
+# 推理进程每隔 UNET_INFERENCE_METRICS_INTERVAL 秒把指标写入该目录(None 表示 socket路径.metrics), 由web进程的 /metrics 合并输出
+UNET_INFERENCE_METRICS_DIR = locals().get("UNET_INFERENCE_METRICS_DIR", None)
+UNET_INFERENCE_METRICS_INTERVAL = locals().get("UNET_INFERENCE_METRICS_INTERVAL", 5)
+
 # ================================================= #
 # ******************** 插件配置 ******************** #
 # ================================================= #
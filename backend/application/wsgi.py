@@ -15,3 +15,8 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'application.settings')
 os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
 
 application = get_wsgi_application()
+
+# web worker 启动后在后台预加载UNet模型(UNET_WARMUP_ON_START)
+from unet_service.apps import start_warmup
+
+start_warmup()
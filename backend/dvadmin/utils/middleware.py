@@ -114,6 +114,8 @@ class HealthCheckMiddleware(object):
                 return self.readiness(request)
             elif request.path == "/healthz":
                 return self.healthz(request)
+            elif request.path == "/metrics":
+                return self.metrics(request)
         return self.get_response(request)
 
     def healthz(self, request):
@@ -122,6 +124,14 @@ class HealthCheckMiddleware(object):
         """
         return HttpResponse("OK")
 
+    def metrics(self, request):
+        """
+        以Prometheus文本格式输出本进程的UNet预测服务指标, 开启推理进程池时包括各推理进程的指标
+        """
+        from unet_service.inference_pool import collect_metrics
+        from unet_service.metrics import render_text
+        return HttpResponse(render_text(collect_metrics()), content_type="text/plain; version=0.0.4; charset=utf-8")
+
     def readiness(self, request):
         # Connect to each database and do a generic standard SQL query
         # that doesn't write any data and doesn't depend on any tables
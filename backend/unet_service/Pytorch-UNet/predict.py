@@ -8,7 +8,7 @@ import torch.nn.functional as F
 from PIL import Image
 from torchvision import transforms
 
-from utils.data_loading import BasicDataset
+from utils.data_loading import BasicDataset, source_size
 from unet import UNet
 from utils.utils import plot_img_and_mask
 
@@ -24,7 +24,8 @@ def predict_img(net,
 
     with torch.no_grad():
         output = net(img).cpu()
-        output = F.interpolate(output, (full_img.size[1], full_img.size[0]), mode='bilinear')
+        w, h = source_size(full_img)
+        output = F.interpolate(output, (h, w), mode='bilinear')
         if net.n_classes > 1:
             mask = output.argmax(dim=1)
         else:
@@ -48,6 +49,8 @@ def get_args():
                         help='Scale factor for the input images')
     parser.add_argument('--bilinear', action='store_true', default=False, help='Use bilinear upsampling')
     parser.add_argument('--classes', '-c', type=int, default=2, help='Number of classes')
+    parser.add_argument('--palette', action='store_true', default=False,
+                        help='Save masks as palette (P-mode) PNGs holding class indices')
     
     return parser.parse_args()
 
@@ -59,21 +62,29 @@ def get_output_filenames(args):
     return args.output or list(map(_generate_name, args.input))
 
 
-def mask_to_image(mask: np.ndarray, mask_values):
-    if isinstance(mask_values[0], list):
-        out = np.zeros((mask.shape[-2], mask.shape[-1], len(mask_values[0])), dtype=np.uint8)
-    elif mask_values == [0, 1]:
-        out = np.zeros((mask.shape[-2], mask.shape[-1]), dtype=bool)
-    else:
-        out = np.zeros((mask.shape[-2], mask.shape[-1]), dtype=np.uint8)
-
+def mask_to_image(mask: np.ndarray, mask_values, palette: bool = False):
     if mask.ndim == 3:
         mask = np.argmax(mask, axis=0)
 
-    for i, v in enumerate(mask_values):
-        out[mask == i] = v
+    color = isinstance(mask_values[0], list)
+    if palette and len(mask_values) <= 256:
+        # Write class indices directly as a P-mode image, colours come from the palette
+        colors = np.asarray(mask_values, dtype=np.uint8)
+        if not color:
+            colors = np.repeat(colors[:, None], 3, axis=1) * (255 if mask_values == [0, 1] else 1)
+        img = Image.fromarray(np.where(mask < len(mask_values), mask, 0).astype(np.uint8))
+        img.putpalette(colors[:, :3].reshape(-1).tolist())
+        return img
+
+    if mask_values == [0, 1]:
+        # Pack rows into bits and build the 1-bit image directly
+        bits = np.packbits(mask == 1, axis=-1)
+        return Image.frombytes('1', (mask.shape[-1], mask.shape[-2]), bits.tobytes())
 
-    return Image.fromarray(out)
+    # Map every pixel through a lookup table in a single indexing step
+    lut = np.zeros((max(256, len(mask_values)),) + ((len(mask_values[0]),) if color else ()), dtype=np.uint8)
+    lut[:len(mask_values)] = mask_values
+    return Image.fromarray(lut[mask])
 
 
 if __name__ == '__main__':
@@ -108,7 +119,7 @@ if __name__ == '__main__':
 
         if not args.no_save:
             out_filename = out_files[i]
-            result = mask_to_image(mask, mask_values)
+            result = mask_to_image(mask, mask_values, args.palette)
             result.save(out_filename)
             logging.info(f'Mask saved to {out_filename}')
 
@@ -16,7 +16,8 @@ from tqdm import tqdm
 import wandb
 from evaluate import evaluate
 from unet import UNet
-from utils.data_loading import BasicDataset, CarvanaDataset
+from utils.data_loading import BasicDataset, CarvanaDataset, collate_samples
+from utils.packed_dataset import PackedDataset
 from utils.dice_score import dice_loss
 
 dir_img = Path('./data/imgs/')
@@ -37,12 +38,17 @@ def train_model(
         weight_decay: float = 1e-8,
         momentum: float = 0.999,
         gradient_clipping: float = 1.0,
+        pack_dir: str = None,
 ):
     # 1. Create dataset
+    # Samples stay uint8 until collation, the batch is converted to float32 once
     try:
-        dataset = CarvanaDataset(dir_img, dir_mask, img_scale)
+        dataset = CarvanaDataset(dir_img, dir_mask, img_scale, defer_normalize=True)
     except (AssertionError, RuntimeError, IndexError):
-        dataset = BasicDataset(dir_img, dir_mask, img_scale)
+        dataset = BasicDataset(dir_img, dir_mask, img_scale, defer_normalize=True)
+    if pack_dir:
+        # Decode and resize once, later epochs read preprocessed samples from memory-mapped shards
+        dataset = PackedDataset.from_dataset(dataset, pack_dir)
 
     # 2. Split into train / validation partitions
     n_val = int(len(dataset) * val_percent)
@@ -50,7 +56,8 @@ def train_model(
     train_set, val_set = random_split(dataset, [n_train, n_val], generator=torch.Generator().manual_seed(0))
 
     # 3. Create data loaders
-    loader_args = dict(batch_size=batch_size, num_workers=os.cpu_count(), pin_memory=True)
+    loader_args = dict(batch_size=batch_size, num_workers=os.cpu_count(), pin_memory=True,
+                       collate_fn=collate_samples)
     train_loader = DataLoader(train_set, shuffle=True, **loader_args)
     val_loader = DataLoader(val_set, shuffle=False, drop_last=True, **loader_args)
 
@@ -180,6 +187,8 @@ def get_args():
     parser.add_argument('--amp', action='store_true', default=False, help='Use mixed precision')
     parser.add_argument('--bilinear', action='store_true', default=False, help='Use bilinear upsampling')
     parser.add_argument('--classes', '-c', type=int, default=2, help='Number of classes')
+    parser.add_argument('--pack', type=str, default=None,
+                        help='Preprocess the dataset once into memory-mapped shards in this directory and train from them')
 
     return parser.parse_args()
 
@@ -218,7 +227,8 @@ if __name__ == '__main__':
             device=device,
             img_scale=args.scale,
             val_percent=args.val / 100,
-            amp=args.amp
+            amp=args.amp,
+            pack_dir=args.pack
         )
     except torch.cuda.OutOfMemoryError:
         logging.error('Detected OutOfMemoryError! '
@@ -234,5 +244,6 @@ if __name__ == '__main__':
             device=device,
             img_scale=args.scale,
             val_percent=args.val / 100,
-            amp=args.amp
+            amp=args.amp,
+            pack_dir=args.pack
         )
@@ -3,14 +3,13 @@ import numpy as np
 import torch
 from PIL import Image
 from functools import lru_cache
-from functools import partial
-from itertools import repeat
-from multiprocessing import Pool
-from os import listdir
-from os.path import splitext, isfile, join
+from os.path import splitext
 from pathlib import Path
-from torch.utils.data import Dataset
-from tqdm import tqdm
+from torch.utils.data import Dataset, default_collate
+
+from utils.file_index import load_file_index
+from utils.image_io import draft_image, source_size
+from utils.mask_manifest import cached_mask_values
 
 
 def load_image(filename):
@@ -23,8 +22,7 @@ def load_image(filename):
         return Image.open(filename)
 
 
-def unique_mask_values(idx, mask_dir, mask_suffix):
-    mask_file = list(mask_dir.glob(idx + mask_suffix + '.*'))[0]
+def unique_mask_values(mask_file):
     mask = np.asarray(load_image(mask_file))
     if mask.ndim == 2:
         return np.unique(mask)
@@ -35,25 +33,94 @@ def unique_mask_values(idx, mask_dir, mask_suffix):
         raise ValueError(f'Loaded masks should have 2 or 3 dimensions, found {mask.ndim}')
 
 
+def pack_channels(pixels):
+    """
+    Pack the last (channel) axis of an unsigned integer array into one key per pixel, most
+    significant channel first. Returns None when the channels do not fit into 64 bits.
+    """
+    channels, bits = pixels.shape[-1], pixels.dtype.itemsize * 8
+    if pixels.dtype.kind not in 'bu' or channels * bits > 64:
+        return None
+    key_dtype = np.uint16 if channels * bits <= 16 else np.uint32 if channels * bits <= 32 else np.uint64
+    keys = np.zeros(pixels.shape[:-1], dtype=key_dtype)
+    for c in range(channels):
+        keys <<= key_dtype(bits)
+        keys |= pixels[..., c].astype(key_dtype)
+    return keys
+
+
+@lru_cache(maxsize=32)
+def mask_lookup(mask_values, dtype, channels):
+    """
+    Lookup table from mask pixel (or packed pixel key) to class index for the given mask_values
+
+    Returns ('lut', table) for 8-bit keys, ('search', (sorted keys, class index of each key))
+    for wider keys, or None when the pixels cannot be packed.
+    """
+    values = np.asarray(mask_values)
+    values = values.reshape(len(values), channels) if channels else values.reshape(len(values))
+    # Values that the pixel dtype cannot represent never match a pixel
+    cast = values.astype(dtype)
+    valid = (cast == values).reshape(len(values), -1).all(-1)
+    values, classes = cast[valid], np.arange(len(valid))[valid]
+    if channels:
+        values = pack_channels(values)
+        if values is None:
+            return None
+    if values.dtype in (np.uint8, np.bool_):
+        lut = np.zeros(256, dtype=np.int64)
+        lut[values.astype(np.uint8)] = classes
+        return 'lut', lut
+    order = np.argsort(values, kind='stable')
+    return 'search', (values[order], classes[order])
+
+
+def _hashable(mask_values):
+    return tuple(tuple(v) if isinstance(v, (list, tuple)) else v for v in mask_values)
+
+
+def collate_samples(batch):
+    """
+    Collate samples whose images are still in their source dtype (uint8 for ordinary images):
+    stack them, convert the batch to float32 and divide by 255 the images flagged 'normalize',
+    giving the same values as BasicDataset.preprocess. Masks are returned as long.
+    """
+    batch = default_collate(batch)
+    images = batch['image'].float()
+    normalize = batch.pop('normalize')
+    if normalize.all():
+        images /= 255.0
+    else:
+        # In place per sample; boolean-mask assignment would allocate another float batch
+        for i in normalize.nonzero().flatten().tolist():
+            images[i] /= 255.0
+    batch['image'] = images
+    batch['mask'] = batch['mask'].long()
+    return batch
+
+
 class BasicDataset(Dataset):
-    def __init__(self, images_dir: str, mask_dir: str, scale: float = 1.0, mask_suffix: str = ''):
+    def __init__(self, images_dir: str, mask_dir: str, scale: float = 1.0, mask_suffix: str = '',
+                 defer_normalize: bool = False):
         self.images_dir = Path(images_dir)
         self.mask_dir = Path(mask_dir)
         assert 0 < scale <= 1, 'Scale must be between 0 and 1'
         self.scale = scale
         self.mask_suffix = mask_suffix
+        # Return images in their source dtype with a 'normalize' flag; collate_samples converts per batch
+        self.defer_normalize = defer_normalize
 
-        self.ids = [splitext(file)[0] for file in listdir(images_dir) if isfile(join(images_dir, file)) and not file.startswith('.')]
+        # id -> (image file names, mask file names), built once instead of globbing in __getitem__
+        self.files = load_file_index(self.images_dir, self.mask_dir, self.mask_suffix)
+        self.ids = list(self.files)
         if not self.ids:
             raise RuntimeError(f'No input file found in {images_dir}, make sure you put your images there')
 
         logging.info(f'Creating dataset with {len(self.ids)} examples')
         logging.info('Scanning mask files to determine unique values')
-        with Pool() as p:
-            unique = list(tqdm(
-                p.imap(partial(unique_mask_values, mask_dir=self.mask_dir, mask_suffix=self.mask_suffix), self.ids),
-                total=len(self.ids)
-            ))
+        mask_files = [self.mask_dir / self.files[idx][1][0] for idx in self.ids]
+        # Only masks that are new or changed since the last run are decoded
+        unique = cached_mask_values(self.mask_dir, mask_files, unique_mask_values)
 
         self.mask_values = list(sorted(np.unique(np.concatenate(unique), axis=0).tolist()))
         logging.info(f'Unique mask values: {self.mask_values}')
@@ -62,22 +129,68 @@ class BasicDataset(Dataset):
         return len(self.ids)
 
     @staticmethod
-    def preprocess(mask_values, pil_img, scale, is_mask):
-        w, h = pil_img.size
+    def resize(pil_img, scale, is_mask):
+        """
+        Decode and resize an image or mask to `scale`, keeping the source pixel dtype
+        """
+        if not is_mask:
+            draft_image(pil_img, scale)
+        w, h = source_size(pil_img)
         newW, newH = int(scale * w), int(scale * h)
         assert newW > 0 and newH > 0, 'Scale is too small, resized images would have no pixel'
-        pil_img = pil_img.resize((newW, newH), resample=Image.NEAREST if is_mask else Image.BICUBIC)
-        img = np.asarray(pil_img)
-
         if is_mask:
-            mask = np.zeros((newH, newW), dtype=np.int64)
-            for i, v in enumerate(mask_values):
-                if img.ndim == 2:
-                    mask[img == v] = i
-                else:
-                    mask[(img == v).all(-1)] = i
+            pil_img = pil_img.resize((newW, newH), resample=Image.NEAREST)
+        elif pil_img.size != (newW, newH):
+            pil_img = pil_img.resize((newW, newH), resample=Image.BICUBIC)
+        return np.asarray(pil_img)
 
-            return mask
+    @staticmethod
+    def mask_to_labels(mask_values, img):
+        """
+        Map mask pixel values to class indices (position in mask_values), pixels matching no value map to 0
+
+        RGB(A) pixels are packed into one integer key, then a single table lookup (8-bit keys) or
+        searchsorted pass over the sorted keys replaces one full-image comparison per class.
+        """
+        channels = img.shape[-1] if img.ndim == 3 else 0
+        lookup = mask_lookup(_hashable(mask_values), img.dtype.str, channels)
+        if lookup is not None:
+            keys = pack_channels(img) if channels else img
+            kind, table = lookup
+            if kind == 'lut':
+                return table[keys.view(np.uint8) if keys.dtype == np.bool_ else keys]
+            sorted_keys, classes = table
+            pos = np.searchsorted(sorted_keys, keys).clip(max=len(sorted_keys) - 1)
+            return np.where(sorted_keys[pos] == keys, classes[pos], 0)
+
+        mask = np.zeros(img.shape[:2], dtype=np.int64)
+        for i, v in enumerate(mask_values):
+            if img.ndim == 2:
+                mask[img == v] = i
+            else:
+                mask[(img == v).all(-1)] = i
+        return mask
+
+    @staticmethod
+    def to_chw(img):
+        """
+        (H, W) or (H, W, C) pixels to a new contiguous (C, H, W) array in the source dtype
+        """
+        return np.array(img[np.newaxis, ...] if img.ndim == 2 else img.transpose((2, 0, 1)), order='C')
+
+    @staticmethod
+    def needs_normalize(img):
+        """
+        Images are divided by 255 only when some pixel is above 1 (max() avoids a full-size boolean temporary)
+        """
+        return bool(img.max() > 1)
+
+    @staticmethod
+    def preprocess(mask_values, pil_img, scale, is_mask):
+        img = BasicDataset.resize(pil_img, scale, is_mask)
+
+        if is_mask:
+            return BasicDataset.mask_to_labels(mask_values, img)
 
         else:
             if img.ndim == 2:
@@ -85,15 +198,23 @@ class BasicDataset(Dataset):
             else:
                 img = img.transpose((2, 0, 1))
 
-            if (img > 1).any():
-                img = img / 255.0
+            # Convert straight to a contiguous float32 array and normalize in place, instead of
+            # going through a float64 array that the caller copies again to float32
+            normalize = BasicDataset.needs_normalize(img)
+            img = img.astype(np.float32, order='C')
+            if normalize:
+                img /= 255.0
 
             return img
 
-    def __getitem__(self, idx):
+    def load_pair(self, idx):
+        """
+        Open the image and mask files of a sample
+        """
         name = self.ids[idx]
-        mask_file = list(self.mask_dir.glob(name + self.mask_suffix + '.*'))
-        img_file = list(self.images_dir.glob(name + '.*'))
+        img_names, mask_names = self.files[name]
+        mask_file = [self.mask_dir / file for file in mask_names]
+        img_file = [self.images_dir / file for file in img_names]
 
         assert len(img_file) == 1, f'Either no image or multiple images found for the ID {name}: {img_file}'
         assert len(mask_file) == 1, f'Either no mask or multiple masks found for the ID {name}: {mask_file}'
@@ -102,16 +223,28 @@ class BasicDataset(Dataset):
 
         assert img.size == mask.size, \
             f'Image and mask {name} should be the same size, but are {img.size} and {mask.size}'
+        return img, mask
 
-        img = self.preprocess(self.mask_values, img, self.scale, is_mask=False)
+    def __getitem__(self, idx):
+        img, mask = self.load_pair(idx)
         mask = self.preprocess(self.mask_values, mask, self.scale, is_mask=True)
 
+        # Both arrays are freshly allocated and contiguous, the tensors share their memory
+        if self.defer_normalize:
+            img = self.to_chw(self.resize(img, self.scale, is_mask=False))
+            return {
+                'image': torch.from_numpy(img),
+                'mask': torch.from_numpy(mask),
+                'normalize': self.needs_normalize(img)
+            }
+
+        img = self.preprocess(self.mask_values, img, self.scale, is_mask=False)
         return {
-            'image': torch.as_tensor(img.copy()).float().contiguous(),
-            'mask': torch.as_tensor(mask.copy()).long().contiguous()
+            'image': torch.from_numpy(img),
+            'mask': torch.from_numpy(mask)
         }
 
 
 class CarvanaDataset(BasicDataset):
-    def __init__(self, images_dir, mask_dir, scale=1):
-        super().__init__(images_dir, mask_dir, scale, mask_suffix='_mask')
+    def __init__(self, images_dir, mask_dir, scale=1, defer_normalize=False):
+        super().__init__(images_dir, mask_dir, scale, mask_suffix='_mask', defer_normalize=defer_normalize)
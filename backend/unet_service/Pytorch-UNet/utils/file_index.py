@@ -0,0 +1,97 @@
+"""
+Persistent id -> (image files, mask files) index for a dataset directory pair
+
+Each directory is listed once with os.scandir and every file is filed under the prefixes that
+`glob(prefix + '.*')` would match it with, so looking up a sample no longer scans the directory.
+The index is saved as a hidden JSON file next to the images directory and rebuilt when the
+modification time of either directory changes (files added, removed or renamed).
+"""
+import hashlib
+import json
+import logging
+import os
+from collections import defaultdict
+from pathlib import Path
+
+INDEX_VERSION = 1
+
+
+def index_path(images_dir, mask_dir, mask_suffix=''):
+    """
+    Index file for a dataset, stored in the parent of the images directory so that writing it
+    does not change the modification time of the indexed directories
+    """
+    images_dir, mask_dir = Path(images_dir).resolve(), Path(mask_dir).resolve()
+    key = hashlib.sha1(f'{images_dir}\0{mask_dir}\0{mask_suffix}'.encode()).hexdigest()[:12]
+    return images_dir.parent / f'.{images_dir.name}.index-{key}.json'
+
+
+def _mtime_ns(directory):
+    return os.stat(directory).st_mtime_ns
+
+
+def _list_files(directory):
+    """
+    Names of the non-hidden regular files in a directory, in listing order
+    """
+    with os.scandir(directory) as entries:
+        return [entry.name for entry in entries if not entry.name.startswith('.') and entry.is_file()]
+
+
+def _by_prefix(names):
+    """
+    Map every prefix p for which glob(p + '.*') matches a file name to the matching names
+    """
+    matches = defaultdict(list)
+    for name in names:
+        dot = name.find('.', 1)
+        while dot != -1:
+            matches[name[:dot]].append(name)
+            dot = name.find('.', dot + 1)
+    return matches
+
+
+def build_index(images_dir, mask_dir, mask_suffix=''):
+    """
+    Scan both directories once and return {id: (image file names, mask file names)}
+    """
+    images = _list_files(images_dir)
+    image_matches = _by_prefix(images)
+    mask_matches = _by_prefix(_list_files(mask_dir))
+    index = {}
+    for name in images:
+        idx = os.path.splitext(name)[0]
+        if idx not in index:
+            index[idx] = (sorted(image_matches[idx]), sorted(mask_matches[idx + mask_suffix]))
+    return index
+
+
+def load_file_index(images_dir, mask_dir, mask_suffix=''):
+    """
+    Load the persisted index if both directories are unchanged, otherwise rebuild and save it
+    """
+    path = index_path(images_dir, mask_dir, mask_suffix)
+    mtimes = [_mtime_ns(images_dir), _mtime_ns(mask_dir)]
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+        if saved.get('version') == INDEX_VERSION and saved.get('mtime_ns') == mtimes:
+            logging.info(f'Loaded file index from {path}')
+            return {idx: (images, masks) for idx, images, masks in saved['files']}
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    index = build_index(images_dir, mask_dir, mask_suffix)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'version': INDEX_VERSION,
+                'mtime_ns': mtimes,
+                'files': [[idx, images, masks] for idx, (images, masks) in index.items()],
+            }, f)
+        os.replace(tmp_path, path)
+        logging.info(f'Saved file index to {path}')
+    except OSError as e:
+        logging.warning(f'Could not save file index to {path}: {e}')
+    return index
@@ -0,0 +1,24 @@
+"""
+Image decoding helpers that do not depend on torch
+"""
+
+
+def draft_image(pil_img, scale):
+    """
+    Before decoding, let JPEG images decode directly at the smallest 1/2, 1/4 or 1/8 DCT scale
+    that is still no smaller than the target size. Other formats and already decoded images are
+    left untouched. The original size is kept in info['source_size'].
+    """
+    if scale < 1 and 'source_size' not in pil_img.info:
+        w, h = pil_img.size
+        pil_img.draft(None, (max(int(scale * w), 1), max(int(scale * h), 1)))
+        if pil_img.size != (w, h):
+            pil_img.info['source_size'] = (w, h)
+    return pil_img
+
+
+def source_size(pil_img):
+    """
+    Size of the image before draft decoding
+    """
+    return pil_img.info.get('source_size', pil_img.size)
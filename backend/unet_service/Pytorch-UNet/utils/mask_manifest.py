@@ -0,0 +1,112 @@
+"""
+Persistent cache of the unique values of every mask file
+
+The manifest records, per mask file name, its size, modification time, a content fingerprint
+and the unique values found in it. It is saved as a hidden JSON file next to the mask directory.
+On later runs only files that are new or whose size/modification time changed are looked at
+again; a file that was only touched or copied (same fingerprint) is not decoded.
+"""
+import hashlib
+import json
+import logging
+import os
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+MANIFEST_VERSION = 1
+CHUNK_SIZE = 1024 * 1024
+
+
+def manifest_path(mask_dir):
+    mask_dir = Path(mask_dir).resolve()
+    return mask_dir.parent / f'.{mask_dir.name}.mask-values.json'
+
+
+def fingerprint(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _load(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION:
+            return manifest['files']
+    except (OSError, ValueError, KeyError):
+        pass
+    return {}
+
+
+def _save(path, entries, mask_dir):
+    # Drop entries of files that no longer exist; other datasets may share the directory
+    existing = set(os.listdir(mask_dir))
+    entries = {name: entry for name, entry in entries.items() if name in existing}
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': MANIFEST_VERSION, 'files': entries}, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.warning(f'Could not save mask value manifest to {path}: {e}')
+
+
+def _scan(args):
+    scan, mask_file = args
+    return fingerprint(mask_file), scan(mask_file).tolist()
+
+
+def cached_mask_values(mask_dir, mask_files, scan):
+    """
+    Unique values of each mask file, reusing the manifest for unchanged files
+
+    Args:
+        mask_dir: directory containing the mask files
+        mask_files: paths of the mask files, all inside mask_dir
+        scan: scan(mask_file) -> np.ndarray of the unique values, run in a process pool for stale files
+
+    Returns:
+        list of np.ndarray, one per mask file
+    """
+    path = manifest_path(mask_dir)
+    entries = _load(path)
+    values, stats, stale, changed = [None] * len(mask_files), [], [], False
+    for i, mask_file in enumerate(mask_files):
+        name = Path(mask_file).name
+        stat = os.stat(mask_file)
+        stats.append(stat)
+        entry = entries.get(name)
+        if entry is None:
+            stale.append(i)
+            continue
+        if entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            if entry['size'] != stat.st_size or entry['fingerprint'] != fingerprint(mask_file):
+                stale.append(i)
+                continue
+            entry['mtime_ns'] = stat.st_mtime_ns
+            changed = True
+        values[i] = np.asarray(entry['values'])
+
+    logging.info(f'Mask value manifest: {len(mask_files) - len(stale)} cached, {len(stale)} to scan')
+    if stale:
+        with Pool() as p:
+            scanned = list(tqdm(
+                p.imap(_scan, [(scan, mask_files[i]) for i in stale]),
+                total=len(stale)
+            ))
+        for i, (digest, unique) in zip(stale, scanned):
+            stat = stats[i]
+            entries[Path(mask_files[i]).name] = {
+                'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'fingerprint': digest, 'values': unique
+            }
+            values[i] = np.asarray(unique)
+        changed = True
+    if changed:
+        _save(path, entries, mask_dir)
+    return values
@@ -0,0 +1,175 @@
+"""
+Preprocessed training cache in memory-mapped shard files
+
+pack_dataset decodes every sample of a BasicDataset once, resizes it to the dataset scale and
+writes the image (source dtype, usually uint8, CHW) and the class-index mask into shard files:
+
+    <pack_dir>/shard-00000.bin ...   raw sample arrays, 64-byte aligned
+    <pack_dir>/index.json            scale, mask_values, source signature and per-sample offsets
+
+PackedDataset maps the shards copy-on-write and returns tensors that view the mapped pages, so an
+epoch does no decoding, resizing or mask remapping. PackedDataset.collate converts a batch to
+float images and long masks, the same values BasicDataset would have produced.
+"""
+import hashlib
+import json
+import logging
+import os
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+from utils.data_loading import collate_samples
+
+PACK_VERSION = 1
+ALIGNMENT = 64
+INDEX_NAME = 'index.json'
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def source_signature(dataset):
+    """
+    Fingerprint of the source files (names, sizes, modification times) and packing parameters
+    """
+    digest = hashlib.sha1(json.dumps([PACK_VERSION, dataset.scale, dataset.mask_values]).encode())
+    for idx in dataset.ids:
+        for directory, names in zip((dataset.images_dir, dataset.mask_dir), dataset.files[idx]):
+            for name in names:
+                stat = os.stat(directory / name)
+                digest.update(f'{name}\0{stat.st_size}\0{stat.st_mtime_ns}\0'.encode())
+    return digest.hexdigest()
+
+
+# Dataset and mask dtype of a packing worker, set once per process by _init_worker
+_worker_state = None
+
+
+def _init_worker(dataset, mask_dtype):
+    global _worker_state
+    _worker_state = (dataset, mask_dtype)
+
+
+def _preprocess_sample(i):
+    dataset, mask_dtype = _worker_state
+    img, mask = dataset.load_pair(i)
+    img = dataset.to_chw(dataset.resize(img, dataset.scale, is_mask=False))
+    labels = dataset.mask_to_labels(dataset.mask_values, dataset.resize(mask, dataset.scale, is_mask=True))
+    return img, labels.astype(mask_dtype), dataset.needs_normalize(img)
+
+
+def pack_dataset(dataset, pack_dir, shard_bytes=1 << 30):
+    """
+    Preprocess every sample of a BasicDataset into shard files in pack_dir
+
+    The index is written last, so an interrupted run leaves no usable pack behind.
+    """
+    pack_dir = Path(pack_dir)
+    pack_dir.mkdir(parents=True, exist_ok=True)
+    index_file = pack_dir / INDEX_NAME
+    if index_file.exists():
+        index_file.unlink()
+    for old in pack_dir.glob('shard-*.bin'):
+        old.unlink()
+
+    mask_dtype = np.dtype(np.uint8 if len(dataset.mask_values) <= 256 else np.int32)
+    samples, shard, f, offset = [], -1, None, 0
+    logging.info(f'Packing {len(dataset)} samples into {pack_dir}')
+    try:
+        # The dataset is sent to each worker once, tasks only carry sample indices
+        with Pool(initializer=_init_worker, initargs=(dataset, mask_dtype)) as p:
+            preprocessed = p.imap(_preprocess_sample, range(len(dataset)), chunksize=4)
+            for img, labels, normalize in tqdm(preprocessed, total=len(dataset)):
+                if f is None or offset >= shard_bytes:
+                    if f is not None:
+                        f.close()
+                    shard += 1
+                    f = open(pack_dir / f'shard-{shard:05d}.bin', 'wb')
+                    offset = 0
+                entry = {'shard': shard, 'normalize': normalize}
+                for key, array in (('image', img), ('mask', labels)):
+                    offset = _align(offset)
+                    f.seek(offset)
+                    f.write(array.tobytes())
+                    entry[key] = [offset, array.dtype.str, list(array.shape)]
+                    offset += array.nbytes
+                samples.append(entry)
+    finally:
+        if f is not None:
+            f.close()
+
+    with open(pack_dir / f'{INDEX_NAME}.tmp', 'w', encoding='utf-8') as out:
+        json.dump({
+            'version': PACK_VERSION,
+            'scale': dataset.scale,
+            'mask_values': dataset.mask_values,
+            'signature': source_signature(dataset),
+            'ids': dataset.ids,
+            'samples': samples,
+        }, out)
+    os.replace(pack_dir / f'{INDEX_NAME}.tmp', index_file)
+    return PackedDataset(pack_dir)
+
+
+class PackedDataset(Dataset):
+    def __init__(self, pack_dir):
+        self.pack_dir = Path(pack_dir)
+        with open(self.pack_dir / INDEX_NAME, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('version') != PACK_VERSION:
+            raise RuntimeError(f'Unsupported pack version {index.get("version")} in {pack_dir}')
+        self.scale = index['scale']
+        self.mask_values = index['mask_values']
+        self.signature = index['signature']
+        self.ids = index['ids']
+        self.samples = index['samples']
+        self._shards = {}
+
+    @classmethod
+    def from_dataset(cls, dataset, pack_dir):
+        """
+        Open the pack in pack_dir, (re)building it when it is missing or the source files changed
+        """
+        try:
+            packed = cls(pack_dir)
+            if packed.signature == source_signature(dataset):
+                logging.info(f'Using packed dataset in {pack_dir}')
+                return packed
+            logging.info(f'Source files changed since {pack_dir} was packed')
+        except (OSError, ValueError, KeyError, RuntimeError):
+            pass
+        return pack_dataset(dataset, pack_dir)
+
+    def __getstate__(self):
+        # Mappings are reopened in each DataLoader worker
+        return {**self.__dict__, '_shards': {}}
+
+    def __len__(self):
+        return len(self.samples)
+
+    def _array(self, shard, offset, dtype, shape):
+        data = self._shards.get(shard)
+        if data is None:
+            # Copy-on-write: pages are shared with the page cache and writes never reach the file
+            data = self._shards[shard] = np.memmap(self.pack_dir / f'shard-{shard:05d}.bin', dtype=np.uint8, mode='c')
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        return data[offset:offset + nbytes].view(dtype).reshape(shape)
+
+    def __getitem__(self, idx):
+        sample = self.samples[idx]
+        img = self._array(sample['shard'], *sample['image'])
+        mask = self._array(sample['shard'], *sample['mask'])
+        return {
+            'image': torch.from_numpy(img),
+            'mask': torch.from_numpy(mask),
+            'normalize': sample['normalize'],
+        }
+
+    collate = staticmethod(collate_samples)
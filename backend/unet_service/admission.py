@@ -0,0 +1,231 @@
+"""
+预测请求的准入控制
+
+限制同时执行的预测请求数, 超出的请求按到达顺序在有界队列中等待, 等待超时、队列已满或
+用户超出配额时立即返回429, 并根据当前排队数和实测的单张图片耗时估算 Retry-After.
+预测请求不会占满全部CPU, 登录、后台管理等其他接口的延迟不受预测高峰影响.
+限制按进程生效, 多worker部署时总并发数为各进程之和.
+"""
+import functools
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+from rest_framework import status
+from rest_framework.response import Response
+
+from .metrics import REGISTRY
+
+ADMISSION_ACTIVE = REGISTRY.gauge('unet_admission_active', '正在执行的预测请求数')
+ADMISSION_QUEUED = REGISTRY.gauge('unet_admission_queued', '等待准入的预测请求数')
+ADMISSION_WAIT = REGISTRY.histogram('unet_admission_wait_seconds', '预测请求准入前的排队时间')
+ADMISSION_REJECTED = REGISTRY.counter('unet_admission_rejected_total', '被拒绝的预测请求数')
+ADMISSION_SECONDS_PER_IMAGE = REGISTRY.gauge('unet_admission_seconds_per_image', '预测请求平均每张图片的耗时')
+
+# 耗时统计的指数滑动平均系数
+EWMA_ALPHA = 0.2
+
+
+class AdmissionRejected(Exception):
+    """
+    预测请求未被准入
+
+    Args:
+        reason: queue_full 队列已满, timeout 排队超时, user_quota 用户超出配额
+        retry_after: 建议客户端重试前等待的秒数
+    """
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """
+    已准入的请求, 预测完成前可设置 images 为实际处理的图片数, 用于估算单张图片耗时
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.images = 1
+
+
+class AdmissionController:
+    """
+    预测请求准入控制器
+
+    Args:
+        max_concurrent: 同时执行的最大请求数
+        max_queue: 最大排队请求数, 0 表示不排队
+        queue_timeout: 最长排队时间(秒)
+        per_user: 每个用户同时执行和排队的最大请求数, 0 表示不限制
+    """
+
+    def __init__(self, max_concurrent=2, max_queue=8, queue_timeout=10.0, per_user=2):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.per_user = per_user
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = deque()
+        self._users = {}
+        self._seconds_per_image = 1.0
+        self._images_per_request = 1.0
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            max_concurrent=getattr(settings, 'UNET_ADMISSION_MAX_CONCURRENT', 2),
+            max_queue=getattr(settings, 'UNET_ADMISSION_MAX_QUEUE', 8),
+            queue_timeout=getattr(settings, 'UNET_ADMISSION_QUEUE_TIMEOUT', 10),
+            per_user=getattr(settings, 'UNET_ADMISSION_PER_USER', 2),
+        )
+
+    def retry_after(self):
+        """
+        按排队数和平均每个请求的耗时估算排在队尾的请求需要等待的秒数
+        """
+        with self._cond:
+            return self._retry_after()
+
+    def _retry_after(self):
+        pending = len(self._waiting) + self._active + 1 - self.max_concurrent
+        request_seconds = self._images_per_request * self._seconds_per_image
+        return max(1, math.ceil(max(pending, 1) * request_seconds / self.max_concurrent))
+
+    def _reject(self, reason):
+        ADMISSION_REJECTED.inc(reason=reason)
+        return AdmissionRejected(reason, self._retry_after())
+
+    @contextmanager
+    def admit(self, user):
+        """
+        准入一个请求, 未被准入时抛出 AdmissionRejected
+        """
+        ticket = AdmissionTicket(user)
+        with self._cond:
+            if self.per_user and self._users.get(user, 0) >= self.per_user:
+                raise self._reject('user_quota')
+            if self._active >= self.max_concurrent or self._waiting:
+                if len(self._waiting) >= self.max_queue:
+                    raise self._reject('queue_full')
+                self._wait(ticket)
+            self._active += 1
+            self._users[user] = self._users.get(user, 0) + 1
+            ADMISSION_ACTIVE.set(self._active)
+
+        started = time.monotonic()
+        try:
+            yield ticket
+        finally:
+            elapsed = time.monotonic() - started
+            with self._cond:
+                self._active -= 1
+                self._users[user] -= 1
+                if not self._users[user]:
+                    del self._users[user]
+                images = max(1, ticket.images)
+                self._seconds_per_image += EWMA_ALPHA * (elapsed / images - self._seconds_per_image)
+                self._images_per_request += EWMA_ALPHA * (images - self._images_per_request)
+                ADMISSION_ACTIVE.set(self._active)
+                ADMISSION_SECONDS_PER_IMAGE.set(self._seconds_per_image)
+                self._cond.notify_all()
+
+    def _wait(self, ticket):
+        """
+        按到达顺序排队, 轮到队首且有空闲名额时返回; 调用时持有锁
+        """
+        # 排队中的请求也计入用户配额
+        self._users[ticket.user] = self._users.get(ticket.user, 0) + 1
+        self._waiting.append(ticket)
+        ADMISSION_QUEUED.set(len(self._waiting))
+        queued_at = time.monotonic()
+        deadline = queued_at + self.queue_timeout
+        try:
+            while self._waiting[0] is not ticket or self._active >= self.max_concurrent:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(ticket)
+                    self._cond.notify_all()
+                    raise self._reject('timeout')
+                self._cond.wait(remaining)
+            self._waiting.popleft()
+        finally:
+            self._users[ticket.user] -= 1
+            if not self._users[ticket.user]:
+                del self._users[ticket.user]
+            ADMISSION_QUEUED.set(len(self._waiting))
+            ADMISSION_WAIT.observe(time.monotonic() - queued_at)
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller():
+    """
+    进程级准入控制器, 未开启时返回None
+    """
+    global _controller
+    if not getattr(settings, 'UNET_ADMISSION_ENABLED', True):
+        return None
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = AdmissionController.from_settings()
+    return _controller
+
+
+def client_key(request):
+    """
+    配额按登录用户统计, 匿名请求按客户端IP统计
+
+    X-Forwarded-For 可以由客户端任意填写, 只有配置了 UNET_ADMISSION_TRUSTED_PROXIES(前面的反向代理层数)时,
+    才取最后一层可信代理追加的地址, 否则使用 REMOTE_ADDR
+    """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    proxies = getattr(settings, 'UNET_ADMISSION_TRUSTED_PROXIES', 0)
+    forwarded = [ip.strip() for ip in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if ip.strip()]
+    if proxies and len(forwarded) >= proxies:
+        return f'ip:{forwarded[-proxies]}'
+    return f"ip:{request.META.get('REMOTE_ADDR')}"
+
+
+def set_image_count(request, images):
+    """
+    记录请求实际处理的图片数, 用于估算 Retry-After
+    """
+    ticket = getattr(request, 'unet_admission', None)
+    if ticket is not None:
+        ticket.images = images
+
+
+def admission_controlled(view):
+    """
+    视图方法的准入控制装饰器, 未被准入时返回429和 Retry-After
+    """
+
+    @functools.wraps(view)
+    def wrapper(self, request, *args, **kwargs):
+        controller = get_admission_controller()
+        if controller is None:
+            return view(self, request, *args, **kwargs)
+        try:
+            with controller.admit(client_key(request)) as ticket:
+                request.unet_admission = ticket
+                return view(self, request, *args, **kwargs)
+        except AdmissionRejected as e:
+            return Response(
+                {'error': f'预测服务繁忙({e.reason}), 请在{e.retry_after}秒后重试', 'retry_after': e.retry_after},
+                status=status.HTTP_429_TOO_MANY_REQUESTS,
+                headers={'Retry-After': str(e.retry_after)}
+            )
+
+    return wrapper
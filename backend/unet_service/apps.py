@@ -1,6 +1,39 @@
+import logging
+import threading
+
 from django.apps import AppConfig
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def start_warmup():
+    """
+    在后台预加载模型, 避免首个预测请求承担加载耗时
+
+    只在提供预测服务的进程中调用: web应用入口(application.asgi / application.wsgi)和celery worker进程,
+    migrate、shell 等管理命令不加载模型. 开启推理进程池时由推理服务加载模型, web worker 不加载
+    """
+    if getattr(settings, 'UNET_WARMUP_ON_START', False) and not getattr(settings, 'UNET_INFERENCE_POOL_ENABLED', False):
+        threading.Thread(target=UnetServiceConfig.warmup_models, name='unet-warmup', daemon=True).start()
+
+
+def _warmup_celery_worker(**kwargs):
+    start_warmup()
 
 
 class UnetServiceConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'unet_service'
+
+    def ready(self):
+        # celery worker 的每个子进程启动后预加载模型, celery beat 等其他进程不会触发该信号
+        from celery.signals import worker_process_init
+        worker_process_init.connect(_warmup_celery_worker, weak=False, dispatch_uid='unet_service.warmup')
+
+    @staticmethod
+    def warmup_models():
+        from .model_registry import get_registry
+        registry = get_registry()
+        registry.warmup(getattr(settings, 'UNET_WARMUP_MODELS', None))
+        logger.info(f"UNet models warmed up: {[m['name'] for m in registry.describe() if m['loaded']]}")
@@ -0,0 +1,163 @@
+"""
+UNet推理后端
+
+同一个 UNetPredictor 可以用不同的运行时执行前向推理:
+    eager       PyTorch模型, 直接加载训练得到的checkpoint
+    torchscript 导出的TorchScript模型(.pt), 冻结后由JIT执行
+    onnx        导出的ONNX模型(.onnx), 由ONNX Runtime在CPU上执行, 需要安装 onnxruntime
+
+导出模型旁边保存同名的 .json 元数据, 记录 mask_values、类别数等, 加载导出模型时不再需要原checkpoint.
+"""
+import inspect
+import json
+import os
+
+import numpy as np
+import torch
+
+BACKENDS = ('eager', 'torchscript', 'onnx')
+
+
+def metadata_path(artifact_path):
+    return f'{os.path.splitext(artifact_path)[0]}.json'
+
+
+def load_metadata(artifact_path):
+    """
+    读取导出模型的元数据
+    """
+    path = metadata_path(artifact_path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Model metadata not found: {path}")
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_metadata(artifact_path, **metadata):
+    with open(metadata_path(artifact_path), 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, ensure_ascii=False, indent=2)
+
+
+class InferenceBackend:
+    """
+    推理后端接口: 输入 (N, 3, H, W) float32张量, 返回CPU上的 (N, n_classes, H, W) logits
+    """
+    name = None
+
+    def __call__(self, batch):
+        raise NotImplementedError
+
+    def memory_bytes(self):
+        """
+        权重占用的内存字节数
+        """
+        return 0
+
+    def share_memory(self):
+        """
+        把权重放入共享内存, 供fork出的推理进程共用
+        """
+
+
+class EagerBackend(InferenceBackend):
+    name = 'eager'
+
+    def __init__(self, net, device):
+        self.net = net
+        self.device = device
+
+    def __call__(self, batch):
+        batch = batch.to(device=self.device, dtype=torch.float32)
+        with torch.no_grad():
+            return self.net(batch).cpu()
+
+    def memory_bytes(self):
+        tensors = list(self.net.parameters()) + list(self.net.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+    def share_memory(self):
+        # 映射的扁平checkpoint已经通过页缓存在进程间共享
+        if not getattr(self.net, 'memory_mapped', False):
+            self.net.share_memory()
+
+
+class TorchScriptBackend(EagerBackend):
+    name = 'torchscript'
+
+    def __init__(self, path, device):
+        super().__init__(torch.jit.load(path, map_location=device), device)
+        self.path = path
+        self.net.eval()
+
+    def memory_bytes(self):
+        # 冻结后的权重是图中的常量, 不再是参数, 以文件大小估算
+        return os.path.getsize(self.path)
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    name = 'onnx'
+
+    def __init__(self, path, threads=None):
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError("ONNX backend requires onnxruntime: pip install onnxruntime") from e
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # 与PyTorch使用相同的intra-op线程数, 推理进程池中由 torch.set_num_threads 决定
+        options.intra_op_num_threads = threads or torch.get_num_threads()
+        options.inter_op_num_threads = 1
+        self.path = path
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        inputs = np.ascontiguousarray(batch.detach().cpu().numpy(), dtype=np.float32)
+        return torch.from_numpy(self.session.run(None, {self.input_name: inputs})[0])
+
+    def memory_bytes(self):
+        return os.path.getsize(self.path)
+
+
+def load_backend(backend, path, device):
+    """
+    加载导出模型, 返回 (推理后端, 元数据)
+    """
+    metadata = load_metadata(path)
+    if backend == 'torchscript':
+        return TorchScriptBackend(path, device), metadata
+    if backend == 'onnx':
+        return OnnxRuntimeBackend(path), metadata
+    raise ValueError(f'backend must be one of {BACKENDS}, got {backend!r}')
+
+
+def export_torchscript(net, path):
+    """
+    把eager模型编译为TorchScript并冻结权重后保存, 输入尺寸不受限制
+    """
+    net.eval()
+    module = torch.jit.freeze(torch.jit.script(net))
+    module.save(path)
+    return path
+
+
+def export_onnx(net, path, opset_version=17):
+    """
+    导出为批大小和图片尺寸都可变的ONNX模型
+    """
+    net.eval()
+    example = torch.randn(1, net.n_channels, 64, 64)
+    dynamic = {0: 'batch', 2: 'height', 3: 'width'}
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # 新版PyTorch默认使用dynamo导出, 这里沿用支持 dynamic_axes 的TorchScript导出器
+        kwargs['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(
+            net, (example,), path,
+            input_names=['input'], output_names=['logits'],
+            dynamic_axes={'input': dynamic, 'logits': dynamic},
+            opset_version=opset_version,
+            **kwargs
+        )
+    return path
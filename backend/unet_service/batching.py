@@ -0,0 +1,197 @@
+"""
+UNet推理微批处理调度器
+
+在一个很短的时间窗口内收集待推理的图片, 相同尺寸的张量合并成一次前向推理,
+再把每张图片的结果分发回各自的调用方
+"""
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from django.conf import settings
+
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+QUEUE_DEPTH = REGISTRY.gauge('unet_batch_queue_depth', '等待批处理的图片数量')
+BATCH_SIZE = REGISTRY.histogram('unet_batch_size', '每次前向推理的批大小', buckets=(1, 2, 4, 8, 16, 32, 64))
+BATCH_WAIT = REGISTRY.histogram('unet_batch_wait_seconds', '图片从入队到开始推理的等待时间')
+BATCHES = REGISTRY.counter('unet_batches_total', '执行的批量前向推理次数')
+
+
+class _PendingItem:
+    __slots__ = ('tensor', 'future', 'enqueued_at')
+
+    def __init__(self, tensor):
+        self.tensor = tensor
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+class MicroBatcher:
+    """
+    单个预测器的微批处理队列
+
+    调用线程负责解码、预处理和后处理, 后台线程只负责合批和前向推理.
+    后台线程空闲超过 idle_timeout 秒后退出, 下次提交时重新启动,
+    因此被注册表淘汰的模型不会被常驻线程一直引用.
+    """
+
+    def __init__(self, predictor, max_batch_size=8, max_wait_ms=10, idle_timeout=60):
+        self.predictor = predictor
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0, max_wait_ms) / 1000.0
+        self.idle_timeout = idle_timeout
+        self.model_name = getattr(predictor, 'name', 'default')
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, tensor):
+        """
+        提交一张 (C, H, W) 的预处理图片, 返回结果为 (1, n_classes, H, W) logits 的Future
+        """
+        item = _PendingItem(tensor)
+        self._queue.put(item)
+        QUEUE_DEPTH.inc(model=self.model_name)
+        self._ensure_worker()
+        return item.future
+
+    def predict(self, image_file, scale_factor=1, out_threshold=0.5, tiling=None):
+        """
+        与 UNetPredictor.predict 相同的接口, 前向推理通过批处理队列完成
+        """
+        img = self.predictor.load_image(image_file, scale_factor)
+        return self.predict_image(img, scale_factor, out_threshold, tiling)
+
+    def predict_image(self, img, scale_factor=1, out_threshold=0.5, tiling=None):
+        """
+        与 UNetPredictor.predict_image 相同的接口, 前向推理通过批处理队列完成
+        """
+        return self.predictor._mask_to_image(self.predict_labels(img, scale_factor, out_threshold, tiling))
+
+    def predict_labels(self, img, scale_factor=1, out_threshold=0.5, tiling=None, with_confidence=False):
+        """
+        与 UNetPredictor.predict_labels 相同的接口, 前向推理通过批处理队列完成
+        """
+        predictor = self.predictor
+        if predictor.should_tile(img, scale_factor, tiling):
+            # 大图分块推理自行批量处理分块, 不进入批处理队列
+            return predictor.predict_labels(img, scale_factor, out_threshold, tiling, with_confidence)
+        img_data = predictor.preprocess(img, scale_factor)
+        output = self.submit(img_data).result()
+        return predictor.postprocess(output, predictor.source_size(img), out_threshold,
+                                     with_confidence=with_confidence)
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name=f'unet-batcher-{self.model_name}', daemon=True
+                )
+                self._thread.start()
+
+    def _collect(self):
+        """
+        阻塞等待第一张图片, 然后在 max_wait 时间窗口内继续收集, 直到达到 max_batch_size
+        """
+        try:
+            first = self._queue.get(timeout=self.idle_timeout)
+        except queue.Empty:
+            return None
+        items = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(items) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        QUEUE_DEPTH.dec(len(items), model=self.model_name)
+        return items
+
+    def _run(self):
+        while True:
+            items = self._collect()
+            if items is None:
+                with self._lock:
+                    # 退出前再确认一次, 避免与 submit 竞争时丢失刚入队的图片
+                    if self._queue.empty():
+                        self._thread = None
+                        return
+                continue
+
+            # 按张量尺寸分组, 每组做一次前向推理
+            groups = OrderedDict()
+            for item in items:
+                groups.setdefault(tuple(item.tensor.shape), []).append(item)
+            for group in groups.values():
+                self._run_group(group)
+
+    def _run_group(self, group):
+        started = time.monotonic()
+        for item in group:
+            BATCH_WAIT.observe(started - item.enqueued_at, model=self.model_name)
+        BATCH_SIZE.observe(len(group), model=self.model_name)
+        BATCHES.inc(model=self.model_name)
+        import torch
+
+        try:
+            output = self.predictor.forward(torch.stack([item.tensor for item in group]))
+        except Exception as e:
+            logger.error(f"Batched UNet forward failed ({len(group)} images): {str(e)}")
+            for item in group:
+                item.future.set_exception(e)
+            return
+        for i, item in enumerate(group):
+            item.future.set_result(output[i:i + 1])
+
+
+_batchers_lock = threading.Lock()
+
+
+def batching_enabled():
+    return getattr(settings, 'UNET_BATCH_ENABLED', True)
+
+
+def get_batcher(predictor):
+    """
+    获取预测器对应的批处理队列, 每个预测器实例一个
+    """
+    batcher = getattr(predictor, '_batcher', None)
+    if batcher is None:
+        with _batchers_lock:
+            batcher = getattr(predictor, '_batcher', None)
+            if batcher is None:
+                batcher = MicroBatcher(
+                    predictor,
+                    max_batch_size=getattr(settings, 'UNET_BATCH_MAX_SIZE', 8),
+                    max_wait_ms=getattr(settings, 'UNET_BATCH_MAX_WAIT_MS', 10),
+                )
+                predictor._batcher = batcher
+    return batcher
+
+
+def get_runner(predictor):
+    """
+    开启批处理时返回预测器的批处理队列, 否则返回预测器本身, 两者接口一致
+    推理进程池的客户端直接返回, 合批在推理进程内完成
+    """
+    if getattr(predictor, 'remote', False):
+        return predictor
+    return get_batcher(predictor) if batching_enabled() else predictor
+
+
+def inference_concurrency():
+    """
+    批量预测时同时提交推理的图片数, 开启批处理时与最大批大小一致
+    """
+    if batching_enabled():
+        return max(1, getattr(settings, 'UNET_BATCH_MAX_SIZE', 8))
+    return 1
@@ -0,0 +1,114 @@
+"""
+可内存映射的扁平checkpoint格式
+
+torch.load 每次都要反序列化整个pickle并为每个参数分配新的张量. 扁平格式把权重按顺序
+写入一个文件, mask_values 和网络结构(n_channels, n_classes, bilinear)写在文件头中:
+
+    b'UNETFLAT' | 文件头长度(uint64, 小端) | 文件头JSON | 按64字节对齐的张量数据
+
+加载时以写时复制方式映射整个文件, 张量直接引用映射的内存, 不复制也不执行pickle,
+冷启动和切换模型只需毫秒级; 多个进程加载同一文件时共享操作系统的页缓存.
+由 manage.py export_unet --format flat 从训练得到的checkpoint转换.
+"""
+import json
+import mmap
+import os
+import struct
+
+MAGIC = b'UNETFLAT'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+FLAT_SUFFIX = '.flat'
+
+_HEADER_LENGTH = struct.Struct('<Q')
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def is_flat_checkpoint(path):
+    """
+    根据文件开头的魔数判断是否为扁平checkpoint
+    """
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def read_header(path):
+    """
+    读取文件头, 返回 (文件头字典, 张量数据的起始偏移)
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a flat UNet checkpoint')
+        (length,) = _HEADER_LENGTH.unpack(f.read(_HEADER_LENGTH.size))
+        header = json.loads(f.read(length).decode('utf-8'))
+    if header.get('version') != FORMAT_VERSION:
+        raise ValueError(f"Unsupported flat checkpoint version {header.get('version')} in {path}")
+    return header, _align(len(MAGIC) + _HEADER_LENGTH.size + length)
+
+
+def save_flat(path, state_dict, **metadata):
+    """
+    把state_dict写为扁平checkpoint, metadata 需要可以JSON序列化
+    """
+    import torch
+
+    tensors, offset = [], 0
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu().contiguous()
+        offset = _align(offset)
+        nbytes = tensor.numel() * tensor.element_size()
+        tensors.append((name, tensor, offset, nbytes))
+        offset += nbytes
+    header = json.dumps({
+        'version': FORMAT_VERSION,
+        'metadata': metadata,
+        'tensors': [
+            {'name': name, 'dtype': str(tensor.dtype).replace('torch.', ''), 'shape': list(tensor.shape),
+             'offset': offset, 'nbytes': nbytes}
+            for name, tensor, offset, nbytes in tensors
+        ],
+    }, ensure_ascii=False).encode('utf-8')
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_HEADER_LENGTH.pack(len(header)))
+        f.write(header)
+        data_start = _align(f.tell())
+        for name, tensor, offset, nbytes in tensors:
+            f.write(b'\0' * (data_start + offset - f.tell()))
+            if nbytes:
+                f.write(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_flat(path):
+    """
+    映射扁平checkpoint, 返回 (state_dict, 元数据), 张量共享映射的内存
+
+    映射为写时复制: 未修改的页在进程间共享页缓存, 修改张量不会写回文件.
+    """
+    import torch
+
+    header, data_start = read_header(path)
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    state_dict = {}
+    for entry in header['tensors']:
+        dtype = getattr(torch, entry['dtype'])
+        numel = 1
+        for dim in entry['shape']:
+            numel *= dim
+        if numel:
+            tensor = torch.frombuffer(buffer, dtype=dtype, count=numel, offset=data_start + entry['offset'])
+        else:
+            tensor = torch.empty(0, dtype=dtype)
+        state_dict[entry['name']] = tensor.reshape(entry['shape'])
+    return state_dict, header['metadata']
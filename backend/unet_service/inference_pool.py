@@ -0,0 +1,407 @@
+"""
+独立的UNet推理进程池
+
+web worker 不再加载模型和运行推理, 而是通过本地unix socket把图片交给推理进程池.
+推理服务主进程先加载模型并把权重放入共享内存, 再fork出各个推理进程, 所有推理进程共用一份权重.
+每个推理进程固定intra-op线程数, 可选绑定到互不重叠的CPU核, 推理吞吐不再随web worker数量抖动.
+
+启动: python manage.py run_inference_pool
+"""
+import io
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import AuthenticationError, Client, Listener
+
+from django.conf import settings
+from PIL import Image
+
+from .batching import get_runner, inference_concurrency
+from .metrics import REGISTRY, MetricsRegistry
+from .model_registry import get_registry
+
+logger = logging.getLogger(__name__)
+
+
+class InferencePoolError(RuntimeError):
+    """
+    推理进程池不可用或推理失败
+    """
+
+
+def pool_enabled():
+    return getattr(settings, 'UNET_INFERENCE_POOL_ENABLED', False)
+
+
+def pool_address():
+    return str(getattr(settings, 'UNET_INFERENCE_POOL_ADDRESS', None) or settings.BASE_DIR / 'unet_inference.sock')
+
+
+def pool_authkey():
+    authkey = getattr(settings, 'UNET_INFERENCE_POOL_AUTHKEY', None) or settings.SECRET_KEY
+    return authkey if isinstance(authkey, bytes) else authkey.encode()
+
+
+def pool_workers():
+    return max(1, getattr(settings, 'UNET_INFERENCE_WORKERS', 2))
+
+
+def pool_metrics_dir():
+    """
+    推理进程定期写入各自指标的目录
+    """
+    return str(getattr(settings, 'UNET_INFERENCE_METRICS_DIR', None) or f'{pool_address()}.metrics')
+
+
+def collect_metrics():
+    """
+    本进程的指标注册表; 开启推理进程池时合并各推理进程最近一次写入的指标, 以 inference_worker 标签区分
+    """
+    if not pool_enabled():
+        return REGISTRY
+    combined = MetricsRegistry()
+    combined.load(REGISTRY.dump())
+    directory = pool_metrics_dir()
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return combined
+    for name in names:
+        index, ext = os.path.splitext(name)
+        if ext != '.json':
+            continue
+        try:
+            with open(os.path.join(directory, name), 'r', encoding='utf-8') as f:
+                combined.load(json.load(f), inference_worker=index)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read metrics of inference worker {index}: {str(e)}")
+    return combined
+
+
+def pack_image(img):
+    """
+    把PIL图片转换为可以通过socket发送的原始像素
+    """
+    palette = img.getpalette() if img.mode == 'P' else None
+    return img.mode, img.size, img.tobytes(), palette, img.info.get('source_size')
+
+
+def unpack_image(packed):
+    mode, size, data, palette, source_size = packed
+    img = Image.frombytes(mode, size, data)
+    if palette is not None:
+        img.putpalette(palette)
+    if source_size is not None:
+        # 按缩小尺寸解码的JPEG, 推理结果仍按原图尺寸输出
+        img.info['source_size'] = source_size
+    return img
+
+
+def pool_call(message, address=None, authkey=None, timeout=None):
+    """
+    向推理进程池发送一个请求并返回结果, 每个请求使用一个新连接, 由空闲的推理进程接受
+    """
+    address = address or pool_address()
+    timeout = timeout or getattr(settings, 'UNET_INFERENCE_POOL_TIMEOUT', 300)
+    try:
+        conn = Client(address, authkey=authkey or pool_authkey())
+    except (OSError, AuthenticationError) as e:
+        raise InferencePoolError(f'推理进程池不可用({address}): {str(e)}') from e
+    with conn:
+        conn.send(message)
+        if not conn.poll(timeout):
+            raise InferencePoolError(f'推理超时({timeout}秒)')
+        try:
+            status, result = conn.recv()
+        except EOFError as e:
+            raise InferencePoolError('推理进程异常退出') from e
+    if status != 'ok':
+        raise InferencePoolError(result)
+    return result
+
+
+# (进程池地址, 模型名称, 版本, checkpoint摘要) -> 推理进程中实际加载的模型信息
+_model_info = {}
+_model_info_lock = threading.Lock()
+
+
+class RemotePredictor:
+    """
+    推理进程池中某个模型的客户端, 接口与 UNetPredictor 的 predict/predict_image 一致
+
+    每次预测使用一个新连接, 由空闲的推理进程接受, 实现进程间的负载均衡.
+    类别数、mask_values 和实际使用的推理精度以推理进程加载的模型为准(扁平checkpoint文件头、
+    导出模型的元数据、精度检查未通过时回退为fp32), 第一次使用某个模型时向进程池查询并缓存.
+    """
+    remote = True
+
+    def __init__(self, spec, address=None, authkey=None, timeout=None):
+        self.name = spec.name
+        self.version = spec.version
+        self.checkpoint_digest = spec.digest
+        self.model_path = spec.path
+        self.mask_mode = getattr(settings, 'UNET_MASK_IMAGE_MODE', 'auto')
+        self.upsample = getattr(settings, 'UNET_UPSAMPLE_MODE', 'exact')
+        self.address = address or pool_address()
+        self.authkey = authkey or pool_authkey()
+        self.timeout = timeout or getattr(settings, 'UNET_INFERENCE_POOL_TIMEOUT', 300)
+        # 整个进程池同时处理的图片数
+        self.concurrency = pool_workers() * inference_concurrency()
+        info = self._describe()
+        self.n_classes = info['n_classes']
+        self.mask_values = info['mask_values']
+        self.precision = info['precision']
+
+    def _describe(self):
+        key = (self.address, self.name, self.version, self.checkpoint_digest)
+        with _model_info_lock:
+            info = _model_info.get(key)
+        if info is None:
+            info = self._call('describe', None, None, None, None)
+            with _model_info_lock:
+                _model_info[key] = info
+        return info
+
+    def predict(self, image_file, scale_factor=1, out_threshold=0.5, tiling=None):
+        if isinstance(image_file, (str, os.PathLike)):
+            with open(image_file, 'rb') as f:
+                data = f.read()
+        else:
+            data = image_file.read()
+        return unpack_image(self._call('predict', data, scale_factor, out_threshold, tiling))
+
+    def predict_image(self, img, scale_factor=1, out_threshold=0.5, tiling=None):
+        return unpack_image(self._call('predict_image', pack_image(img), scale_factor, out_threshold, tiling))
+
+    def predict_labels(self, img, scale_factor=1, out_threshold=0.5, tiling=None, with_confidence=False):
+        op = 'predict_scores' if with_confidence else 'predict_labels'
+        return self._call(op, pack_image(img), scale_factor, out_threshold, tiling)
+
+    def _call(self, op, payload, scale_factor, out_threshold, tiling):
+        return pool_call(
+            (op, self.name, self.version, payload, scale_factor, out_threshold, tiling),
+            self.address, self.authkey, self.timeout
+        )
+
+
+def get_predictor(name=None, version=None):
+    """
+    开启推理进程池时返回进程池客户端, 否则返回本进程注册表中加载的预测器
+
+    两种情况都会校验模型名称和版本, 未注册时抛出 UnknownModelError
+    """
+    registry = get_registry()
+    if pool_enabled():
+        return RemotePredictor(registry.resolve(name, version))
+    return registry.get(name=name, version=version)
+
+
+def describe_models():
+    """
+    已注册模型及加载状态; 开启推理进程池时为推理进程中的加载状态和实际使用的推理精度
+    """
+    if pool_enabled():
+        return pool_call(('models', None, None, None, None, None, None))
+    return get_registry().describe()
+
+
+class InferenceServer:
+    """
+    推理进程池服务端
+
+    Args:
+        workers: 推理进程数
+        threads: 每个推理进程的intra-op线程数, None 表示平均分配本机CPU
+        pin_cpus: 是否把每个推理进程绑定到互不重叠的CPU核
+        preload: 主进程预加载并共享权重的模型名称, None 表示 UNET_WARMUP_MODELS
+    """
+
+    def __init__(self, registry=None, workers=2, threads=None, pin_cpus=False, address=None, authkey=None,
+                 preload=None):
+        self.registry = registry or get_registry()
+        self.workers = max(1, workers)
+        cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+        self.threads = max(1, threads or cpus // self.workers)
+        self.pin_cpus = pin_cpus
+        self.address = address or pool_address()
+        self.authkey = authkey or pool_authkey()
+        self.preload = preload
+        self._stopping = False
+
+    @classmethod
+    def from_settings(cls, **kwargs):
+        kwargs.setdefault('workers', pool_workers())
+        kwargs.setdefault('threads', getattr(settings, 'UNET_INFERENCE_THREADS', None))
+        kwargs.setdefault('pin_cpus', getattr(settings, 'UNET_INFERENCE_PIN_CPUS', False))
+        kwargs.setdefault('preload', getattr(settings, 'UNET_WARMUP_MODELS', None))
+        return cls(**kwargs)
+
+    def serve_forever(self):
+        import torch
+
+        # 主进程不做并行计算, 避免fork后子进程继承已经启动的OpenMP线程池
+        torch.set_num_threads(1)
+        if torch.cuda.is_available():
+            # CUDA上下文不能跨fork共享, 由各推理进程各自加载模型
+            logger.info("CUDA is available, UNet models are loaded by each inference process")
+        else:
+            self._share_weights()
+
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        self._clear_metrics()
+        listener = Listener(self.address, authkey=self.authkey, backlog=128)
+        context = multiprocessing.get_context('fork')
+        processes = {}
+
+        def stop(signum, frame):
+            self._stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        logger.info(f"UNet inference pool listening on {self.address}: "
+                    f"{self.workers} workers x {self.threads} threads")
+        try:
+            while not self._stopping:
+                # 启动或重启退出的推理进程, 新进程同样从主进程fork, 继续共享权重
+                for index in range(self.workers):
+                    process = processes.get(index)
+                    if process is not None and process.is_alive():
+                        continue
+                    if process is not None:
+                        logger.warning(f"UNet inference worker {index} exited with {process.exitcode}, restarting")
+                    process = context.Process(
+                        target=self._worker_main, args=(index, listener), name=f'unet-inference-{index}', daemon=True
+                    )
+                    process.start()
+                    processes[index] = process
+                time.sleep(1)
+        finally:
+            for process in processes.values():
+                process.terminate()
+            for process in processes.values():
+                process.join(5)
+            listener.close()
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            self._clear_metrics()
+            logger.info("UNet inference pool stopped")
+
+    def _clear_metrics(self):
+        directory = pool_metrics_dir()
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            os.unlink(os.path.join(directory, name))
+
+    def _publish_metrics(self, index, interval):
+        """
+        定期把本推理进程的指标写入 pool_metrics_dir, 由web进程的 /metrics 合并输出
+        """
+        path = os.path.join(pool_metrics_dir(), f'{index}.json')
+        tmp_path = f'{path}.tmp'
+        while True:
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(REGISTRY.dump(), f, default=str)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning(f"Failed to write metrics of inference worker {index}: {str(e)}")
+            time.sleep(interval)
+
+    def _share_weights(self):
+        for name in self.preload or [self.registry.default_name]:
+            try:
+                predictor = self.registry.get(name)
+            except Exception as e:
+                logger.error(f"Failed to preload UNet model '{name}': {str(e)}")
+                continue
+            try:
+                predictor.backend.share_memory()
+            except RuntimeError as e:
+                # /dev/shm 空间不足时仍可依靠fork的写时复制共享权重
+                logger.warning(f"Failed to move UNet model '{name}' to shared memory: {str(e)}")
+            logger.info(f"Preloaded UNet model '{name}' ({predictor.memory_bytes() / 1024 / 1024:.1f}MB)")
+
+    def _configure_threads(self, index):
+        import torch
+
+        torch.set_num_threads(self.threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass
+        if self.pin_cpus and hasattr(os, 'sched_setaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+            start = index * self.threads % len(cpus)
+            pinned = cpus[start:start + self.threads] or cpus
+            os.sched_setaffinity(0, pinned)
+            logger.info(f"UNet inference worker {index} pinned to CPUs {pinned}")
+
+    def _worker_main(self, index, listener):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self._configure_threads(index)
+        threading.Thread(
+            target=self._publish_metrics, args=(index, getattr(settings, 'UNET_INFERENCE_METRICS_INTERVAL', 5)),
+            name=f'unet-inference-{index}-metrics', daemon=True
+        ).start()
+
+        # 开启批处理时每个推理进程同时处理最多一个批次的图片, 它们在进程内合批推理
+        concurrency = inference_concurrency()
+        slots = threading.Semaphore(concurrency)
+        executor = ThreadPoolExecutor(concurrency, thread_name_prefix=f'unet-inference-{index}')
+        while True:
+            # 只在有空闲处理线程时接受连接, 其余连接留给其他推理进程
+            slots.acquire()
+            try:
+                conn = listener.accept()
+            except AuthenticationError as e:
+                logger.warning(f"Rejected inference connection: {str(e)}")
+                slots.release()
+                continue
+            except OSError:
+                slots.release()
+                break
+            executor.submit(self._handle, conn, slots)
+
+    def _handle(self, conn, slots):
+        try:
+            with conn:
+                try:
+                    op, name, version, payload, scale_factor, out_threshold, tiling = conn.recv()
+                except EOFError:
+                    return
+                try:
+                    if op == 'models':
+                        conn.send(('ok', self.registry.describe()))
+                        return
+                    predictor = self.registry.get(name=name, version=version)
+                    if op == 'describe':
+                        conn.send(('ok', {
+                            'n_classes': predictor.n_classes,
+                            'mask_values': predictor.mask_values,
+                            'precision': predictor.precision,
+                        }))
+                        return
+                    runner = get_runner(predictor)
+                    if op == 'predict':
+                        result = pack_image(runner.predict(io.BytesIO(payload), scale_factor, out_threshold, tiling))
+                    elif op in ('predict_labels', 'predict_scores'):
+                        result = runner.predict_labels(unpack_image(payload), scale_factor, out_threshold, tiling,
+                                                       with_confidence=op == 'predict_scores')
+                    else:
+                        img = unpack_image(payload)
+                        result = pack_image(runner.predict_image(img, scale_factor, out_threshold, tiling))
+                    conn.send(('ok', result))
+                except Exception as e:
+                    logger.error(f"Inference of model '{name}' failed: {str(e)}")
+                    conn.send(('error', f'{type(e).__name__}: {str(e)}'))
+        except OSError as e:
+            logger.warning(f"Inference connection closed unexpectedly: {str(e)}")
+        finally:
+            slots.release()
@@ -0,0 +1,150 @@
+import io
+import json
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+
+from unet_service.management.commands.benchmark_unet import parse_list, parse_resolution, synthetic_image
+from unet_service.pytorch_unet import add_pytorch_unet_path
+from unet_service.unet_predictor import UNetPredictor
+
+add_pytorch_unet_path()
+from utils.data_loading import BasicDataset, collate_samples  # noqa: E402
+
+
+def legacy_preprocess(img, scale):
+    """
+    原来的预处理: uint8 除以255得到float64数组
+    """
+    img = BasicDataset.resize(img, scale, is_mask=False)
+    img = img[np.newaxis, ...] if img.ndim == 2 else img.transpose((2, 0, 1))
+    if (img > 1).any():
+        img = img / 255.0
+    return img
+
+
+def legacy_training_sample(img, scale):
+    # 原来的 BasicDataset.__getitem__: 复制float64数组后再转换为float32
+    return torch.as_tensor(legacy_preprocess(img, scale).copy()).float().contiguous()
+
+
+def legacy_predictor_sample(img, scale):
+    # 原来的 UNetPredictor.preprocess
+    return torch.from_numpy(legacy_preprocess(img, scale)).float()
+
+
+def training_sample(img, scale):
+    return torch.from_numpy(BasicDataset.preprocess(None, img, scale, is_mask=False))
+
+
+def uint8_batch(imgs, scale):
+    """
+    defer_normalize 的训练路径: 样本保持uint8, collate_samples 按批转换为float32
+    """
+    samples = []
+    for img in imgs:
+        pixels = BasicDataset.to_chw(BasicDataset.resize(img, scale, is_mask=False))
+        samples.append({
+            'image': torch.from_numpy(pixels),
+            'mask': torch.zeros(1, dtype=torch.uint8),
+            'normalize': BasicDataset.needs_normalize(pixels),
+        })
+    return collate_samples(samples)
+
+
+def numpy_peak_bytes(fn):
+    """
+    执行期间numpy(Python堆)分配的峰值字节数, 不含调用前已有的内存
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    del result
+    return max(peak - before, 0)
+
+
+def torch_alloc_bytes(fn):
+    """
+    执行期间torch CPU分配器分配的总字节数
+    """
+    from torch.profiler import ProfilerActivity, profile
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    return sum(max(event.self_cpu_memory_usage, 0) for event in prof.key_averages())
+
+
+class Command(BaseCommand):
+    """
+    预处理微基准: python manage.py benchmark_preprocess --resolutions 512x512,1024x768 --scale 0.5
+
+    对已解码的合成图片分别计时训练路径(原来的float64路径、float32路径、保持uint8到按批转换的路径)
+    和 UNetPredictor 的预处理(原来的float64路径、当前路径), 输出每个样本的耗时、numpy分配峰值
+    (tracemalloc)和torch CPU分配总量(torch.profiler). 不包括解码, 分配统计与计时分开执行.
+    """
+    help = '训练和推理预处理的每样本耗时和内存分配'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resolutions', default='512x512,1024x768,2048x1536', help='图片分辨率列表')
+        parser.add_argument('--scale', type=float, default=0.5, help='缩放比例')
+        parser.add_argument('--batch-size', type=int, default=4, help='uint8路径按批转换时的批大小')
+        parser.add_argument('--iterations', type=int, default=20, help='每条路径的计时次数')
+        parser.add_argument('--json', action='store_true', default=False, help='以JSON输出')
+
+    def handle(self, *args, **options):
+        try:
+            resolutions = parse_list(options['resolutions'], parse_resolution)
+        except ValueError as e:
+            raise CommandError(f'参数格式错误: {e}')
+        scale, batch_size = options['scale'], max(1, options['batch_size'])
+        if not 0 < scale <= 1:
+            raise CommandError('--scale 必须在 (0, 1] 之间')
+
+        results = []
+        for width, height in resolutions:
+            img = Image.open(io.BytesIO(synthetic_image(width, height, seed=0)))
+            img.load()
+            imgs = [img] * batch_size
+            # (路径, 可调用对象, 一次调用处理的样本数)
+            paths = [
+                ('train_legacy', lambda: legacy_training_sample(img, scale), 1),
+                ('train_float32', lambda: training_sample(img, scale), 1),
+                ('train_uint8_collate', lambda: uint8_batch(imgs, scale), batch_size),
+                ('predictor_legacy', lambda: legacy_predictor_sample(img, scale), 1),
+                ('predictor', lambda: UNetPredictor.preprocess(img, scale), 1),
+            ]
+            for name, fn, samples in paths:
+                fn()
+                timings = []
+                for _ in range(options['iterations']):
+                    started = time.perf_counter()
+                    fn()
+                    timings.append(time.perf_counter() - started)
+                timings = np.asarray(timings) * 1000 / samples
+                results.append({
+                    'path': name,
+                    'resolution': f'{width}x{height}',
+                    'scale_factor': scale,
+                    'mean_ms': round(float(timings.mean()), 3),
+                    'p50_ms': round(float(np.percentile(timings, 50)), 3),
+                    'numpy_peak_mb': round(numpy_peak_bytes(fn) / samples / 2 ** 20, 2),
+                    'torch_alloc_mb': round(torch_alloc_bytes(fn) / samples / 2 ** 20, 2),
+                })
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, ensure_ascii=False, indent=2))
+            return
+        self.stdout.write(f"{'路径':<22}{'分辨率':>12}{'mean ms':>10}{'p50 ms':>10}{'numpy MB':>10}{'torch MB':>10}")
+        for row in results:
+            self.stdout.write(
+                f"{row['path']:<22}{row['resolution']:>12}{row['mean_ms']:>10.2f}{row['p50_ms']:>10.2f}"
+                f"{row['numpy_peak_mb']:>10.2f}{row['torch_alloc_mb']:>10.2f}"
+            )
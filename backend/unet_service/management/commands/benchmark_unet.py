@@ -0,0 +1,332 @@
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from PIL import Image, ImageDraw
+
+from unet_service.backends import BACKENDS
+from unet_service.management.commands.export_unet import EXPORT_SUFFIXES
+from unet_service.metrics import STAGE_SECONDS
+from unet_service.model_registry import UnknownModelError, get_registry
+from unet_service.pipeline import decode_image, encode_png
+from unet_service.unet_predictor import UNetPredictor
+
+# 结果中用于与基准结果对应的字段
+RESULT_KEY = ('path', 'backend', 'resolution', 'scale_factor', 'batch_size', 'threads')
+
+
+def parse_list(value, cast):
+    return [cast(item) for item in value.split(',') if item.strip()]
+
+
+def parse_resolution(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def synthetic_image(width, height, seed, image_format='JPEG'):
+    """
+    生成带有若干椭圆和矩形"元件"的合成图片, 相同参数生成的图片相同
+    """
+    rng = np.random.default_rng(seed)
+    background = rng.normal(96, 12, (height, width, 3)) + np.linspace(0, 48, width)[None, :, None]
+    img = Image.fromarray(np.clip(background, 0, 255).astype(np.uint8))
+    draw = ImageDraw.Draw(img)
+    for _ in range(max(4, width * height // 40000)):
+        w, h = rng.integers(8, max(9, width // 6)), rng.integers(8, max(9, height // 6))
+        x, y = rng.integers(0, width - w), rng.integers(0, height - h)
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        shape = draw.ellipse if rng.random() < 0.5 else draw.rectangle
+        shape((int(x), int(y), int(x + w), int(y + h)), fill=color, outline=(0, 0, 0))
+    buffer = io.BytesIO()
+    img.save(buffer, format=image_format, quality=90)
+    return buffer.getvalue()
+
+
+class PeakRss:
+    """
+    在后台线程中采样进程RSS, 记录一段代码执行期间的峰值(字节)
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def current():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            # 非Linux系统只能取得进程生命周期内的峰值
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.current())
+
+    def __enter__(self):
+        self.peak = self.current()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def stage_seconds():
+    return {labels['stage']: value['sum'] for labels, value in STAGE_SECONDS.samples() if 'stage' in labels}
+
+
+def summarize(latencies, images, elapsed, peak_rss, stages_before):
+    """
+    汇总一组计时: 延迟百分位(毫秒)、吞吐量、峰值RSS以及每张图片各阶段的平均耗时(毫秒)
+    """
+    latencies = np.asarray(latencies) * 1000
+    stages = {
+        name: round((seconds - stages_before.get(name, 0.0)) * 1000 / images, 3)
+        for name, seconds in stage_seconds().items()
+        if seconds - stages_before.get(name, 0.0) > 0
+    }
+    return {
+        'iterations': int(latencies.size),
+        'images': images,
+        'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+        'p95_ms': round(float(np.percentile(latencies, 95)), 3),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+        'mean_ms': round(float(latencies.mean()), 3),
+        'images_per_sec': round(images / elapsed, 3) if elapsed else None,
+        'peak_rss_mb': round(peak_rss / 2 ** 20, 1),
+        'stages_ms_per_image': stages,
+    }
+
+
+class Command(BaseCommand):
+    """
+    UNet推理基准测试: python manage.py benchmark_unet --output bench.json
+
+    生成多种分辨率的合成元件图片, 在不同批大小、线程数、缩放比例和推理后端下直接调用预测器
+    (解码→预处理→批量前向推理→后处理→渲染→PNG编码), 加上 --view 时还通过完整的DRF视图
+    POST /api/unet/predict/ 计时. 每组配置输出p50/p95/p99延迟、吞吐量、峰值RSS和各阶段耗时,
+    结果可写入JSON; 指定 --baseline 时与之前的结果比较, 超出 --max-regression 时命令失败.
+    """
+    help = 'UNet推理基准测试'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default=None, help='模型名称, 默认使用默认模型')
+        parser.add_argument('--resolutions', default='256x256,512x512,1024x768', help='图片分辨率列表')
+        parser.add_argument('--scales', default='1.0,0.5', help='缩放比例列表')
+        parser.add_argument('--batch-sizes', default='1,4', help='批大小列表')
+        parser.add_argument('--threads', default=str(torch.get_num_threads()), help='intra-op线程数列表')
+        parser.add_argument('--backends', default='eager', help=f'推理后端列表, 可选 {",".join(BACKENDS)}')
+        parser.add_argument('--format', choices=['jpeg', 'png'], default='jpeg', help='合成图片格式')
+        parser.add_argument('--iterations', type=int, default=10, help='每组配置的计时次数')
+        parser.add_argument('--warmup', type=int, default=2, help='每组配置计时前的预热次数')
+        parser.add_argument('--threshold', type=float, default=0.5, help='单类别模型的阈值')
+        parser.add_argument('--seed', type=int, default=0, help='合成图片的随机种子')
+        parser.add_argument('--view', action='store_true', default=False, help='同时通过DRF视图计时')
+        parser.add_argument('--output', default=None, help='结果JSON路径')
+        parser.add_argument('--baseline', default=None, help='基准结果JSON路径')
+        parser.add_argument('--max-regression', type=float, default=0.1,
+                            help='相对基准p95延迟增加或吞吐量下降的最大比例')
+
+    def handle(self, *args, **options):
+        try:
+            spec = get_registry().resolve(options['model'])
+        except UnknownModelError as e:
+            raise CommandError(str(e))
+        resolutions = parse_list(options['resolutions'], parse_resolution)
+        scales = parse_list(options['scales'], float)
+        batch_sizes = parse_list(options['batch_sizes'], int)
+        thread_counts = parse_list(options['threads'], int)
+        backends = parse_list(options['backends'], str)
+        for backend in backends:
+            if backend not in BACKENDS:
+                raise CommandError(f'未知的推理后端: {backend}')
+
+        image_format = options['format'].upper()
+        images = {
+            (width, height): [
+                synthetic_image(width, height, options['seed'] + i, image_format) for i in range(max(batch_sizes))
+            ]
+            for width, height in resolutions
+        }
+
+        default_threads = torch.get_num_threads()
+        results = []
+        try:
+            for threads in thread_counts:
+                torch.set_num_threads(threads)
+                for backend in backends:
+                    predictor = self.load_predictor(spec, backend)
+                    if predictor is None:
+                        continue
+                    for (width, height), samples in images.items():
+                        for scale in scales:
+                            for batch_size in batch_sizes:
+                                row = self.bench_predictor(predictor, samples[:batch_size], scale, options)
+                                results.append(self.report({
+                                    'path': 'predictor', 'backend': backend, 'resolution': f'{width}x{height}',
+                                    'scale_factor': scale, 'batch_size': batch_size, 'threads': threads, **row,
+                                }))
+                if options['view']:
+                    results.extend(self.bench_view(spec, images, scales, threads, options))
+        finally:
+            torch.set_num_threads(default_threads)
+
+        if not results:
+            raise CommandError('没有可执行的基准测试配置')
+        data = {
+            'environment': {
+                'python': platform.python_version(),
+                'torch': torch.__version__,
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+            },
+            'model': spec.to_dict(),
+            'options': {
+                key: options[key] for key in (
+                    'resolutions', 'scales', 'batch_sizes', 'threads', 'backends', 'format',
+                    'iterations', 'warmup', 'threshold', 'seed', 'view',
+                )
+            },
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"结果已保存到 {options['output']}"))
+        if options['baseline']:
+            self.check_regressions(results, options['baseline'], options['max_regression'])
+
+    def load_predictor(self, spec, backend):
+        """
+        按推理后端加载预测器, 导出模型不存在时跳过该后端
+        """
+        if backend == spec.backend:
+            path = spec.path
+        elif backend == 'eager':
+            self.stderr.write(f'模型 {spec.name} 不是eager checkpoint, 跳过eager后端')
+            return None
+        else:
+            path = str(Path(spec.path).with_suffix(EXPORT_SUFFIXES[backend]))
+            if not os.path.exists(path):
+                self.stderr.write(f'{path} 不存在, 跳过{backend}后端(先执行 manage.py export_unet)')
+                return None
+        # ONNX Runtime在创建会话时确定线程数, 每种线程数单独加载
+        return UNetPredictor(path, n_classes=spec.n_classes, bilinear=spec.bilinear, backend=backend)
+
+    def bench_predictor(self, predictor, samples, scale, options):
+        """
+        一次迭代完整处理一批图片: 解码、预处理、批量前向推理、后处理、渲染和PNG编码
+        """
+        def run():
+            imgs = [decode_image(data, '', scale) for data in samples]
+            batch = torch.stack([predictor.preprocess(img, scale) for img in imgs])
+            output = predictor.forward(batch)
+            for i, img in enumerate(imgs):
+                mask = predictor.postprocess(output[i:i + 1], predictor.source_size(img), options['threshold'])
+                encode_png(predictor._mask_to_image(mask))
+
+        return self.measure(run, len(samples), options)
+
+    def bench_view(self, spec, images, scales, threads, options):
+        """
+        通过 UNetViewSet.predict 计时, 包含请求解析、准入控制、推理、PNG编码和结果保存
+        """
+        from rest_framework.test import APIRequestFactory
+
+        from unet_service.views import UNetViewSet
+
+        view = UNetViewSet.as_view({'post': 'predict'})
+        factory = APIRequestFactory()
+        predictor = get_registry().get(spec.name)
+        media_root = tempfile.mkdtemp(prefix='unet_benchmark_')
+        results = []
+        # 结果写入临时目录, 关闭结果缓存以免重复图片直接命中
+        try:
+            with override_settings(MEDIA_ROOT=media_root, UNET_RESULT_CACHE_ENABLED=False):
+                for (width, height), samples in images.items():
+                    for scale in scales:
+                        def run():
+                            request = factory.post('/api/unet/predict/', {
+                                'file': SimpleUploadedFile(f'bench.{options["format"]}', samples[0]),
+                                'scale_factor': scale,
+                                'threshold': options['threshold'],
+                                'model': spec.name,
+                            }, format='multipart')
+                            response = view(request)
+                            if response.status_code != 200:
+                                raise CommandError(f'预测接口返回 {response.status_code}: {response.data}')
+
+                        row = self.measure(run, 1, options)
+                        results.append(self.report({
+                            'path': 'view', 'backend': predictor.backend.name, 'resolution': f'{width}x{height}',
+                            'scale_factor': scale, 'batch_size': 1, 'threads': threads, **row,
+                        }))
+        finally:
+            shutil.rmtree(media_root, ignore_errors=True)
+        return results
+
+    @staticmethod
+    def measure(run, images_per_iteration, options):
+        for _ in range(options['warmup']):
+            run()
+        latencies = []
+        stages_before = stage_seconds()
+        with PeakRss() as rss:
+            started = time.perf_counter()
+            for _ in range(max(1, options['iterations'])):
+                iteration_started = time.perf_counter()
+                run()
+                latencies.append(time.perf_counter() - iteration_started)
+            elapsed = time.perf_counter() - started
+        return summarize(latencies, images_per_iteration * len(latencies), elapsed, rss.peak, stages_before)
+
+    def report(self, row):
+        self.stdout.write(
+            f"{row['path']} {row['backend']} {row['resolution']} scale {row['scale_factor']} "
+            f"batch {row['batch_size']} threads {row['threads']}: p50 {row['p50_ms']:.1f}ms "
+            f"p95 {row['p95_ms']:.1f}ms p99 {row['p99_ms']:.1f}ms {row['images_per_sec']:.2f} img/s "
+            f"峰值RSS {row['peak_rss_mb']:.0f}MB"
+        )
+        return row
+
+    def check_regressions(self, results, baseline_path, max_regression):
+        """
+        与基准结果中相同配置的p95延迟和吞吐量比较
+        """
+        with open(baseline_path, 'r', encoding='utf-8') as f:
+            baseline = {tuple(row[k] for k in RESULT_KEY): row for row in json.load(f)['results']}
+        regressions = []
+        for row in results:
+            base = baseline.get(tuple(row[k] for k in RESULT_KEY))
+            if base is None:
+                continue
+            label = ' '.join(str(row[k]) for k in RESULT_KEY)
+            if row['p95_ms'] > base['p95_ms'] * (1 + max_regression):
+                regressions.append(f"{label}: p95 {base['p95_ms']:.1f}ms -> {row['p95_ms']:.1f}ms")
+            if base['images_per_sec'] and row['images_per_sec'] < base['images_per_sec'] * (1 - max_regression):
+                regressions.append(
+                    f"{label}: 吞吐量 {base['images_per_sec']:.2f} -> {row['images_per_sec']:.2f} img/s"
+                )
+        if regressions:
+            raise CommandError('性能回退:\n' + '\n'.join(regressions))
+        self.stdout.write(self.style.SUCCESS(f'与基准 {baseline_path} 相比没有超过 {max_regression:.0%} 的性能回退'))
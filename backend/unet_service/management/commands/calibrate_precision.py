@@ -0,0 +1,150 @@
+import os
+import time
+import zipfile
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from data_manager.models import DatasetManagerModel
+from unet_service.backends import EagerBackend
+from unet_service.model_registry import UnknownModelError, get_registry
+from unet_service.pipeline import InvalidImageError, decode_image, iter_image_members
+from unet_service.precision import (
+    Int8Backend, PrecisionError, build_backend, mask_scores, precision_artifact_path, quantize_int8,
+    save_calibration,
+)
+from unet_service.unet_predictor import UNetPredictor
+
+
+def load_dataset_images(source, limit):
+    """
+    按压缩包内顺序读取最多 limit 张有效图片
+    """
+    images = []
+    with zipfile.ZipFile(source, 'r') as zip_ref:
+        for info in iter_image_members(zip_ref):
+            try:
+                images.append((info.filename, decode_image(zip_ref.read(info), info.filename)))
+            except InvalidImageError:
+                continue
+            if len(images) >= limit:
+                break
+    return images
+
+
+class Command(BaseCommand):
+    """
+    校准低精度推理模式: python manage.py calibrate_precision --precision int8 --dataset <数据集id>
+
+    数据集压缩包中前 --calibration 张图片用于统计int8激活范围, 之后的 --holdout 张图片作为留出集,
+    以fp32预测结果为基准计算低精度预测的Dice/IoU. 平均Dice和IoU都不低于阈值时保存校准记录,
+    在 UNET_MODELS 中配置 "precision" 后加载模型时才会启用; 否则删除旧的校准记录并拒绝启用.
+    """
+    help = '在数据集上校准int8/bf16推理并与fp32比较精度'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--precision', choices=['int8', 'bf16'], required=True, help='推理精度')
+        parser.add_argument('--model', default=None, help='模型名称, 默认使用默认模型')
+        parser.add_argument('--dataset', type=int, default=None, help='数据集id')
+        parser.add_argument('--source', default=None, help='图片压缩包路径, 与 --dataset 二选一')
+        parser.add_argument('--calibration', type=int, default=32, help='校准图片数')
+        parser.add_argument('--holdout', type=int, default=32, help='留出集图片数')
+        parser.add_argument('--scale', type=float, default=0.5, help='缩放比例')
+        parser.add_argument('--threshold', type=float, default=0.5, help='单类别模型的阈值')
+        parser.add_argument('--min-dice', type=float, default=0.98, help='平均Dice下限')
+        parser.add_argument('--min-iou', type=float, default=0.96, help='平均IoU下限')
+
+    def get_source(self, options):
+        if options['source']:
+            return options['source']
+        if options['dataset'] is None:
+            raise CommandError('需要提供 --dataset 或 --source')
+        dataset = DatasetManagerModel.objects.filter(id=options['dataset']).first()
+        if dataset is None or not dataset.data:
+            raise CommandError(f"数据集 {options['dataset']} 不存在或没有数据文件")
+        return os.path.join(settings.MEDIA_ROOT, dataset.data)
+
+    def handle(self, *args, **options):
+        precision = options['precision']
+        try:
+            spec = get_registry().resolve(options['model'])
+        except UnknownModelError as e:
+            raise CommandError(str(e))
+        if spec.backend != 'eager':
+            raise CommandError('低精度推理只支持eager后端的checkpoint')
+        # 使用独立加载的fp32预测器作为基准, 不影响注册表中的模型
+        predictor = UNetPredictor(spec.path, n_classes=spec.n_classes, bilinear=spec.bilinear)
+        reference = EagerBackend(predictor.net, predictor.device)
+        scale, threshold = options['scale'], options['threshold']
+
+        images = load_dataset_images(self.get_source(options), options['calibration'] + options['holdout'])
+        calibration = images[:options['calibration']] if precision == 'int8' else []
+        holdout = images[len(calibration):]
+        if not holdout:
+            raise CommandError('数据集中没有可用于留出集的图片')
+        tensors = {name: predictor.preprocess(img, scale) for name, img in images}
+
+        started = time.perf_counter()
+        try:
+            if precision == 'int8':
+                if not calibration:
+                    raise CommandError('int8 需要至少一张校准图片')
+                backend = Int8Backend(quantize_int8(predictor.net, [tensors[name] for name, _ in calibration]))
+            else:
+                backend = build_backend(predictor.net, 'bf16', device=predictor.device)
+        except PrecisionError as e:
+            raise CommandError(str(e))
+        self.stdout.write(f'{precision} 校准完成: {len(calibration)} 张图片, {time.perf_counter() - started:.1f}s')
+
+        dices, ious, fp32_time, reduced_time = [], [], 0.0, 0.0
+        for name, img in holdout:
+            batch = tensors[name].unsqueeze(0)
+            started = time.perf_counter()
+            expected = reference(batch)
+            fp32_time += time.perf_counter() - started
+            started = time.perf_counter()
+            actual = backend(batch)
+            reduced_time += time.perf_counter() - started
+
+            dice, iou = mask_scores(
+                predictor.postprocess(expected, img.size, threshold),
+                predictor.postprocess(actual, img.size, threshold),
+                predictor.n_classes,
+            )
+            dices.append(dice)
+            ious.append(iou)
+            self.stdout.write(f'  {name}: Dice {dice:.4f} IoU {iou:.4f}')
+
+        report = {
+            'calibration_images': len(calibration),
+            'holdout_images': len(holdout),
+            'scale_factor': scale,
+            'mean_dice': float(np.mean(dices)),
+            'min_dice': float(np.min(dices)),
+            'mean_iou': float(np.mean(ious)),
+            'min_iou': float(np.min(ious)),
+            'fp32_seconds': fp32_time,
+            'seconds': reduced_time,
+            'speedup': fp32_time / reduced_time if reduced_time else None,
+        }
+        report['passed'] = report['mean_dice'] >= options['min_dice'] and report['mean_iou'] >= options['min_iou']
+        self.stdout.write(
+            f"留出集 {len(holdout)} 张: 平均Dice {report['mean_dice']:.4f} (最低 {report['min_dice']:.4f}) "
+            f"平均IoU {report['mean_iou']:.4f} (最低 {report['min_iou']:.4f}) "
+            f"前向推理 fp32 {fp32_time:.2f}s {precision} {reduced_time:.2f}s"
+            + (f" (加速 {report['speedup']:.2f}x)" if report['speedup'] else '')
+        )
+
+        if not report['passed']:
+            stale = precision_artifact_path(spec.path, precision)
+            if os.path.exists(stale):
+                os.remove(stale)
+            raise CommandError(
+                f"{precision} 精度低于阈值(Dice>={options['min_dice']}, IoU>={options['min_iou']}), 拒绝启用"
+            )
+        path = save_calibration(spec.path, precision, spec.digest, report, backend)
+        self.stdout.write(self.style.SUCCESS(
+            f'{precision} 精度检查通过, 校准记录已保存到 {path}; '
+            f'在 UNET_MODELS 中为模型 {spec.name} 配置 "precision": "{precision}" 后生效'
+        ))
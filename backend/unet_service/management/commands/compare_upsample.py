@@ -0,0 +1,113 @@
+import time
+from pathlib import Path
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from unet_service.model_registry import UnknownModelError, get_registry
+from unet_service.pipeline import IMAGE_EXTENSIONS
+
+
+def iter_image_paths(paths):
+    for path in map(Path, paths):
+        if path.is_dir():
+            yield from sorted(p for p in path.rglob('*') if p.suffix.lower() in IMAGE_EXTENSIONS)
+        elif path.exists():
+            yield path
+        else:
+            raise CommandError(f'{path} 不存在')
+
+
+def timed(func, *args, repeat=1):
+    """
+    返回 (最后一次的结果, 最短耗时秒数)
+    """
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def class_iou(reference, candidate, n_classes):
+    """
+    以 reference 为基准逐类别计算IoU, 两者都不含的类别跳过
+    """
+    ious = {}
+    for c in range(max(n_classes, 2)):
+        ref, cand = reference == c, candidate == c
+        union = np.count_nonzero(ref | cand)
+        if union:
+            ious[c] = np.count_nonzero(ref & cand) / union
+    return ious
+
+
+class Command(BaseCommand):
+    """
+    比较 fast 与 exact 上采样的精度和耗时: python manage.py compare_upsample <图片或目录>...
+
+    两种方式使用同一次前向推理的输出, 以 exact 结果为基准统计像素一致率、各类别IoU、
+    后处理耗时以及上采样时在原图尺寸上分配的张量大小.
+    """
+    help = '比较 fast 与 exact 上采样的精度和耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='图片文件或目录')
+        parser.add_argument('--model', default=None, help='模型名称, 默认使用默认模型')
+        parser.add_argument('--model-version', default=None, help='模型版本')
+        parser.add_argument('--scale', type=float, default=0.5, help='缩放比例')
+        parser.add_argument('--threshold', type=float, default=0.5, help='单类别模型的阈值')
+        parser.add_argument('--repeat', type=int, default=3, help='每种方式重复计时的次数, 取最短耗时')
+        parser.add_argument('--limit', type=int, default=0, help='最多比较的图片数, 0 表示不限制')
+
+    def handle(self, *args, **options):
+        try:
+            predictor = get_registry().get(name=options['model'], version=options['model_version'])
+        except UnknownModelError as e:
+            raise CommandError(str(e))
+        n_classes = predictor.n_classes
+        scale, threshold, repeat = options['scale'], options['threshold'], max(1, options['repeat'])
+
+        rows = []
+        for i, path in enumerate(iter_image_paths(options['paths'])):
+            if options['limit'] and i >= options['limit']:
+                break
+            img = predictor.load_image(str(path))
+            output = predictor.forward(predictor.preprocess(img, scale).unsqueeze(0))
+            exact, exact_time = timed(predictor.postprocess, output, img.size, threshold, 'exact', repeat=repeat)
+            fast, fast_time = timed(predictor.postprocess, output, img.size, threshold, 'fast', repeat=repeat)
+
+            mismatched = int(np.count_nonzero(exact != fast))
+            ious = class_iou(exact, fast, n_classes)
+            rows.append({
+                'name': path.name,
+                'pixels': exact.size,
+                'mismatched': mismatched,
+                'miou': float(np.mean(list(ious.values()))) if ious else 1.0,
+                'exact_time': exact_time,
+                'fast_time': fast_time,
+            })
+            self.stdout.write(
+                f"{path.name}: {img.size[0]}x{img.size[1]} 不一致像素 {mismatched} "
+                f"({mismatched / exact.size:.4%}) mIoU {rows[-1]['miou']:.4f} "
+                f"exact {exact_time * 1000:.1f}ms fast {fast_time * 1000:.1f}ms"
+            )
+
+        if not rows:
+            raise CommandError('没有找到图片')
+
+        pixels = sum(row['pixels'] for row in rows)
+        mismatched = sum(row['mismatched'] for row in rows)
+        exact_time = sum(row['exact_time'] for row in rows)
+        fast_time = sum(row['fast_time'] for row in rows)
+        # 上采样时在原图尺寸上分配的float32张量: exact 为全部类别, fast 为单通道或uint8类别掩码
+        fast_bytes_per_pixel = 4 if n_classes <= 2 else 1
+        self.stdout.write(self.style.SUCCESS(
+            f"共 {len(rows)} 张图片, {n_classes} 个类别, 缩放比例 {scale}\n"
+            f"像素一致率 {1 - mismatched / pixels:.6f}, 最低mIoU {min(row['miou'] for row in rows):.4f}\n"
+            f"后处理总耗时 exact {exact_time * 1000:.1f}ms fast {fast_time * 1000:.1f}ms "
+            f"(加速 {exact_time / fast_time if fast_time else float('inf'):.2f}x)\n"
+            f"原图尺寸张量 exact {n_classes * 4} 字节/像素 fast {fast_bytes_per_pixel} 字节/像素"
+        ))
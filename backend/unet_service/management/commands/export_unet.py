@@ -0,0 +1,96 @@
+import os
+import time
+from pathlib import Path
+
+import torch
+from django.core.management.base import BaseCommand, CommandError
+
+from unet_service.backends import EagerBackend, export_onnx, export_torchscript, load_backend, save_metadata
+from unet_service.flat_checkpoint import FLAT_SUFFIX, save_flat
+from unet_service.model_registry import checkpoint_digest
+from unet_service.unet_predictor import UNetPredictor
+
+EXPORT_SUFFIXES = {'torchscript': '.pt', 'onnx': '.onnx', 'flat': FLAT_SUFFIX}
+
+
+class Command(BaseCommand):
+    """
+    把训练得到的checkpoint导出为TorchScript、ONNX模型和/或扁平checkpoint: python manage.py export_unet <checkpoint>
+
+    导出后默认与eager模型做一致性检查: 在多个随机尺寸的输入上比较logits最大误差和argmax类别一致率,
+    超出容差时命令失败. 导出的模型可在 UNET_MODELS 中以 {"path": ..., "backend": "onnx"} 方式注册;
+    扁平checkpoint(.flat)仍由eager后端执行, 以 {"path": "MODEL.flat"} 注册, 加载时直接映射权重.
+    """
+    help = '导出UNet模型为TorchScript/ONNX/扁平checkpoint并检查与eager模型的一致性'
+
+    def add_arguments(self, parser):
+        parser.add_argument('checkpoint', nargs='?', default=None, help='checkpoint路径, 默认使用默认模型路径')
+        parser.add_argument('--format', choices=[*EXPORT_SUFFIXES, 'all'], default='all', help='导出格式')
+        parser.add_argument('--output', default=None, help='输出目录, 默认与checkpoint相同')
+        parser.add_argument('--classes', type=int, default=2, help='类别数')
+        parser.add_argument('--bilinear', action='store_true', default=False, help='模型是否使用双线性上采样')
+        parser.add_argument('--opset', type=int, default=17, help='ONNX opset版本')
+        parser.add_argument('--skip-check', action='store_true', default=False, help='跳过一致性检查')
+        parser.add_argument('--atol', type=float, default=1e-3, help='logits允许的最大绝对误差')
+        parser.add_argument('--min-agreement', type=float, default=0.9999, help='argmax类别的最低一致率')
+
+    def handle(self, *args, **options):
+        checkpoint = options['checkpoint'] or UNetPredictor.default_model_path()
+        if not os.path.exists(checkpoint):
+            raise CommandError(f'checkpoint不存在: {checkpoint}')
+        device = torch.device('cpu')
+        net = UNetPredictor.load_checkpoint(checkpoint, options['classes'], options['bilinear'], device)
+
+        output_dir = Path(options['output'] or Path(checkpoint).parent)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        formats = list(EXPORT_SUFFIXES) if options['format'] == 'all' else [options['format']]
+        metadata = {
+            'mask_values': net.mask_values,
+            'n_classes': net.n_classes,
+            'bilinear': net.bilinear,
+            'checkpoint_digest': checkpoint_digest(checkpoint),
+        }
+
+        for fmt in formats:
+            path = str(output_dir / f'{Path(checkpoint).stem}{EXPORT_SUFFIXES[fmt]}')
+            started = time.perf_counter()
+            if fmt == 'flat':
+                save_flat(path, net.state_dict(), n_channels=net.n_channels, **metadata)
+            elif fmt == 'torchscript':
+                export_torchscript(net, path)
+            else:
+                export_onnx(net, path, opset_version=options['opset'])
+            if fmt != 'flat':
+                save_metadata(path, format=fmt, **metadata)
+            self.stdout.write(f'已导出 {fmt}: {path} ({time.perf_counter() - started:.1f}s)')
+            if not options['skip_check']:
+                self.check_parity(net, fmt, path, device, options['atol'], options['min_agreement'])
+
+    def check_parity(self, net, fmt, path, device, atol, min_agreement):
+        """
+        在不同批大小和奇数尺寸的随机输入上比较导出模型与eager模型的输出
+        """
+        if fmt == 'flat':
+            backend = EagerBackend(UNetPredictor.load_checkpoint(path, device=device), device)
+        else:
+            backend, _ = load_backend(fmt, path, device)
+        generator = torch.Generator().manual_seed(0)
+        for batch_size, height, width in ((1, 64, 64), (2, 97, 131), (1, 160, 120)):
+            batch = torch.rand(batch_size, net.n_channels, height, width, generator=generator)
+            with torch.no_grad():
+                expected = net(batch)
+            started = time.perf_counter()
+            actual = backend(batch)
+            elapsed = time.perf_counter() - started
+            max_error = (expected - actual).abs().max().item()
+            if net.n_classes > 1:
+                agreement = (expected.argmax(dim=1) == actual.argmax(dim=1)).float().mean().item()
+            else:
+                agreement = ((expected > 0) == (actual > 0)).float().mean().item()
+            self.stdout.write(
+                f'  {fmt} {batch_size}x{height}x{width}: 最大误差 {max_error:.2e} '
+                f'类别一致率 {agreement:.6f} 耗时 {elapsed * 1000:.1f}ms'
+            )
+            if max_error > atol or agreement < min_agreement:
+                raise CommandError(f'{fmt} 模型与eager模型输出不一致: 最大误差 {max_error:.2e}, 类别一致率 {agreement:.6f}')
+        self.stdout.write(self.style.SUCCESS(f'{fmt} 一致性检查通过'))
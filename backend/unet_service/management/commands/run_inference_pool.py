@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from unet_service.inference_pool import InferenceServer
+
+
+class Command(BaseCommand):
+    """
+    启动UNet推理进程池: python manage.py run_inference_pool
+
+    需要在 settings 中开启 UNET_INFERENCE_POOL_ENABLED, web worker 和 celery worker 才会把推理交给进程池
+    """
+    help = '启动UNet推理进程池'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help='推理进程数, 默认 UNET_INFERENCE_WORKERS')
+        parser.add_argument('--threads', type=int, default=None, help='每个推理进程的intra-op线程数')
+        parser.add_argument('--pin-cpus', action='store_true', default=None, help='把推理进程绑定到互不重叠的CPU核')
+        parser.add_argument('--address', default=None, help='unix socket路径, 默认 UNET_INFERENCE_POOL_ADDRESS')
+
+    def handle(self, *args, **options):
+        overrides = {
+            key: options[key] for key in ('workers', 'threads', 'pin_cpus', 'address') if options[key] is not None
+        }
+        InferenceServer.from_settings(**overrides).serve_forever()
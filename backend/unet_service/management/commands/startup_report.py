@@ -0,0 +1,116 @@
+import json
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# 在新的解释器中执行, 模块导入都是冷启动; 最后一行输出JSON结果
+PROBE = '''
+import importlib, json, resource, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+setup_seconds = time.perf_counter() - started
+for module in {modules!r}:
+    importlib.import_module(module)
+if {celery!r}:
+    from application.celery import app
+    app.loader.import_default_modules()
+print(json.dumps({{
+    'setup_seconds': setup_seconds,
+    'total_seconds': time.perf_counter() - started,
+    'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    'modules': sorted(sys.modules),
+}}))
+'''
+
+
+def parse_importtime(stderr):
+    """
+    解析 python -X importtime 的输出, 返回 {模块名: 自身导入耗时(微秒)}
+    """
+    self_us = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        try:
+            own, _, module = line[len('import time:'):].split('|')
+            self_us[module.strip()] = self_us.get(module.strip(), 0) + int(own)
+        except ValueError:
+            continue
+    return self_us
+
+
+class Command(BaseCommand):
+    """
+    启动耗时报告: python manage.py startup_report [--target web|celery|setup]
+
+    在新的Python进程中执行 django.setup() 并导入web worker(ROOT_URLCONF)或celery worker(任务模块)
+    启动时需要的模块, 按已安装的app和第三方包汇总导入耗时, 并报告进程峰值RSS. 指定 --forbid torch
+    时若启动过程导入了torch则命令失败, 可以用于检查web和celery worker没有加载推理栈.
+    """
+    help = '统计web/celery worker启动时各app和第三方包的导入耗时和内存'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', choices=['web', 'celery', 'setup'], default='web',
+                            help='web: 导入ROOT_URLCONF; celery: 导入celery任务模块; setup: 只执行django.setup()')
+        parser.add_argument('--top', type=int, default=15, help='显示导入耗时最多的第三方包数量')
+        parser.add_argument('--forbid', action='append', default=[], help='启动时不应导入的模块, 可重复指定')
+        parser.add_argument('--json', action='store_true', default=False, help='以JSON输出')
+
+    def handle(self, *args, **options):
+        modules = [settings.ROOT_URLCONF] if options['target'] == 'web' else []
+        probe = PROBE.format(modules=modules, celery=options['target'] == 'celery')
+        # 子进程继承 DJANGO_SETTINGS_MODULE
+        completed = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', probe],
+            cwd=settings.BASE_DIR, capture_output=True, text=True,
+        )
+        if completed.returncode != 0:
+            raise CommandError(f'启动失败:\n{completed.stderr[-4000:]}')
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        self_us = parse_importtime(completed.stderr)
+
+        # 按app汇总: 模块属于名称最长的匹配app, 其余按顶层包汇总
+        app_names = sorted((config.name for config in apps.get_app_configs()), key=len, reverse=True)
+        by_app, by_package = defaultdict(int), defaultdict(int)
+        for module, us in self_us.items():
+            owner = next((name for name in app_names if module == name or module.startswith(name + '.')), None)
+            if owner:
+                by_app[owner] += us
+            else:
+                by_package[module.split('.')[0]] += us
+
+        report = {
+            'target': options['target'],
+            'setup_seconds': round(result['setup_seconds'], 3),
+            'total_seconds': round(result['total_seconds'], 3),
+            'max_rss_mb': round(result['max_rss_bytes'] / 2 ** 20, 1),
+            'apps_ms': {name: round(us / 1000, 1) for name, us in sorted(by_app.items(), key=lambda i: -i[1])},
+            'packages_ms': {
+                name: round(us / 1000, 1)
+                for name, us in sorted(by_package.items(), key=lambda i: -i[1])[:options['top']]
+            },
+            'imported': {name: name in result['modules'] for name in ('torch', 'cv2', 'onnxruntime', 'unet')},
+        }
+        if options['json']:
+            self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+        else:
+            self.stdout.write(
+                f"{report['target']}: django.setup() {report['setup_seconds'] * 1000:.0f}ms, "
+                f"总计 {report['total_seconds'] * 1000:.0f}ms, 峰值RSS {report['max_rss_mb']:.0f}MB"
+            )
+            self.stdout.write('各app导入耗时(不含其导入的第三方包):')
+            for name, ms in report['apps_ms'].items():
+                self.stdout.write(f'  {name:<32} {ms:>8.1f}ms')
+            self.stdout.write('第三方包导入耗时:')
+            for name, ms in report['packages_ms'].items():
+                self.stdout.write(f'  {name:<32} {ms:>8.1f}ms')
+            self.stdout.write('已导入: ' + ', '.join(f'{k}={v}' for k, v in report['imported'].items()))
+
+        forbidden = [name for name in options['forbid'] if name in result['modules']]
+        if forbidden:
+            raise CommandError(f"{report['target']} 启动时导入了 {', '.join(forbidden)}")
@@ -0,0 +1,97 @@
+"""
+预测结果的紧凑输出格式
+
+除PNG外, 预测结果可以直接从类别掩码计算并内联在JSON中返回, 不写存储:
+    rle        每个前景类别一个COCO风格的未压缩RLE({"size": [h, w], "counts": [...]}, 按列优先, 从背景开始计数)
+    polygons   每个前景类别的连通域外轮廓, 经 Douglas-Peucker 简化, 需要安装 opencv-python-headless
+    bitpacked  每个前景类别按行优先逐位打包(高位在前)并base64编码的二值掩码
+"""
+import base64
+
+import numpy as np
+
+OUTPUT_FORMATS = ('png', 'rle', 'polygons', 'bitpacked')
+
+
+def require_opencv():
+    try:
+        import cv2
+    except ImportError as e:
+        raise ImportError(
+            "opencv is required for polygon output and component analysis: pip install opencv-python-headless"
+        ) from e
+    return cv2
+
+
+def check_output_format(output_format):
+    """
+    校验输出格式, 依赖缺失时抛出 ImportError
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'output_format must be one of {OUTPUT_FORMATS}, got {output_format!r}')
+    if output_format == 'polygons':
+        require_opencv()
+
+
+def rle_counts(mask):
+    """
+    二值掩码的COCO RLE计数: 按列优先展开, 第一段为背景
+    """
+    flat = np.asarray(mask, dtype=bool).ravel(order='F')
+    if not flat.size:
+        return []
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat[0]:
+        counts = np.concatenate(([0], counts))
+    return counts.tolist()
+
+
+def pack_bits(mask):
+    return base64.b64encode(np.packbits(np.asarray(mask, dtype=bool), axis=None).tobytes()).decode('ascii')
+
+
+def polygons(mask, tolerance=1.0):
+    """
+    每个连通域的外轮廓多边形, 不包含孔洞
+
+    Args:
+        tolerance: 简化时允许的最大偏差(像素), 0 表示不简化
+    """
+    cv2 = require_opencv()
+    contours, _ = cv2.findContours(
+        np.ascontiguousarray(mask, dtype=np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+    )
+    result = []
+    for contour in contours:
+        if tolerance > 0:
+            contour = cv2.approxPolyDP(contour, tolerance, True)
+        x, y, w, h = cv2.boundingRect(contour)
+        result.append({
+            'points': contour.reshape(-1, 2).tolist(),
+            'area': float(cv2.contourArea(contour)),
+            'bbox': [int(x), int(y), int(w), int(h)],
+        })
+    return result
+
+
+def encode_labels(labels, output_format, n_classes, tolerance=1.0):
+    """
+    把 (H, W) 类别掩码编码为可以直接放入JSON的紧凑格式, 每个前景类别一项
+    """
+    height, width = labels.shape[-2], labels.shape[-1]
+    classes = []
+    for c in range(1, max(n_classes, 2)):
+        mask = labels == c
+        entry = {'class': c}
+        if output_format == 'rle':
+            entry['rle'] = {'size': [height, width], 'counts': rle_counts(mask)}
+        elif output_format == 'bitpacked':
+            entry['bits'] = pack_bits(mask)
+        elif output_format == 'polygons':
+            entry['polygons'] = polygons(mask, tolerance)
+            entry['count'] = len(entry['polygons'])
+        else:
+            raise ValueError(f'{output_format} is not an inline output format')
+        classes.append(entry)
+    return {'format': output_format, 'size': [height, width], 'classes': classes}
@@ -0,0 +1,206 @@
+"""
+UNet预测服务的进程内指标
+
+提供计数器、仪表和直方图三种指标, 按标签分组统计, 线程安全.
+输出为Prometheus文本格式供抓取.
+其他进程(推理进程池)的指标可以通过 dump/load 加上进程标签后合并到同一个注册表中输出.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def samples(self):
+        """
+        [(标签字典, 值)]
+        """
+        with self._lock:
+            return [(dict(key), self._copy(value)) for key, value in self._values.items()]
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            state['counts'][bisect.bisect_left(self.buckets, value)] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    @staticmethod
+    def _copy(value):
+        return {'counts': list(value['counts']), 'sum': value['sum'], 'count': value['count']}
+
+
+class MetricsRegistry:
+    """
+    指标注册表, 同名指标只创建一次
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get_or_create(self, cls, name, documentation, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, **kwargs)
+            return metric
+
+    def counter(self, name, documentation=''):
+        return self._get_or_create(Counter, name, documentation)
+
+    def gauge(self, name, documentation=''):
+        return self._get_or_create(Gauge, name, documentation)
+
+    def histogram(self, name, documentation='', buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, buckets=buckets)
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def dump(self):
+        """
+        可以JSON序列化的原始指标值, 供其他进程 load
+        """
+        return [
+            {
+                'name': metric.name,
+                'type': metric.type,
+                'help': metric.documentation,
+                'buckets': list(getattr(metric, 'buckets', ())),
+                'samples': metric.samples(),
+            }
+            for metric in self.metrics()
+        ]
+
+    def load(self, dumped, **labels):
+        """
+        把 dump 的指标值加上 labels 后并入本注册表, 相同标签的样本被覆盖
+        """
+        for entry in dumped:
+            if entry['type'] == 'histogram':
+                metric = self.histogram(entry['name'], entry['help'], buckets=entry['buckets'])
+            else:
+                metric = getattr(self, entry['type'])(entry['name'], entry['help'])
+            with metric._lock:
+                for sample_labels, value in entry['samples']:
+                    metric._values[_label_key({**sample_labels, **labels})] = value
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in sorted(labels.items())
+    )
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_text(registry=None):
+    """
+    按Prometheus文本格式(0.0.4)输出所有指标, 直方图的桶为累计计数
+    """
+    lines = []
+    for metric in (registry or REGISTRY).metrics():
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for labels, value in metric.samples():
+            if metric.type != 'histogram':
+                lines.append(f'{metric.name}{_format_labels(labels)} {_format_value(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(list(metric.buckets) + ['+Inf'], value['counts']):
+                cumulative += count
+                le = bound if bound == '+Inf' else _format_value(float(bound))
+                lines.append(f'{metric.name}_bucket{_format_labels({**labels, "le": le})} {cumulative}')
+            lines.append(f'{metric.name}_sum{_format_labels(labels)} {_format_value(value["sum"])}')
+            lines.append(f'{metric.name}_count{_format_labels(labels)} {value["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'unet_stage_seconds', '预测各阶段耗时(秒)',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+STAGE_ERRORS = REGISTRY.counter('unet_stage_errors_total', '预测各阶段失败次数')
+
+
+@contextmanager
+def stage(name, **labels):
+    """
+    记录预测中一个阶段的耗时, 阶段抛出异常时同时计入失败次数
+
+    阶段: read 读取上传文件/压缩包成员, decode 图片解码, preprocess 缩放和归一化, forward 前向推理,
+    postprocess 插值和argmax, render 掩码渲染, encode PNG编码, save 保存结果文件
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=name, **labels)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=name, **labels)
@@ -0,0 +1,298 @@
+"""
+UNet模型注册表
+
+进程级单例: 每个checkpoint在进程内只加载一次, 多个命名模型同时常驻内存,
+超出内存预算时按LRU淘汰最久未使用的模型
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from django.conf import settings
+
+from .flat_checkpoint import is_flat_checkpoint, read_header
+from .pytorch_unet import default_model_path
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownModelError(LookupError):
+    """
+    请求的模型名称或版本未注册
+    """
+
+
+def checkpoint_digest(model_path, chunk_size=1024 * 1024):
+    """
+    计算checkpoint文件的sha256摘要, 用作模型版本标识
+    """
+    if is_flat_checkpoint(model_path):
+        # 扁平checkpoint沿用转换来源checkpoint的摘要, 不需要读取全部权重
+        digest = read_header(model_path)[0]['metadata'].get('checkpoint_digest')
+        if digest:
+            return digest
+    digest = hashlib.sha256()
+    with open(model_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ModelSpec:
+    """
+    注册表中一个命名模型的配置
+
+    backend 为 torchscript/onnx 时 path 指向导出的模型, n_classes 和 bilinear 以导出时的元数据为准;
+    path 为扁平checkpoint(.flat)时同样以文件头为准
+    precision 为 int8/bf16 时需要先通过 manage.py calibrate_precision 的精度检查, 否则以fp32运行
+    revalidate_interval 秒内不再检查checkpoint文件是否变化
+    """
+
+    def __init__(self, name, path, version=None, n_classes=2, bilinear=False, backend='eager', precision='fp32',
+                 revalidate_interval=2.0):
+        self.name = name
+        self.path = str(path)
+        self._version = version
+        self.n_classes = n_classes
+        self.bilinear = bilinear
+        self.backend = backend
+        self.precision = precision
+        self.revalidate_interval = revalidate_interval
+        self._digest = None
+        self._digest_stat = None
+        self._checked_at = None
+        self._digest_lock = threading.Lock()
+
+    @property
+    def digest(self):
+        """
+        checkpoint内容摘要, 文件大小或修改时间变化时重新计算
+
+        每 revalidate_interval 秒最多检查一次文件, 同时只有一个线程计算摘要
+        """
+        if self._digest is not None and time.monotonic() - self._checked_at < (self.revalidate_interval or 0):
+            return self._digest
+        with self._digest_lock:
+            stat = os.stat(self.path)
+            stat_key = (stat.st_size, stat.st_mtime_ns)
+            if self._digest is None or self._digest_stat != stat_key:
+                self._digest = checkpoint_digest(self.path)
+                self._digest_stat = stat_key
+            self._checked_at = time.monotonic()
+            return self._digest
+
+    @property
+    def version(self):
+        """
+        未显式配置版本时使用checkpoint摘要前12位
+        """
+        if self._version:
+            return str(self._version)
+        return self.digest[:12]
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'version': self.version if os.path.exists(self.path) else self._version,
+            'n_classes': self.n_classes,
+            'bilinear': self.bilinear,
+            'backend': self.backend,
+            'precision': self.precision,
+        }
+
+
+class ModelRegistry:
+    """
+    进程级UNet模型注册表
+    """
+
+    def __init__(self, specs=None, default_name='default', memory_budget_bytes=None, device=None):
+        self.default_name = default_name
+        self.memory_budget_bytes = memory_budget_bytes
+        self.device = device
+        self._specs = OrderedDict()
+        self._loaded = OrderedDict()
+        # (名称, 版本) -> 正在加载的Future, 同一模型的并发请求等待同一次加载
+        self._loading = {}
+        self._lock = threading.RLock()
+        for spec in specs or []:
+            self.register(spec)
+
+    @classmethod
+    def from_settings(cls):
+        """
+        根据settings中的UNET_*配置构建注册表
+        """
+        configured = getattr(settings, 'UNET_MODELS', None) or {}
+        default_name = getattr(settings, 'UNET_DEFAULT_MODEL', 'default')
+        specs = []
+        for name, options in configured.items():
+            if isinstance(options, (str, os.PathLike)):
+                options = {'path': options}
+            options = {'revalidate_interval': getattr(settings, 'UNET_MODEL_REVALIDATE_SECONDS', 2.0), **options}
+            specs.append(ModelSpec(name, **options))
+        if default_name not in configured:
+            specs.append(ModelSpec(
+                default_name, default_model_path(),
+                revalidate_interval=getattr(settings, 'UNET_MODEL_REVALIDATE_SECONDS', 2.0),
+            ))
+        budget_mb = getattr(settings, 'UNET_MODEL_MEMORY_BUDGET_MB', None)
+        return cls(
+            specs,
+            default_name=default_name,
+            memory_budget_bytes=budget_mb * 1024 * 1024 if budget_mb else None,
+        )
+
+    def register(self, spec):
+        with self._lock:
+            self._specs[spec.name] = spec
+            # 同名模型重新注册时丢弃旧实例
+            self._loaded.pop(spec.name, None)
+
+    def resolve(self, name=None, version=None):
+        """
+        根据名称和/或版本查找模型配置
+        """
+        if name:
+            spec = self._specs.get(name)
+            if spec is None:
+                raise UnknownModelError(f'未注册的模型: {name}')
+            if version and spec.version != str(version):
+                raise UnknownModelError(f'模型 {name} 不存在版本 {version}')
+            return spec
+        if version:
+            for spec in self._specs.values():
+                if spec.version == str(version):
+                    return spec
+            raise UnknownModelError(f'未找到版本为 {version} 的模型')
+        spec = self._specs.get(self.default_name)
+        if spec is None:
+            raise UnknownModelError(f'未注册默认模型: {self.default_name}')
+        return spec
+
+    def get(self, name=None, version=None):
+        """
+        获取已加载的预测器, 未加载时加载并按LRU淘汰
+
+        加载(读取checkpoint、计算摘要、移动到设备)在注册表锁之外进行, 只有请求同一模型同一版本的
+        调用者等待这次加载, 其他已加载模型的请求不受影响.
+        checkpoint文件变化后, 已加载的旧权重在新版本加载完成时被替换.
+        """
+        spec = self.resolve(name, version)
+        digest = spec.digest
+        key = (spec.name, digest)
+        with self._lock:
+            predictor = self._loaded.get(spec.name)
+            if predictor is not None and predictor.checkpoint_digest == digest:
+                self._loaded.move_to_end(spec.name)
+                return predictor
+            loading = self._loading.get(key)
+            owner = loading is None
+            if owner:
+                loading = self._loading[key] = Future()
+        if not owner:
+            return loading.result()
+
+        try:
+            predictor = self._load(spec, digest)
+        except BaseException as e:
+            with self._lock:
+                self._loading.pop(key, None)
+            loading.set_exception(e)
+            raise
+        with self._lock:
+            self._loading.pop(key, None)
+            # 加载期间同名模型被重新注册时不缓存旧版本
+            if self._specs.get(spec.name) is spec:
+                if self._loaded.pop(spec.name, None) is not None:
+                    logger.info(f"Replaced UNet model '{spec.name}' with version {predictor.version}")
+                self._loaded[spec.name] = predictor
+                self._evict(keep=spec.name)
+        loading.set_result(predictor)
+        return predictor
+
+    def _load(self, spec, digest):
+        # 推理栈(torch和UNet网络)在第一次加载模型时才导入
+        from .unet_predictor import UNetPredictor
+
+        logger.info(f"Loading UNet model '{spec.name}' from {spec.path}")
+        predictor = UNetPredictor(
+            model_path=spec.path,
+            device=self.device,
+            n_classes=spec.n_classes,
+            bilinear=spec.bilinear,
+            mask_mode=getattr(settings, 'UNET_MASK_IMAGE_MODE', 'auto'),
+            upsample=getattr(settings, 'UNET_UPSAMPLE_MODE', 'exact'),
+            backend=spec.backend,
+        )
+        predictor.name = spec.name
+        predictor.version = str(spec._version) if spec._version else digest[:12]
+        predictor.checkpoint_digest = digest
+        predictor.enable_precision(spec.precision, digest)
+        return predictor
+
+    def _evict(self, keep):
+        if not self.memory_budget_bytes:
+            return
+        while len(self._loaded) > 1 and self.memory_bytes() > self.memory_budget_bytes:
+            name = next(iter(self._loaded))
+            if name == keep:
+                self._loaded.move_to_end(name)
+                name = next(iter(self._loaded))
+            self._loaded.pop(name)
+            logger.info(f"Evicted UNet model '{name}' from registry (memory budget exceeded)")
+
+    def memory_bytes(self):
+        return sum(predictor.memory_bytes() for predictor in self._loaded.values())
+
+    def warmup(self, names=None):
+        """
+        预加载模型, 默认只加载默认模型
+        """
+        for name in names or [self.default_name]:
+            try:
+                self.get(name)
+            except Exception as e:
+                logger.error(f"Failed to warm up UNet model '{name}': {str(e)}")
+
+    def unload(self, name=None):
+        with self._lock:
+            if name is None:
+                self._loaded.clear()
+            else:
+                self._loaded.pop(name, None)
+
+    def describe(self):
+        """
+        已注册模型及加载状态, active_precision 为已加载模型实际使用的推理精度
+        """
+        with self._lock:
+            return [
+                {
+                    **spec.to_dict(),
+                    'loaded': spec.name in self._loaded,
+                    'active_precision': getattr(self._loaded.get(spec.name), 'precision', None),
+                    'default': spec.name == self.default_name,
+                }
+                for spec in self._specs.values()
+            ]
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """
+    获取进程级注册表单例
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ModelRegistry.from_settings()
+    return _registry
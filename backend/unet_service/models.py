@@ -1,3 +1,50 @@
 from django.db import models
 
-# Create your models here.
+from dvadmin.utils.models import CoreModel, table_prefix
+
+
+class PredictionJob(CoreModel):
+    """
+    异步批量预测任务
+    """
+    STATUS_CHOICES = [
+        (0, '任务已创建'),
+        (1, '任务进行中'),
+        (2, '任务完成'),
+        (3, '任务失败'),
+    ]
+    status = models.SmallIntegerField(default=0, choices=STATUS_CHOICES, verbose_name="任务状态", help_text="任务状态")
+    source = models.CharField(max_length=255, verbose_name="待预测文件路径", help_text="相对于media目录的ZIP或图片路径")
+    dataset = models.ForeignKey(to='data_manager.DatasetManagerModel', null=True, blank=True, on_delete=models.SET_NULL,
+                                db_constraint=False, verbose_name="数据集", help_text="数据集")
+    model_name = models.CharField(max_length=64, null=True, blank=True, verbose_name="模型名称", help_text="模型名称")
+    model_version = models.CharField(max_length=64, null=True, blank=True, verbose_name="模型版本", help_text="模型版本")
+    params = models.JSONField(default=dict, blank=True, verbose_name="预测参数", help_text="预测参数")
+    total = models.IntegerField(default=0, verbose_name="图片总数", help_text="图片总数")
+    processed = models.IntegerField(default=0, verbose_name="成功数", help_text="成功数")
+    failed = models.IntegerField(default=0, verbose_name="失败数", help_text="失败数")
+    message = models.CharField(max_length=255, null=True, blank=True, verbose_name="任务信息", help_text="任务信息")
+
+    class Meta:
+        db_table = table_prefix + "unet_prediction_job"
+        verbose_name = "预测任务"
+        verbose_name_plural = verbose_name
+        ordering = ("-create_datetime",)
+
+
+class PredictionJobResult(models.Model):
+    """
+    预测任务中单张图片的结果
+    """
+    job = models.ForeignKey(to=PredictionJob, related_name='results', on_delete=models.CASCADE,
+                            db_constraint=False, verbose_name="预测任务", help_text="预测任务")
+    index = models.IntegerField(verbose_name="序号", help_text="在压缩包内的顺序")
+    name = models.CharField(max_length=255, verbose_name="文件名", help_text="文件名")
+    result_path = models.CharField(max_length=255, null=True, blank=True, verbose_name="结果路径", help_text="结果路径")
+    error = models.CharField(max_length=255, null=True, blank=True, verbose_name="错误信息", help_text="错误信息")
+
+    class Meta:
+        db_table = table_prefix + "unet_prediction_job_result"
+        verbose_name = "预测任务结果"
+        verbose_name_plural = verbose_name
+        ordering = ("index",)
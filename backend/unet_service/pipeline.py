@@ -0,0 +1,285 @@
+"""
+ZIP批量预测流水线
+
+直接从压缩包中按成员读取图片, 不解压到磁盘. 解码校验、推理和PNG编码保存分别在
+独立的线程池中执行, 不同图片的各个阶段相互重叠; 同时在途的图片数量有上限,
+避免大压缩包占满内存. 读取成员时同时计算内容哈希, 内容相同的成员只预测一次,
+重复的成员直接复用第一次出现的结果.
+"""
+import hashlib
+import io
+import logging
+import os
+import zipfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.conf import settings
+from PIL import Image
+
+from .batching import get_runner, inference_concurrency
+from .mask_formats import encode_labels
+from .metrics import REGISTRY, stage
+from .pytorch_unet import add_pytorch_unet_path
+
+add_pytorch_unet_path()
+from utils.image_io import draft_image  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp'}
+IMAGE_FORMATS = {'JPEG', 'PNG', 'BMP'}
+READ_CHUNK_SIZE = 1024 * 1024
+
+PIPELINE_DUPLICATES = REGISTRY.counter('unet_pipeline_duplicate_images_total', '压缩包中复用结果的重复图片数')
+
+
+class InvalidImageError(ValueError):
+    """
+    压缩包成员不是有效的图片
+    """
+
+
+def iter_image_members(zip_ref):
+    """
+    压缩包内需要预测的图片成员, 跳过目录、__MACOSX和非图片文件
+    """
+    for info in zip_ref.infolist():
+        if info.is_dir():
+            continue
+        ext = os.path.splitext(info.filename)[1].lower()
+        if '__MACOSX' in info.filename or ext not in IMAGE_EXTENSIONS:
+            logger.info(f"Skipping non-image file: {info.filename}")
+            continue
+        yield info
+
+
+def read_member(zip_ref, info):
+    """
+    按块读取压缩包成员, 边解压边计算内容的SHA-256, 返回 (数据, 十六进制摘要)
+    """
+    digest = hashlib.sha256()
+    chunks = []
+    with zip_ref.open(info) as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            chunks.append(chunk)
+    return b''.join(chunks), digest.hexdigest()
+
+
+def decode_image(data, name='', scale_factor=1):
+    """
+    一次完成图片的解码和校验, scale_factor 小于1时JPEG直接按缩小尺寸解码
+    """
+    try:
+        with stage('decode'):
+            img = Image.open(io.BytesIO(data))
+            if img.format not in IMAGE_FORMATS:
+                raise InvalidImageError(f'unsupported image format {img.format}')
+            draft_image(img, scale_factor)
+            img.load()  # 这会验证图片数据是否完整
+            return img
+    except InvalidImageError:
+        raise
+    except Exception as e:
+        raise InvalidImageError(f'Invalid image file {name}: {str(e)}') from e
+
+
+def encode_png(image):
+    with stage('encode'):
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        return buffer.getvalue()
+
+
+class ZipPredictionPipeline:
+    """
+    ZIP批量预测流水线
+
+    Args:
+        runner: 提供 predict_image(img, scale_factor, out_threshold, tiling) 的预测器或批处理队列
+        save_result: save_result(member_name, png_bytes) -> 结果文件的存储路径
+        inference_workers: 同时提交推理的图片数, 开启批处理时应与最大批大小一致
+        max_in_flight: 同时在流水线中的最大图片数
+        on_start: on_start(total) 开始处理前回调, total 为需要预测的图片数
+        on_result: on_result(index, member_name, result, error) 每张图片完成后按压缩包内顺序回调
+        result_cache: 结果缓存作用域(CacheScope), 命中时跳过解码、推理和编码, 只用于PNG输出
+        output_format: 输出格式, png 保存结果文件并以存储路径作为结果, 其他格式见 mask_formats,
+                       结果为内联的编码字典, 不写存储
+        analyze: analyze(labels, confidence) -> dict, 指定时对类别掩码和置信度图做分析(如连通域统计)
+                 并以分析结果作为结果, 忽略 output_format
+        dedupe: 内容相同的成员只预测一次, 重复成员复用第一次出现的成员的结果(PNG输出时为同一个结果文件),
+                run 之后 duplicates 为 {重复成员名: 第一次出现的成员名}
+    """
+
+    def __init__(self, runner, save_result, scale_factor=1, out_threshold=0.5, tiling=None,
+                 decode_workers=2, inference_workers=1, encode_workers=2, max_in_flight=32,
+                 on_start=None, on_result=None, result_cache=None, output_format='png', n_classes=2,
+                 polygon_tolerance=1.0, analyze=None, dedupe=True):
+        self.runner = runner
+        self.save_result = save_result
+        self.scale_factor = scale_factor
+        self.out_threshold = out_threshold
+        self.tiling = tiling
+        self.decode_workers = max(1, decode_workers)
+        self.inference_workers = max(1, inference_workers)
+        self.encode_workers = max(1, encode_workers)
+        self.max_in_flight = max(1, max_in_flight)
+        self.on_start = on_start
+        self.on_result = on_result
+        self.output_format = output_format
+        self.n_classes = n_classes
+        self.polygon_tolerance = polygon_tolerance
+        self.analyze = analyze
+        self.dedupe = dedupe
+        self.duplicates = {}
+        self.result_cache = result_cache if output_format == 'png' and analyze is None else None
+
+    @classmethod
+    def from_settings(cls, predictor, save_result, **kwargs):
+        """
+        按settings中的 UNET_PIPELINE_* 和批处理配置构建流水线
+        """
+        kwargs.setdefault('decode_workers', getattr(settings, 'UNET_PIPELINE_DECODE_WORKERS', 2))
+        runner = get_runner(predictor)
+        # 推理进程池的客户端按整个进程池的并发数提交
+        kwargs.setdefault('inference_workers', getattr(runner, 'concurrency', None) or inference_concurrency())
+        kwargs.setdefault('encode_workers', getattr(settings, 'UNET_PIPELINE_ENCODE_WORKERS', 2))
+        kwargs.setdefault('max_in_flight', getattr(settings, 'UNET_PIPELINE_MAX_IN_FLIGHT', 32))
+        kwargs.setdefault('dedupe', getattr(settings, 'UNET_PIPELINE_DEDUPE', True))
+        kwargs.setdefault('n_classes', predictor.n_classes)
+        return cls(runner, save_result, **kwargs)
+
+    def run(self, zip_source):
+        """
+        对压缩包中的所有图片进行预测
+
+        回调都在调用线程中执行, 已完成的图片在读取下一张之前按顺序上报.
+        重复成员不占用在途名额, 按自己在压缩包中的位置上报第一次出现的成员的结果或错误.
+
+        Args:
+            zip_source: ZIP文件路径或可seek的文件对象
+
+        Returns:
+            (按压缩包内顺序排列的 (成员名, 结果存储路径/编码字典或None) 列表, 成功数, 失败数)
+        """
+        results = []
+        # (成员名, 结果Future, 是否占用在途名额), 按压缩包内顺序排列
+        pending = deque()
+        in_flight = 0
+        # 内容摘要 -> (第一次出现的成员名, 其结果Future)
+        seen = {}
+        self.duplicates = {}
+        with ThreadPoolExecutor(self.decode_workers, thread_name_prefix='unet-decode') as decode_pool, \
+                ThreadPoolExecutor(self.inference_workers, thread_name_prefix='unet-infer') as infer_pool, \
+                ThreadPoolExecutor(self.encode_workers, thread_name_prefix='unet-encode') as encode_pool:
+            stages = (decode_pool, infer_pool, encode_pool)
+            with zipfile.ZipFile(zip_source, 'r') as zip_ref:
+                members = list(iter_image_members(zip_ref))
+                if self.on_start is not None:
+                    self.on_start(len(members))
+                for info in members:
+                    # 在途图片达到上限时等待最早的一张完成
+                    # 重复成员排在第一次出现的成员之后, 轮到它时结果已经就绪
+                    while pending and (in_flight >= self.max_in_flight or pending[0][1].done()):
+                        name, done, counted = pending.popleft()
+                        in_flight -= counted
+                        self._report(results, name, done)
+                    try:
+                        with stage('read'):
+                            data, digest = read_member(zip_ref, info)
+                    except Exception as e:
+                        logger.error(f"Error reading {info.filename} from ZIP: {str(e)}")
+                        done = Future()
+                        done.set_exception(e)
+                        pending.append((info.filename, done, False))
+                        continue
+                    if self.dedupe and digest in seen:
+                        first_name, done = seen[digest]
+                        self.duplicates[info.filename] = first_name
+                        PIPELINE_DUPLICATES.inc()
+                        pending.append((info.filename, done, False))
+                        continue
+                    done = Future()
+                    seen[digest] = (info.filename, done)
+                    pending.append((info.filename, done, True))
+                    in_flight += 1
+                    self._start(info.filename, data, digest, stages, done)
+
+            while pending:
+                name, done, _ = pending.popleft()
+                self._report(results, name, done)
+        processed = sum(1 for _, result in results if result is not None)
+        return results, processed, len(results) - processed
+
+    def _report(self, results, name, done):
+        result = error = None
+        try:
+            result = done.result()
+            logger.info(f"Successfully processed {name}")
+        except Exception as e:
+            error = str(e)
+            logger.error(f"Error processing {name}: {error}")
+        results.append((name, result))
+        if self.on_result is not None:
+            self.on_result(len(results) - 1, name, result, error)
+
+    def _start(self, name, data, digest, stages, done):
+        decode_pool, infer_pool, encode_pool = stages
+
+        # 上一阶段完成后把结果交给下一阶段的线程池
+        def on_decoded(f):
+            if f.exception() is not None:
+                done.set_exception(f.exception())
+                return
+            img, key, cached = f.result()
+            if cached is not None:
+                done.set_result(cached)
+                return
+            infer_pool.submit(self._infer, img).add_done_callback(lambda f: on_inferred(f, key))
+
+        def on_inferred(f, key):
+            if f.exception() is not None:
+                done.set_exception(f.exception())
+                return
+            encode_pool.submit(self._encode, name, f.result(), key).add_done_callback(on_encoded)
+
+        def on_encoded(f):
+            if f.exception() is not None:
+                done.set_exception(f.exception())
+            else:
+                done.set_result(f.result())
+
+        decode_pool.submit(self._decode, name, data, digest).add_done_callback(on_decoded)
+
+    def _decode(self, name, data, digest=None):
+        """
+        命中缓存时直接返回缓存结果, 否则解码图片
+        """
+        key = None
+        if self.result_cache is not None:
+            key = self.result_cache.key(data, digest)
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                return None, key, cached
+        return decode_image(data, name, self.scale_factor), key, None
+
+    def _infer(self, img):
+        if self.analyze is not None:
+            return self.runner.predict_labels(img, self.scale_factor, self.out_threshold, self.tiling,
+                                              with_confidence=True)
+        if self.output_format != 'png':
+            return self.runner.predict_labels(img, self.scale_factor, self.out_threshold, self.tiling)
+        return self.runner.predict_image(img, self.scale_factor, self.out_threshold, self.tiling)
+
+    def _encode(self, name, mask, key=None):
+        if self.analyze is not None:
+            with stage('analyze'):
+                return self.analyze(*mask)
+        if self.output_format != 'png':
+            with stage('encode'):
+                return encode_labels(mask, self.output_format, self.n_classes, self.polygon_tolerance)
+        png_bytes = encode_png(mask)
+        if key is not None:
+            return self.result_cache.put(key, png_bytes)
+        return self.save_result(name, png_bytes)
@@ -0,0 +1,145 @@
+"""
+低精度CPU推理
+
+int8: FX图模式静态量化, 卷积权重和激活都量化为int8, 激活的量化参数由数据集图片校准得到.
+      (动态量化只支持Linear/LSTM, 对以卷积为主的UNet没有效果, 因此使用静态量化)
+bf16: 在支持bf16指令的CPU上以 torch.autocast 执行前向推理.
+
+低精度模式需要先用 manage.py calibrate_precision 在数据集上校准并与fp32比较Dice/IoU,
+通过后在checkpoint旁保存 <checkpoint>.<precision>.pt; 加载模型时没有通过校准的记录则拒绝启用, 回退到fp32.
+"""
+import copy
+import os
+
+import numpy as np
+import torch
+
+from .backends import EagerBackend
+
+PRECISIONS = ('fp32', 'int8', 'bf16')
+
+
+class PrecisionError(RuntimeError):
+    """
+    低精度模式不可用: 未校准、校准未通过或CPU不支持
+    """
+
+
+def bf16_supported():
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def precision_artifact_path(checkpoint_path, precision):
+    return f'{os.path.splitext(checkpoint_path)[0]}.{precision}.pt'
+
+
+class Bf16Backend(EagerBackend):
+    name = 'bf16'
+
+    def __call__(self, batch):
+        batch = batch.to(device=self.device, dtype=torch.float32)
+        with torch.no_grad(), torch.autocast(device_type='cpu', dtype=torch.bfloat16):
+            return self.net(batch).float().cpu()
+
+
+class Int8Backend(EagerBackend):
+    name = 'int8'
+
+    def __init__(self, net):
+        super().__init__(net, torch.device('cpu'))
+
+    def memory_bytes(self):
+        # 量化后的权重保存在打包参数中, 不再是普通参数
+        return sum(t.numel() * t.element_size() for t in self.net.state_dict().values() if torch.is_tensor(t))
+
+
+def _prepare_int8(net):
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx
+
+    engine = 'x86' if 'x86' in torch.backends.quantized.supported_engines else torch.backends.quantized.engine
+    torch.backends.quantized.engine = engine
+    example = (torch.randn(1, net.n_channels, 64, 64),)
+    return prepare_fx(copy.deepcopy(net).cpu().eval(), get_default_qconfig_mapping(engine), example)
+
+
+def quantize_int8(net, calibration):
+    """
+    用校准图片统计激活范围后把模型转换为int8
+
+    Args:
+        calibration: 预处理后的 (C, H, W) 张量序列
+    """
+    from torch.ao.quantization.quantize_fx import convert_fx
+
+    prepared = _prepare_int8(net)
+    with torch.no_grad():
+        for tensor in calibration:
+            prepared(tensor.unsqueeze(0))
+    return convert_fx(prepared)
+
+
+def build_backend(net, precision, state_dict=None, device=None):
+    """
+    构建低精度推理后端, int8 需要校准得到的量化模型参数
+    """
+    if precision == 'bf16':
+        if not bf16_supported():
+            raise PrecisionError('当前CPU不支持bf16')
+        return Bf16Backend(net, device or torch.device('cpu'))
+    if precision == 'int8':
+        from torch.ao.quantization.quantize_fx import convert_fx
+
+        quantized = convert_fx(_prepare_int8(net))
+        quantized.load_state_dict(state_dict)
+        return Int8Backend(quantized)
+    raise ValueError(f'precision must be one of {PRECISIONS}, got {precision!r}')
+
+
+def save_calibration(checkpoint_path, precision, checkpoint_digest, report, backend):
+    path = precision_artifact_path(checkpoint_path, precision)
+    torch.save({
+        'precision': precision,
+        'checkpoint_digest': checkpoint_digest,
+        'report': report,
+        'state_dict': backend.net.state_dict() if precision == 'int8' else None,
+    }, path)
+    return path
+
+
+def load_backend(net, precision, checkpoint_path, checkpoint_digest, device=None):
+    """
+    按校准记录加载低精度推理后端, 没有通过校准或checkpoint已变化时抛出 PrecisionError
+    """
+    path = precision_artifact_path(checkpoint_path, precision)
+    if not os.path.exists(path):
+        raise PrecisionError(f'{precision} 未校准, 请先执行 manage.py calibrate_precision')
+    artifact = torch.load(path, map_location='cpu', weights_only=False)
+    if artifact.get('checkpoint_digest') != checkpoint_digest:
+        raise PrecisionError(f'{precision} 校准记录与当前checkpoint不匹配, 请重新校准')
+    if not artifact.get('report', {}).get('passed'):
+        raise PrecisionError(f'{precision} 校准未通过精度检查')
+    if device is not None and device.type != 'cpu':
+        raise PrecisionError(f'{precision} 仅用于CPU推理')
+    return build_backend(net, precision, artifact.get('state_dict'), device)
+
+
+def mask_scores(reference, candidate, n_classes):
+    """
+    以 reference 为基准计算前景类别的平均Dice和IoU, 两者都没有前景时记为1
+    """
+    dices, ious = [], []
+    for c in range(1, max(n_classes, 2)):
+        ref, cand = reference == c, candidate == c
+        total = np.count_nonzero(ref) + np.count_nonzero(cand)
+        if not total:
+            continue
+        intersection = np.count_nonzero(ref & cand)
+        dices.append(2 * intersection / total)
+        ious.append(intersection / (total - intersection))
+    if not dices:
+        return 1.0, 1.0
+    return float(np.mean(dices)), float(np.mean(ious))
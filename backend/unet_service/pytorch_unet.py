@@ -0,0 +1,26 @@
+"""
+Pytorch-UNet 目录的导入路径和默认模型路径
+
+本模块不导入torch: web worker、celery worker和管理命令导入预测服务的视图和任务时不加载推理栈,
+torch和UNet网络只在第一次加载模型时(开启推理进程池时只在推理进程中)由 unet_predictor 导入.
+"""
+import sys
+from pathlib import Path
+
+PYTORCH_UNET_PATH = str(Path(__file__).resolve().parent / 'Pytorch-UNet')
+
+
+def add_pytorch_unet_path():
+    """
+    把Pytorch-UNet目录加入Python路径, 之后才能导入其中的 unet 和 utils 模块
+    """
+    if PYTORCH_UNET_PATH not in sys.path:
+        sys.path.append(PYTORCH_UNET_PATH)
+
+
+def default_model_path():
+    """
+    默认模型路径
+    """
+    base_dir = Path(__file__).resolve().parent.parent.parent
+    return str(base_dir / 'Pytorch-UNet' / 'checkpoints' / 'MODEL.pth')
@@ -0,0 +1,76 @@
+"""
+预测掩码渲染
+
+按模型的 mask_values 只构建一次查找表, 一次索引完成整张类别掩码到像素值的映射,
+代替逐类别的全图布尔掩码赋值. 二值掩码直接按位打包写成1-bit图片,
+palette 模式直接把类别掩码作为P模式图片的调色板索引, 不再逐像素映射.
+"""
+import numpy as np
+from PIL import Image
+
+MASK_IMAGE_MODES = ('auto', 'palette')
+
+
+class MaskRenderer:
+    """
+    类别掩码渲染器
+
+    Args:
+        mask_values: checkpoint中保存的类别值, 标量灰度值或RGB列表
+        mode: auto 输出与类别值一致的像素值(二值为1-bit, 灰度为L, 彩色为RGB);
+              palette 输出P模式图片, 像素为类别序号, 颜色由调色板给出
+    """
+
+    def __init__(self, mask_values, mode='auto'):
+        if mode not in MASK_IMAGE_MODES:
+            raise ValueError(f'mask image mode must be one of {MASK_IMAGE_MODES}, got {mode!r}')
+        self.mask_values = mask_values
+        self.color = isinstance(mask_values[0], (list, tuple))
+        self.binary = not self.color and list(mask_values) == [0, 1]
+        # 查找表补齐到256项, 超出 mask_values 的类别与逐类赋值时一样渲染为0
+        size = max(256, len(mask_values))
+        if self.color:
+            self.lut = np.zeros((size, len(mask_values[0])), dtype=np.uint8)
+        else:
+            self.lut = np.zeros(size, dtype=np.uint8)
+        self.lut[:len(mask_values)] = mask_values
+        if self.binary:
+            self.lut[1] = 255
+        # 类别数超过256时无法使用P模式
+        self.mode = mode if len(mask_values) <= 256 else 'auto'
+
+    def palette(self):
+        """
+        P模式图片的调色板, 按类别序号排列的RGB值
+        """
+        lut = self.lut[:len(self.mask_values)]
+        if not self.color:
+            lut = np.repeat(lut[:, None], 3, axis=1)
+        elif lut.shape[1] >= 3:
+            lut = lut[:, :3]
+        else:
+            lut = np.repeat(lut[:, :1], 3, axis=1)
+        return lut.reshape(-1).tolist()
+
+    def render(self, mask):
+        """
+        将 (H, W) 类别掩码或 (C, H, W) 概率图转换为图片
+        """
+        if mask.ndim == 3:
+            mask = np.argmax(mask, axis=0)
+        height, width = mask.shape[-2], mask.shape[-1]
+
+        if self.mode == 'palette':
+            if mask.dtype != np.uint8:
+                # 超出调色板的类别与auto模式一致渲染为0
+                mask = np.where(mask < len(self.mask_values), mask, 0).astype(np.uint8)
+            image = Image.frombuffer('P', (width, height), np.ascontiguousarray(mask), 'raw', 'P', 0, 1)
+            image.putpalette(self.palette())
+            return image
+
+        if self.binary:
+            # 每行按位打包, 与PIL 1-bit图片的原始格式一致
+            bits = np.packbits(mask == 1, axis=-1)
+            return Image.frombytes('1', (width, height), bits.tobytes())
+
+        return Image.fromarray(self.lut[mask])
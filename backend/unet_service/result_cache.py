@@ -0,0 +1,239 @@
+"""
+基于内容寻址的预测结果缓存
+
+缓存键由图片内容哈希、checkpoint摘要和影响结果的预测参数共同决定, 结果PNG按键保存在
+default_storage 中. 文件本身就是缓存索引, 共享media存储的多个进程之间可以互相命中.
+按TTL和总大小淘汰最旧的结果文件.
+"""
+import hashlib
+import io
+import json
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from PIL import Image
+
+from .metrics import REGISTRY, stage
+from .tiling import scaled_size
+
+logger = logging.getLogger(__name__)
+
+CACHE_REQUESTS = REGISTRY.counter('unet_result_cache_requests_total', '预测结果缓存查询次数')
+CACHE_EVICTIONS = REGISTRY.counter('unet_result_cache_evictions_total', '预测结果缓存淘汰的文件数')
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class PredictionResultCache:
+    """
+    预测结果缓存
+
+    Args:
+        prefix: 结果文件在存储中的目录
+        ttl: 结果有效期(秒), None 表示不过期
+        max_bytes: 结果文件总大小上限, None 表示不限制
+        evict_interval: 每写入多少个结果执行一次淘汰
+    """
+
+    def __init__(self, prefix='unet_cache', ttl=None, max_bytes=None, evict_interval=100, storage=None):
+        self.prefix = prefix.rstrip('/')
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.evict_interval = evict_interval
+        self.storage = storage or default_storage
+        self._lock = threading.Lock()
+        self._puts = 0
+
+    @classmethod
+    def from_settings(cls):
+        max_mb = getattr(settings, 'UNET_RESULT_CACHE_MAX_MB', None)
+        return cls(
+            prefix=getattr(settings, 'UNET_RESULT_CACHE_PREFIX', 'unet_cache'),
+            ttl=getattr(settings, 'UNET_RESULT_CACHE_TTL', None),
+            max_bytes=max_mb * 1024 * 1024 if max_mb else None,
+            evict_interval=getattr(settings, 'UNET_RESULT_CACHE_EVICT_INTERVAL', 100),
+        )
+
+    def scope(self, model_digest, scale_factor, threshold, **options):
+        """
+        绑定模型和预测参数, 返回只需图片内容即可查询/写入的缓存作用域
+        """
+        return CacheScope(self, model_digest, scale_factor, threshold, **options)
+
+    def path(self, key):
+        return f'{self.prefix}/{key[:2]}/{key}.png'
+
+    def owns(self, path):
+        """
+        path 是否为缓存中的结果文件(会被淘汰)
+        """
+        return path.startswith(f'{self.prefix}/')
+
+    def _expired(self, path):
+        if not self.ttl:
+            return False
+        return self.storage.get_modified_time(path) < timezone.now() - timedelta(seconds=self.ttl)
+
+    def get(self, key):
+        """
+        命中时返回结果文件的存储路径, 未命中或已过期返回None
+        """
+        path = self.path(key)
+        try:
+            if self.storage.exists(path) and not self._expired(path):
+                CACHE_REQUESTS.inc(result='hit')
+                return path
+        except OSError as e:
+            logger.warning(f"Prediction cache lookup failed for {path}: {str(e)}")
+        CACHE_REQUESTS.inc(result='miss')
+        return None
+
+    def put(self, key, png_bytes):
+        """
+        写入结果, 返回存储路径
+        """
+        path = self.path(key)
+        if self.storage.exists(path):
+            # 过期文件删除后重写, 并发写入同一键时保留已有文件
+            if not self._expired(path):
+                return path
+            self.storage.delete(path)
+        with stage('save'):
+            saved = self.storage.save(path, ContentFile(png_bytes))
+        with self._lock:
+            self._puts += 1
+            should_evict = self.evict_interval and self._puts % self.evict_interval == 0
+        if should_evict:
+            self.evict()
+        return saved
+
+    def _entries(self):
+        try:
+            dirs, _ = self.storage.listdir(self.prefix)
+        except FileNotFoundError:
+            return []
+        entries = []
+        for directory in dirs:
+            _, files = self.storage.listdir(f'{self.prefix}/{directory}')
+            for name in files:
+                path = f'{self.prefix}/{directory}/{name}'
+                try:
+                    entries.append((self.storage.get_modified_time(path), self.storage.size(path), path))
+                except OSError:
+                    continue
+        return entries
+
+    def evict(self):
+        """
+        删除过期结果, 然后按修改时间从旧到新删除直到总大小不超过上限
+
+        Returns:
+            删除的文件数
+        """
+        entries = sorted(self._entries())
+        removed = 0
+        expire_before = timezone.now() - timedelta(seconds=self.ttl) if self.ttl else None
+        total = sum(size for _, size, _ in entries)
+        for modified, size, path in entries:
+            expired = expire_before is not None and modified < expire_before
+            over_budget = self.max_bytes is not None and total > self.max_bytes
+            if not expired and not over_budget:
+                break
+            try:
+                self.storage.delete(path)
+            except OSError as e:
+                logger.warning(f"Failed to evict cached prediction {path}: {str(e)}")
+                continue
+            total -= size
+            removed += 1
+        if removed:
+            CACHE_EVICTIONS.inc(removed)
+            logger.info(f"Evicted {removed} cached prediction results")
+        return removed
+
+
+class CacheScope:
+    """
+    绑定了模型和预测参数的缓存作用域
+
+    分块参数只对实际分块推理的图片计入缓存键, 不分块的图片与未指定分块参数时共用缓存
+    """
+
+    def __init__(self, cache, model_digest, scale_factor, threshold, tiling=None, **options):
+        self.cache = cache
+        self.scale_factor = scale_factor
+        self.tiling = tiling
+        params = {
+            'model': model_digest,
+            'scale_factor': float(scale_factor),
+            'threshold': float(threshold),
+            **options,
+        }
+        self._params = json.dumps({**params, 'tiling': None}, sort_keys=True, default=str)
+        self._tiled_params = json.dumps({**params, 'tiling': vars(tiling) if tiling else None},
+                                        sort_keys=True, default=str)
+
+    def tiled(self, data):
+        """
+        图片是否会分块推理, 只读取图片头部得到原始尺寸
+        """
+        if self.tiling is None:
+            return False
+        try:
+            size = Image.open(io.BytesIO(data)).size
+            return self.tiling.applies(*scaled_size(size, self.scale_factor))
+        except Exception:
+            # 无法识别的图片预测时会失败, 不会写入缓存
+            return False
+
+    def key(self, data, digest=None):
+        """
+        由图片内容和绑定的参数计算缓存键, digest 为已经计算好的 content_hash(data) 时不再重复计算
+        """
+        params = self._tiled_params if self.tiled(data) else self._params
+        return hashlib.sha256(f'{digest or content_hash(data)}:{params}'.encode()).hexdigest()
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def put(self, key, png_bytes):
+        return self.cache.put(key, png_bytes)
+
+
+_cache = None
+
+
+def get_result_cache():
+    """
+    进程级结果缓存, 未开启时返回None
+    """
+    global _cache
+    if not getattr(settings, 'UNET_RESULT_CACHE_ENABLED', True):
+        return None
+    if _cache is None:
+        _cache = PredictionResultCache.from_settings()
+    return _cache
+
+
+def get_cache_scope(predictor, scale_factor, threshold, tiling=None):
+    """
+    当前预测器和预测参数对应的缓存作用域, 未开启缓存时返回None
+    """
+    cache = get_result_cache()
+    if cache is None:
+        return None
+    model_digest = getattr(predictor, 'checkpoint_digest', None) or predictor.model_path
+    return cache.scope(
+        model_digest, scale_factor, threshold,
+        tiling=tiling,
+        mask_mode=getattr(predictor, 'mask_mode', None),
+        upsample=getattr(predictor, 'upsample', None),
+        precision=getattr(predictor, 'precision', None),
+    )
@@ -0,0 +1,34 @@
+from django.core.files.storage import default_storage
+from rest_framework import serializers
+
+from dvadmin.utils.serializers import CustomModelSerializer
+from unet_service.models import PredictionJob, PredictionJobResult
+
+
+class PredictionJobSerializer(CustomModelSerializer):
+    """
+    预测任务-序列化器
+    """
+
+    class Meta:
+        model = PredictionJob
+        fields = "__all__"
+        read_only_fields = ["id", "status", "total", "processed", "failed", "message"]
+
+
+class PredictionJobResultSerializer(serializers.ModelSerializer):
+    """
+    预测任务结果-序列化器
+    """
+    result_url = serializers.SerializerMethodField(read_only=True)
+
+    def get_result_url(self, instance):
+        if not instance.result_path:
+            return None
+        url = default_storage.url(instance.result_path)
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+    class Meta:
+        model = PredictionJobResult
+        fields = ["id", "index", "name", "result_url", "error"]
@@ -0,0 +1,184 @@
+import io
+import logging
+import os
+from pathlib import Path
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from application.celery import app
+from unet_service.metrics import stage
+from unet_service.models import PredictionJob, PredictionJobResult
+
+logger = logging.getLogger(__name__)
+
+
+def job_progress(job, result=None):
+    """
+    任务进度消息内容
+    """
+    content = {
+        'job_id': job.id,
+        'status': job.status,
+        'total': job.total,
+        'processed': job.processed,
+        'failed': job.failed,
+        'message': job.message,
+    }
+    if result is not None:
+        content['result'] = {
+            'index': result.index,
+            'name': result.name,
+            'result_url': default_storage.url(result.result_path) if result.result_path else None,
+            'error': result.error,
+        }
+    return content
+
+
+def push_job_progress(job, result=None):
+    """
+    通过websocket把任务进度推送给任务创建人
+    """
+    if not job.creator_id:
+        return
+    try:
+        from application.websocketConfig import set_message, websocket_push
+        websocket_push(job.creator_id, set_message('system', 'UNET_JOB', job_progress(job, result)))
+    except Exception as e:
+        logger.warning(f"Failed to push progress of prediction job {job.id}: {str(e)}")
+
+
+def save_job_result(job, name, png_bytes):
+    """
+    保存单张图片的预测结果, 返回存储路径
+    """
+    with stage('save'):
+        return default_storage.save(
+            f'unet_jobs/{job.id}/{Path(name).stem}_{os.urandom(4).hex()}_result.png',
+            ContentFile(png_bytes)
+        )
+
+
+def keep_job_result(job, name, result_path):
+    """
+    结果缓存中的文件会按TTL和容量被淘汰, 复制到任务目录后作为任务结果保存
+    """
+    from unet_service.result_cache import get_result_cache
+
+    cache = get_result_cache()
+    if not result_path or cache is None or not cache.owns(result_path):
+        return result_path
+    with cache.storage.open(result_path, 'rb') as f:
+        return save_job_result(job, name, f.read())
+
+
+def _predict_single(job, predictor, source, name, scale_factor, threshold, tiling, cache_scope):
+    """
+    预测单张图片, 返回结果存储路径, 命中结果缓存时不再推理
+    """
+    from unet_service.batching import get_runner
+    from unet_service.pipeline import encode_png
+
+    with stage('read'):
+        data = source.read()
+    key = cache_scope.key(data) if cache_scope is not None else None
+    if key is not None:
+        cached = cache_scope.get(key)
+        if cached is not None:
+            return cached
+    mask_image = get_runner(predictor).predict(io.BytesIO(data), scale_factor, threshold, tiling)
+    png_bytes = encode_png(mask_image)
+    if key is not None:
+        return cache_scope.put(key, png_bytes)
+    return save_job_result(job, name, png_bytes)
+
+
+@app.task
+def run_prediction_job(job_id):
+    from unet_service.inference_pool import get_predictor
+    from unet_service.pipeline import ZipPredictionPipeline
+    from unet_service.result_cache import get_cache_scope
+    from unet_service.tiling import TileConfig
+
+    job = PredictionJob.objects.get(pk=job_id)
+    job.status = 1
+    job.save(update_fields=['status', 'update_datetime'])
+    push_job_progress(job)
+
+    params = job.params or {}
+    scale_factor = float(params.get('scale_factor', 1.0))
+    threshold = float(params.get('threshold', 0.5))
+
+    def on_start(total):
+        job.total = total
+        job.save(update_fields=['total', 'update_datetime'])
+        push_job_progress(job)
+
+    def on_result(index, name, result_path, error):
+        try:
+            result_path = keep_job_result(job, name, result_path)
+        except Exception as e:
+            logger.error(f"Error saving result of {name}: {str(e)}")
+            result_path, error = None, str(e)
+        result = PredictionJobResult.objects.create(
+            job=job, index=index, name=name, result_path=result_path, error=(error or '')[:250] or None
+        )
+        if error:
+            job.failed += 1
+        else:
+            job.processed += 1
+        job.save(update_fields=['processed', 'failed', 'update_datetime'])
+        push_job_progress(job, result)
+
+    duplicates = 0
+    try:
+        predictor = get_predictor(name=job.model_name or None, version=job.model_version or None)
+        tiling = TileConfig.from_settings(params.get('tile_size'), params.get('tile_overlap'))
+        cache_scope = get_cache_scope(predictor, scale_factor, threshold, tiling)
+        with default_storage.open(job.source, 'rb') as source:
+            if job.source.lower().endswith('.zip'):
+                pipeline = ZipPredictionPipeline.from_settings(
+                    predictor,
+                    lambda name, png_bytes: save_job_result(job, name, png_bytes),
+                    scale_factor=scale_factor,
+                    out_threshold=threshold,
+                    tiling=tiling,
+                    result_cache=cache_scope,
+                    on_start=on_start,
+                    on_result=on_result,
+                )
+                pipeline.run(source)
+                duplicates = len(pipeline.duplicates)
+            else:
+                on_start(1)
+                name = os.path.basename(job.source)
+                try:
+                    on_result(0, name, _predict_single(
+                        job, predictor, source, name, scale_factor, threshold, tiling, cache_scope
+                    ), None)
+                except Exception as e:
+                    logger.error(f"Error processing {name}: {str(e)}")
+                    on_result(0, name, None, str(e))
+        job.status = 2 if job.processed else 3
+        job.message = f'成功处理{job.processed}个文件，失败{job.failed}个文件'
+        if duplicates:
+            job.message += f'，其中{duplicates}个重复文件复用了结果'
+    except Exception as e:
+        logger.error(f"Prediction job {job.id} failed: {str(e)}")
+        job.status = 3
+        job.message = str(e)[:250]
+    job.save()
+    push_job_progress(job)
+
+
+@app.task
+def evict_prediction_cache():
+    """
+    清理过期和超出容量上限的预测结果缓存, 可配置为celery beat定时任务
+    """
+    from unet_service.result_cache import get_result_cache
+
+    cache = get_result_cache()
+    if cache is None:
+        return 0
+    return cache.evict()
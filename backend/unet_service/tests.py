@@ -1,3 +1,225 @@
-from django.test import TestCase
+import importlib.util
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
 
-# Create your tests here.
+import numpy as np
+from django.test import SimpleTestCase
+from PIL import Image
+
+
+def random_image(width, height, seed=0):
+    return Image.fromarray(np.random.RandomState(seed).randint(0, 256, (height, width, 3), dtype=np.uint8))
+
+
+class UNetTestMixin:
+    """
+    在临时目录中保存一个随机初始化的UNet checkpoint
+    """
+    n_classes = 3
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        import torch
+
+        from unet_service.pytorch_unet import add_pytorch_unet_path
+        from unet_service.unet_predictor import UNetPredictor
+
+        add_pytorch_unet_path()
+        from unet import UNet
+
+        torch.manual_seed(0)
+        cls.tmp_dir = Path(tempfile.mkdtemp())
+        cls.checkpoint = str(cls.tmp_dir / 'model.pth')
+        state_dict = UNet(n_channels=3, n_classes=cls.n_classes).state_dict()
+        state_dict['mask_values'] = list(range(cls.n_classes))
+        torch.save(state_dict, cls.checkpoint)
+        cls.device = torch.device('cpu')
+        cls.predictor = UNetPredictor(cls.checkpoint, device=cls.device, n_classes=cls.n_classes)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+        super().tearDownClass()
+
+
+class ExportParityTest(UNetTestMixin, SimpleTestCase):
+    """
+    导出的TorchScript/ONNX模型与eager模型的argmax类别一致
+    """
+
+    def export(self, fmt):
+        from unet_service.backends import export_onnx, export_torchscript, save_metadata
+
+        net = self.predictor.net
+        path = str(self.tmp_dir / f'model.{"pt" if fmt == "torchscript" else "onnx"}')
+        if fmt == 'torchscript':
+            export_torchscript(net, path)
+        else:
+            export_onnx(net, path)
+        save_metadata(path, format=fmt, mask_values=net.mask_values, n_classes=net.n_classes, bilinear=net.bilinear)
+        return path
+
+    def assert_parity(self, fmt):
+        import torch
+
+        from unet_service.unet_predictor import UNetPredictor
+
+        exported = UNetPredictor(self.export(fmt), device=self.device, backend=fmt)
+        self.assertEqual(exported.n_classes, self.n_classes)
+        generator = torch.Generator().manual_seed(0)
+        for batch_size, height, width in ((1, 64, 64), (2, 37, 53)):
+            batch = torch.rand(batch_size, 3, height, width, generator=generator)
+            with torch.no_grad():
+                expected = self.predictor.net(batch).argmax(dim=1)
+            actual = exported.forward(batch).argmax(dim=1)
+            self.assertTrue(torch.equal(expected, actual), f'{fmt} {batch_size}x{height}x{width}')
+
+        img = random_image(48, 40)
+        np.testing.assert_array_equal(exported.predict_labels(img), self.predictor.predict_labels(img))
+
+    def test_torchscript(self):
+        self.assert_parity('torchscript')
+
+    @unittest.skipUnless(importlib.util.find_spec('onnxruntime'), 'onnxruntime is not installed')
+    def test_onnx(self):
+        self.assert_parity('onnx')
+
+
+def decode_rle(counts, height, width):
+    """
+    COCO RLE计数还原为二值掩码(列优先, 第一段为背景)
+    """
+    flat = np.zeros(height * width, dtype=bool)
+    position, value = 0, False
+    for count in counts:
+        flat[position:position + count] = value
+        position += count
+        value = not value
+    assert position == height * width
+    return flat.reshape((height, width), order='F')
+
+
+class RleTest(SimpleTestCase):
+    def assert_round_trip(self, mask):
+        from unet_service.mask_formats import rle_counts
+
+        counts = rle_counts(mask)
+        self.assertTrue(all(count > 0 for count in counts[1:]))
+        np.testing.assert_array_equal(decode_rle(counts, *mask.shape), mask)
+
+    def test_round_trip(self):
+        rng = np.random.RandomState(0)
+        self.assert_round_trip(rng.rand(17, 23) > 0.5)
+        self.assert_round_trip(np.zeros((4, 5), dtype=bool))
+
+    def test_starts_with_foreground(self):
+        from unet_service.mask_formats import rle_counts
+
+        mask = np.zeros((3, 4), dtype=bool)
+        mask[:2, 0] = True
+        self.assertEqual(rle_counts(mask), [0, 2, 10])
+        self.assert_round_trip(mask)
+        self.assert_round_trip(np.ones((3, 4), dtype=bool))
+
+    def test_encode_labels(self):
+        from unet_service.mask_formats import encode_labels
+
+        labels = np.random.RandomState(1).randint(0, 4, (9, 13)).astype(np.uint8)
+        encoded = encode_labels(labels, 'rle', n_classes=4)
+        self.assertEqual(encoded['size'], [9, 13])
+        self.assertEqual([entry['class'] for entry in encoded['classes']], [1, 2, 3])
+        for entry in encoded['classes']:
+            np.testing.assert_array_equal(decode_rle(entry['rle']['counts'], 9, 13), labels == entry['class'])
+
+
+def reference_labels(mask_values, img):
+    """
+    逐类别比较整张掩码的原始实现
+    """
+    mask = np.zeros(img.shape[:2], dtype=np.int64)
+    for i, v in enumerate(mask_values):
+        if img.ndim == 2:
+            mask[img == v] = i
+        else:
+            mask[(img == v).all(-1)] = i
+    return mask
+
+
+class MaskLabelsTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        from unet_service.pytorch_unet import add_pytorch_unet_path
+
+        add_pytorch_unet_path()
+        from utils.data_loading import BasicDataset, mask_lookup
+
+        cls.mask_to_labels = staticmethod(BasicDataset.mask_to_labels)
+        cls.mask_lookup = staticmethod(mask_lookup)
+
+    def lookup_kind(self, mask_values, img):
+        values = tuple(tuple(v) if isinstance(v, list) else v for v in mask_values)
+        return self.mask_lookup(values, img.dtype.str, img.shape[-1] if img.ndim == 3 else 0)[0]
+
+    def assert_matches_reference(self, mask_values, img):
+        np.testing.assert_array_equal(self.mask_to_labels(mask_values, img), reference_labels(mask_values, img))
+
+    def test_grayscale(self):
+        rng = np.random.RandomState(0)
+        mask_values = [0, 128, 255]
+        # 包含不属于任何类别的像素值
+        img = rng.choice([0, 7, 128, 255], (19, 21)).astype(np.uint8)
+        self.assertEqual(self.lookup_kind(mask_values, img), 'lut')
+        self.assert_matches_reference(mask_values, img)
+        self.assert_matches_reference([0, 300, 255], img)
+        self.assert_matches_reference([0, 1000, 60000], rng.choice([0, 5, 1000, 60000], (8, 9)).astype(np.uint16))
+        self.assert_matches_reference([False, True], rng.rand(6, 7) > 0.5)
+
+    def test_rgb(self):
+        rng = np.random.RandomState(1)
+        mask_values = [[0, 0, 0], [255, 0, 0], [0, 255, 0], [0, 0, 255]]
+        colors = np.array(mask_values + [[255, 255, 0]], dtype=np.uint8)
+        img = colors[rng.randint(0, len(colors), (15, 17))]
+        self.assertEqual(self.lookup_kind(mask_values, img), 'search')
+        self.assert_matches_reference(mask_values, img)
+        rgba = np.concatenate([img, np.full((15, 17, 1), 255, dtype=np.uint8)], axis=-1)
+        self.assert_matches_reference([v + [255] for v in mask_values], rgba)
+
+
+class TilingTest(UNetTestMixin, SimpleTestCase):
+    def test_tile_starts_cover_length(self):
+        from unet_service.tiling import tile_starts
+
+        self.assertEqual(tile_starts(40, 64, 8), [0])
+        for length, tile, overlap in ((100, 32, 8), (64, 32, 0), (97, 30, 29)):
+            starts = tile_starts(length, tile, overlap)
+            self.assertEqual(starts[0], 0)
+            self.assertEqual(starts[-1], length - tile)
+            # 相邻分块至少重叠 overlap 像素, 没有遗漏的像素
+            self.assertTrue(all(0 < b - a <= tile - overlap for a, b in zip(starts, starts[1:])))
+
+    def test_blend_window(self):
+        from unet_service.tiling import blend_window
+
+        np.testing.assert_array_equal(blend_window(16, 0), np.ones(16, dtype=np.float32))
+        window = blend_window(32, 8)
+        np.testing.assert_array_equal(window, window[::-1])
+        self.assertTrue((window > 0).all() and (window <= 1).all())
+        np.testing.assert_array_equal(window[8:24], 1)
+
+    def test_single_tile_matches_untiled(self):
+        from unet_service.tiling import TileConfig
+
+        img = random_image(48, 40, seed=2)
+        tiling = TileConfig(tile_size=64, overlap=8, force=True)
+        untiled = self.predictor.predict_labels(img)
+        tiled = self.predictor.predict_labels(img, tiling=tiling)
+        np.testing.assert_array_equal(tiled, untiled)
+
+        untiled_labels, untiled_confidence = self.predictor.predict_labels(img, with_confidence=True)
+        tiled_labels, tiled_confidence = self.predictor.predict_labels(img, tiling=tiling, with_confidence=True)
+        np.testing.assert_array_equal(tiled_labels, untiled_labels)
+        np.testing.assert_allclose(tiled_confidence, untiled_confidence, rtol=1e-5)
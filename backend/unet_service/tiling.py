@@ -0,0 +1,172 @@
+"""
+大图滑窗分块推理
+
+按网络输入尺寸把图片切成有重叠的分块, 分块批量前向推理后用线性渐变权重融合接缝.
+推理按行带进行, 只为当前行带保留融合中的logits, 某行不再被后续分块覆盖时立即
+转换为类别标签, 因此峰值内存由分块大小而不是图片大小决定.
+"""
+import numpy as np
+from django.conf import settings
+from PIL import Image
+
+
+class TileConfig:
+    """
+    分块推理配置
+
+    Args:
+        tile_size: 分块边长(网络输入分辨率下的像素)
+        overlap: 相邻分块的重叠像素
+        batch_size: 每次前向推理的分块数量
+        min_pixels: 网络输入像素数超过该值时自动启用分块, None 表示不自动启用
+        force: 无论图片大小都启用分块
+    """
+
+    def __init__(self, tile_size=512, overlap=64, batch_size=4, min_pixels=None, force=False):
+        if tile_size <= 0:
+            raise ValueError('tile_size must be positive')
+        if not 0 <= overlap < tile_size:
+            raise ValueError('overlap must be in [0, tile_size)')
+        self.tile_size = int(tile_size)
+        self.overlap = int(overlap)
+        self.batch_size = max(1, int(batch_size))
+        self.min_pixels = min_pixels
+        self.force = force
+
+    @classmethod
+    def from_settings(cls, tile_size=0, overlap=None):
+        """
+        根据settings构建配置: 指定 tile_size 时强制分块, 否则大图按 UNET_TILE_MIN_PIXELS 自动分块
+        """
+        tile_size = int(tile_size or 0)
+        if overlap in (None, ''):
+            overlap = getattr(settings, 'UNET_TILE_OVERLAP', 64)
+        return cls(
+            tile_size=tile_size or getattr(settings, 'UNET_TILE_SIZE', 512),
+            overlap=int(overlap),
+            batch_size=getattr(settings, 'UNET_TILE_BATCH_SIZE', 4),
+            min_pixels=getattr(settings, 'UNET_TILE_MIN_PIXELS', None),
+            force=tile_size > 0,
+        )
+
+    def applies(self, width, height):
+        if self.force:
+            return True
+        return bool(self.min_pixels) and width * height > self.min_pixels
+
+
+def scaled_size(size, scale_factor):
+    """
+    与 BasicDataset.preprocess 一致的缩放后尺寸
+    """
+    w, h = size
+    new_w, new_h = int(scale_factor * w), int(scale_factor * h)
+    assert new_w > 0 and new_h > 0, 'Scale is too small, resized images would have no pixel'
+    return new_w, new_h
+
+
+def tile_starts(length, tile, overlap):
+    """
+    一维方向上的分块起点, 最后一个分块贴齐末端
+    """
+    if length <= tile:
+        return [0]
+    stride = tile - overlap
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+
+def blend_window(tile, overlap):
+    """
+    一维融合权重: 分块边缘的重叠区域线性渐变, 中间为1
+    """
+    if overlap == 0:
+        return np.ones(tile, dtype=np.float32)
+    idx = np.arange(tile, dtype=np.float32)
+    ramp = np.minimum(idx + 0.5, tile - idx - 0.5) / overlap
+    return np.clip(ramp, 1e-3, 1.0).astype(np.float32)
+
+
+def _to_chw(arr, normalize):
+    if arr.ndim == 2:
+        arr = arr[np.newaxis, ...]
+    else:
+        arr = arr.transpose((2, 0, 1))
+    arr = arr.astype(np.float32)
+    if normalize:
+        arr /= 255.0
+    return arr
+
+
+def predict_tiled(predictor, img, scale_factor=1, out_threshold=0.5, config=None, with_confidence=False):
+    """
+    分块推理, 返回原图尺寸的类别掩码 (H, W), with_confidence 为True时返回 (类别掩码, 置信度图)
+
+    与整图推理不同, 类别在网络分辨率下确定, 缩放回原图尺寸时对标签做最近邻插值
+    """
+    import torch
+
+    config = config or TileConfig(force=True)
+    n_classes = predictor.n_classes
+    size = predictor.source_size(img)
+    new_w, new_h = scaled_size(size, scale_factor)
+    scaled = img if (new_w, new_h) == img.size else img.resize((new_w, new_h), resample=Image.BICUBIC)
+    pixels = np.asarray(scaled)
+    # 与 BasicDataset.preprocess 一致: 只有整图存在大于1的像素值时才归一化
+    normalize = bool(pixels.max() > 1)
+
+    tile_h, tile_w = min(config.tile_size, new_h), min(config.tile_size, new_w)
+    ys = tile_starts(new_h, tile_h, config.overlap)
+    xs = tile_starts(new_w, tile_w, config.overlap)
+    weight = np.outer(blend_window(tile_h, min(config.overlap, tile_h - 1)),
+                      blend_window(tile_w, min(config.overlap, tile_w - 1)))
+
+    channels = max(n_classes, 1)
+    labels = np.zeros((new_h, new_w), dtype=np.uint8 if n_classes <= 256 else np.int32)
+    confidence = np.zeros((new_h, new_w), dtype=np.float32) if with_confidence else None
+    acc_top = 0
+    acc = np.zeros((channels, 0, new_w), dtype=np.float32)
+    acc_weight = np.zeros((0, new_w), dtype=np.float32)
+
+    for band, y0 in enumerate(ys):
+        # 扩展累加缓冲区到当前行带底部
+        grow = y0 + tile_h - (acc_top + acc.shape[1])
+        if grow > 0:
+            acc = np.concatenate([acc, np.zeros((channels, grow, new_w), dtype=np.float32)], axis=1)
+            acc_weight = np.concatenate([acc_weight, np.zeros((grow, new_w), dtype=np.float32)], axis=0)
+
+        for i in range(0, len(xs), config.batch_size):
+            batch_xs = xs[i:i + config.batch_size]
+            tiles = np.stack([
+                _to_chw(pixels[y0:y0 + tile_h, x0:x0 + tile_w], normalize) for x0 in batch_xs
+            ])
+            output = predictor.forward(torch.from_numpy(tiles)).numpy()
+            row = y0 - acc_top
+            for x0, logits in zip(batch_xs, output):
+                acc[:, row:row + tile_h, x0:x0 + tile_w] += logits * weight
+                acc_weight[row:row + tile_h, x0:x0 + tile_w] += weight
+
+        # 后续行带不再覆盖的行可以确定类别并释放
+        done = (ys[band + 1] if band + 1 < len(ys) else new_h) - acc_top
+        blended = acc[:, :done] / acc_weight[:done]
+        if n_classes > 1:
+            labels[acc_top:acc_top + done] = blended.argmax(axis=0)
+            if with_confidence:
+                confidence[acc_top:acc_top + done] = torch.softmax(torch.from_numpy(blended), dim=0).amax(dim=0).numpy()
+        else:
+            prob = torch.sigmoid(torch.from_numpy(blended[0])).numpy()
+            labels[acc_top:acc_top + done] = prob > out_threshold
+            if with_confidence:
+                confidence[acc_top:acc_top + done] = np.maximum(prob, 1 - prob)
+        acc = acc[:, done:].copy()
+        acc_weight = acc_weight[done:].copy()
+        acc_top += done
+
+    if (new_w, new_h) != size:
+        labels = np.asarray(Image.fromarray(labels).resize(size, resample=Image.NEAREST))
+        if with_confidence:
+            confidence = np.asarray(Image.fromarray(confidence).resize(size, resample=Image.BILINEAR))
+    if with_confidence:
+        return labels, confidence
+    return labels
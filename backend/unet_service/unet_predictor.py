@@ -1,46 +1,158 @@
+import inspect
+import logging
 import os
-import sys
 import torch
 import torch.nn.functional as F
 from PIL import Image
 import numpy as np
-from pathlib import Path
 
-# 添加Pytorch-UNet目录到Python路径
-current_dir = Path(__file__).resolve().parent
-pytorch_unet_path = str(current_dir / 'Pytorch-UNet')
-if pytorch_unet_path not in sys.path:
-    sys.path.append(pytorch_unet_path)
+from .pytorch_unet import add_pytorch_unet_path, default_model_path
+
+# 添加Pytorch-UNet目录到Python路径后导入UNet相关模块
+add_pytorch_unet_path()
+from unet import UNet  # noqa: E402
+from utils.data_loading import BasicDataset  # noqa: E402
+from utils.image_io import draft_image, source_size  # noqa: E402
+
+from .backends import BACKENDS, EagerBackend, load_backend
+from .flat_checkpoint import is_flat_checkpoint, load_flat
+from .metrics import stage
+from .precision import PrecisionError, load_backend as load_precision_backend
+from .rendering import MaskRenderer
+from .tiling import predict_tiled, scaled_size
+
+# exact: 全部类别的logits双线性插值到原图尺寸后再取argmax
+# fast: 在网络输出分辨率上决定类别, 只对单通道数据或类别掩码上采样
+UPSAMPLE_MODES = ('exact', 'fast')
+
+logger = logging.getLogger(__name__)
+
+# torch>=2.1: 在meta设备上构建网络后用 load_state_dict(assign=True) 直接采用映射的权重
+ASSIGN_STATE_DICT = 'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters
 
-# 导入UNet相关模块
-from unet import UNet
-from utils.data_loading import BasicDataset
 
 class UNetPredictor:
-    def __init__(self, model_path=None, device=None):
+    """
+    UNet预测器
+
+    backend 为 eager 时 model_path 是训练得到的checkpoint; 为 torchscript/onnx 时 model_path 是
+    manage.py export_unet 导出的模型, 类别数和 mask_values 从导出模型旁的元数据读取.
+    """
+
+    def __init__(self, model_path=None, device=None, n_classes=2, bilinear=False, mask_mode='auto',
+                 upsample='exact', backend='eager'):
         if device is None:
             self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         else:
             self.device = device
             
-        self.net = UNet(n_channels=3, n_classes=2, bilinear=False)
-        self.net.to(device=self.device)
-        
+        if upsample not in UPSAMPLE_MODES:
+            raise ValueError(f'upsample must be one of {UPSAMPLE_MODES}, got {upsample!r}')
+        self.upsample = upsample
+        if backend not in BACKENDS:
+            raise ValueError(f'backend must be one of {BACKENDS}, got {backend!r}')
+
         if model_path is None:
-            # 默认模型路径
-            base_dir = Path(__file__).resolve().parent.parent.parent
-            model_path = str(base_dir / 'Pytorch-UNet' / 'checkpoints' / 'MODEL.pth')
+            model_path = self.default_model_path()
             
         if not os.path.exists(model_path):
             raise FileNotFoundError(f"Model file not found: {model_path}")
-            
-        # 加载模型
-        state_dict = torch.load(model_path, map_location=self.device)
-        self.mask_values = state_dict.pop('mask_values', [0, 1])
-        self.net.load_state_dict(state_dict)
-        self.net.eval()
+        self.model_path = str(model_path)
+
+        if backend == 'eager':
+            self.net = self.load_checkpoint(model_path, n_classes, bilinear, self.device)
+            self.mask_values = self.net.mask_values
+            self.n_classes = self.net.n_classes
+            self.backend = EagerBackend(self.net, self.device)
+            self.precision = 'fp32'
+        else:
+            # 导出模型不需要构建eager网络
+            self.net = None
+            self.backend, metadata = load_backend(backend, self.model_path, self.device)
+            self.mask_values = metadata['mask_values']
+            self.n_classes = metadata['n_classes']
+            self.precision = metadata.get('precision', 'fp32')
+        self.renderer = MaskRenderer(self.mask_values, mask_mode)
+
+    @staticmethod
+    def load_checkpoint(model_path, n_classes=2, bilinear=False, device=None):
+        """
+        加载checkpoint到eager网络, checkpoint中的 mask_values 保存在网络的 mask_values 属性上
 
-    def predict(self, image_file, scale_factor=1, out_threshold=0.5):
+        扁平checkpoint(见 flat_checkpoint)直接映射权重, 类别数和网络结构以文件头为准;
+        torch<2.1 不支持 assign, 退回到常规构建网络后复制权重, 权重不再映射文件
+        """
+        if is_flat_checkpoint(model_path):
+            state_dict, metadata = load_flat(model_path)
+            options = dict(n_channels=metadata['n_channels'], n_classes=metadata['n_classes'],
+                           bilinear=metadata['bilinear'])
+            if ASSIGN_STATE_DICT:
+                # 在meta设备上构建网络, 不为随后被替换的初始权重分配内存
+                with torch.device('meta'):
+                    net = UNet(**options)
+                net.load_state_dict(state_dict, assign=True)
+            else:
+                logger.warning(f"torch {torch.__version__} cannot assign mapped weights, copying {model_path}")
+                net = UNet(**options)
+                net.load_state_dict(state_dict)
+            net.mask_values = metadata['mask_values']
+            net.memory_mapped = ASSIGN_STATE_DICT
+            net.to(device=device)
+            net.eval()
+            return net
+
+        net = UNet(n_channels=3, n_classes=n_classes, bilinear=bilinear)
+        net.to(device=device)
+        state_dict = torch.load(model_path, map_location=device)
+        net.mask_values = state_dict.pop('mask_values', [0, 1])
+        net.load_state_dict(state_dict)
+        net.eval()
+        return net
+
+    @staticmethod
+    def default_model_path():
+        """
+        默认模型路径
+        """
+        return default_model_path()
+
+    def enable_precision(self, precision, checkpoint_digest):
+        """
+        切换到通过校准的低精度推理, 未校准、校准未通过或不支持时保持fp32
+
+        Returns:
+            是否已切换
+        """
+        if precision == 'fp32' or precision == self.precision:
+            return precision == self.precision
+        try:
+            if self.net is None:
+                raise PrecisionError('只有eager后端的fp32模型可以切换精度')
+            self.backend = load_precision_backend(self.net, precision, self.model_path, checkpoint_digest, self.device)
+            if precision == 'int8':
+                # 量化模型是独立的副本, 释放fp32权重
+                self.net = None
+        except PrecisionError as e:
+            logger.warning(f"Refusing {precision} inference for {self.model_path}, using fp32: {str(e)}")
+            return False
+        self.precision = precision
+        logger.info(f"Enabled {precision} inference for {self.model_path}")
+        return True
+
+    @property
+    def mask_mode(self):
+        """
+        结果图片格式, 见 MaskRenderer
+        """
+        return self.renderer.mode
+
+    def memory_bytes(self):
+        """
+        模型参数和缓冲区占用的内存字节数
+        """
+        return self.backend.memory_bytes()
+
+    def predict(self, image_file, scale_factor=1, out_threshold=0.5, tiling=None):
         """
         对输入图片进行预测
         
@@ -48,51 +160,143 @@ class UNetPredictor:
             image_file: 图片文件对象或路径
             scale_factor: 图片缩放因子
             out_threshold: 输出阈值
+            tiling: 分块推理配置(TileConfig), 满足条件时按分块推理
             
         Returns:
             预测结果图片对象
         """
-        # 如果输入是文件对象，直接打开；如果是路径字符串，用PIL打开
-        if isinstance(image_file, (str, Path)):
-            img = Image.open(image_file)
-        else:
-            img = Image.open(image_file)
-            
-        # 预处理图片
-        img_data = torch.from_numpy(BasicDataset.preprocess(None, img, scale_factor, is_mask=False))
-        img_data = img_data.unsqueeze(0)
-        img_data = img_data.to(device=self.device, dtype=torch.float32)
-        
-        # 预测
+        return self.predict_image(self.load_image(image_file, scale_factor), scale_factor, out_threshold, tiling)
+
+    def predict_image(self, img, scale_factor=1, out_threshold=0.5, tiling=None):
+        """
+        对已解码的PIL图片进行预测, 返回预测结果图片对象
+        """
+        return self._mask_to_image(self.predict_labels(img, scale_factor, out_threshold, tiling))
+
+    def predict_labels(self, img, scale_factor=1, out_threshold=0.5, tiling=None, with_confidence=False):
+        """
+        对已打开的图片进行预测, 返回原图尺寸的类别掩码
+
+        Args:
+            with_confidence: 为True时返回 (类别掩码, 置信度图), 置信度为每个像素所属类别的概率
+        """
+        if self.should_tile(img, scale_factor, tiling):
+            return predict_tiled(self, img, scale_factor, out_threshold, tiling, with_confidence)
+        img_data = self.preprocess(img, scale_factor)
+        output = self.forward(img_data.unsqueeze(0))
+        return self.postprocess(output, self.source_size(img), out_threshold, with_confidence=with_confidence)
+
+    @staticmethod
+    def source_size(img):
+        """
+        图片的原始尺寸, 预测结果按该尺寸输出; JPEG按缩小尺寸解码时与 img.size 不同
+        """
+        return source_size(img)
+
+    @staticmethod
+    def should_tile(img, scale_factor, tiling):
+        """
+        是否对该图片使用分块推理
+        """
+        return tiling is not None and tiling.applies(*scaled_size(source_size(img), scale_factor))
+
+    @staticmethod
+    def load_image(image_file, scale_factor=1):
+        """
+        打开并解码图片文件对象或路径, scale_factor 小于1时JPEG直接按缩小尺寸解码
+        """
+        with stage('decode'):
+            img = draft_image(Image.open(image_file), scale_factor)
+            img.load()
+            return img
+
+    @staticmethod
+    def preprocess(img, scale_factor=1):
+        """
+        预处理图片, 返回 (C, H, W) 的float32张量, 张量直接使用预处理得到的数组, 不再复制
+        """
+        with stage('preprocess'):
+            return torch.from_numpy(BasicDataset.preprocess(None, img, scale_factor, is_mask=False))
+
+    def forward(self, batch):
+        """
+        对 (N, C, H, W) 的批量张量做前向推理, 返回CPU上的logits
+        """
+        with stage('forward'):
+            return self.backend(batch)
+
+    def postprocess(self, output, size, out_threshold=0.5, upsample=None, with_confidence=False):
+        """
+        将单张图片的logits (1, C, h, w) 还原到原图尺寸并转换为类别掩码
+
+        Args:
+            upsample: 上采样方式, 默认使用预测器的 upsample
+            with_confidence: 为True时同时返回原图尺寸的float32置信度图
+        """
+        with stage('postprocess'):
+            if (upsample or self.upsample) == 'fast':
+                mask = self._postprocess_fast(output, size, out_threshold)
+            else:
+                mask = self._postprocess_exact(output, size, out_threshold)
+            if with_confidence:
+                return mask, self._confidence(output, size)
+            return mask
+
+    def _confidence(self, output, size):
+        """
+        每个像素所属类别的概率: 在网络分辨率上计算后双线性插值到原图尺寸
+        """
         with torch.no_grad():
-            output = self.net(img_data).cpu()
-            output = F.interpolate(output, (img.size[1], img.size[0]), mode='bilinear')
-            if self.net.n_classes > 1:
+            if self.n_classes > 1:
+                confidence = torch.softmax(output[0], dim=0).amax(dim=0)
+            else:
+                prob = torch.sigmoid(output[0, 0])
+                confidence = torch.maximum(prob, 1 - prob)
+        confidence = Image.fromarray(confidence.float().numpy())
+        if confidence.size != tuple(size):
+            confidence = confidence.resize(size, Image.BILINEAR)
+        return np.asarray(confidence)
+
+    def _postprocess_exact(self, output, size, out_threshold=0.5):
+        """
+        全部类别的logits双线性插值到原图尺寸后取argmax
+        """
+        with torch.no_grad():
+            output = F.interpolate(output, (size[1], size[0]), mode='bilinear')
+            if self.n_classes > 1:
                 mask = output.argmax(dim=1)
             else:
                 mask = torch.sigmoid(output) > out_threshold
-                
+
         # 获取预测掩码
-        mask = mask[0].long().squeeze().numpy()
-        
-        # 转换为图片
-        return self._mask_to_image(mask)
-    
-    def _mask_to_image(self, mask):
-        """
-        将预测掩码转换为图片
+        return mask[0].long().squeeze().numpy()
+
+    def _postprocess_fast(self, output, size, out_threshold=0.5):
         """
-        if isinstance(self.mask_values[0], list):
-            out = np.zeros((mask.shape[-2], mask.shape[-1], len(self.mask_values[0])), dtype=np.uint8)
-        elif self.mask_values == [0, 1]:
-            out = np.zeros((mask.shape[-2], mask.shape[-1]), dtype=bool)
-        else:
-            out = np.zeros((mask.shape[-2], mask.shape[-1]), dtype=np.uint8)
+        不在原图尺寸上分配 n_classes 个float32通道的后处理
 
-        if mask.ndim == 3:
-            mask = np.argmax(mask, axis=0)
+        一到两个类别时只对单通道插值, 结果与 exact 一致; 多类别时在网络分辨率上取argmax,
+        再最近邻放大类别掩码, 类别边界处会有不超过一个网络像素的误差.
+        """
+        n_classes = self.n_classes
+        with torch.no_grad():
+            if n_classes <= 2:
+                # 双线性插值是线性的, 先做通道相减再插值与插值后比较两个通道等价
+                logit = output if n_classes == 1 else output[:, 1:2] - output[:, 0:1]
+                logit = F.interpolate(logit, (size[1], size[0]), mode='bilinear')
+                mask = torch.sigmoid(logit) > out_threshold if n_classes == 1 else logit > 0
+                return mask[0, 0].to(torch.uint8).numpy()
+            labels = output.argmax(dim=1)[0]
 
-        for i, v in enumerate(self.mask_values):
-            out[mask == i] = v
+        if n_classes > 256:
+            labels = F.interpolate(labels[None, None].float(), (size[1], size[0]), mode='nearest')
+            return labels[0, 0].long().numpy()
+        labels = Image.fromarray(labels.to(torch.uint8).numpy())
+        return np.asarray(labels.resize(size, Image.NEAREST))
 
-        return Image.fromarray(out)
\ No newline at end of file
+    def _mask_to_image(self, mask):
+        """
+        将预测掩码转换为图片
+        """
+        with stage('render'):
+            return self.renderer.render(mask)
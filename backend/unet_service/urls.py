@@ -1,9 +1,10 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import UNetViewSet
+from .views import UNetViewSet, PredictionJobViewSet
 
 # 创建路由器并注册视图
 router = DefaultRouter()
+router.register(r'jobs', PredictionJobViewSet, basename='unet-job')
 router.register(r'', UNetViewSet, basename='unet')
 
 urlpatterns = [
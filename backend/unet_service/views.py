@@ -1,21 +1,35 @@
-import io
-import zipfile
+from functools import partial
 from pathlib import Path
-import tempfile
+import io
 import os
 import logging
-import imghdr
+import zipfile
 
+from django.core.files import File
 from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
 from django.conf import settings
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
-from rest_framework.permissions import AllowAny
+from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
-from PIL import Image
 
-from .unet_predictor import UNetPredictor
+from data_manager.models import DatasetManagerModel
+from dvadmin.utils.json_response import DetailResponse, ErrorResponse, SuccessResponse
+from dvadmin.utils.viewset import CustomModelViewSet
+from .admission import admission_controlled, set_image_count
+from .batching import get_runner
+from .components import check_connectivity, component_stats, summarize
+from .metrics import stage
+from .inference_pool import InferencePoolError, describe_models, get_predictor
+from .mask_formats import check_output_format, encode_labels, require_opencv
+from .model_registry import UnknownModelError
+from .models import PredictionJob
+from .pipeline import ZipPredictionPipeline, decode_image, encode_png
+from .result_cache import get_cache_scope
+from .serializers import PredictionJobSerializer, PredictionJobResultSerializer
+from .tasks import run_prediction_job
+from .tiling import TileConfig
 
 logger = logging.getLogger(__name__)
 
@@ -24,185 +38,208 @@ class UNetViewSet(viewsets.ViewSet):
     UNet模型预测服务的视图集
     """
     permission_classes = [AllowAny]  # 允许所有用户访问
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.predictor = None
 
-    def get_predictor(self):
+    def get_predictor(self, request=None):
         """
-        懒加载预测器实例
+        获取预测器, 可通过 model / model_version 参数指定模型
+        开启推理进程池时返回进程池客户端, 本进程不加载模型
         """
-        if self.predictor is None:
-            self.predictor = UNetPredictor()
-        return self.predictor
+        name = version = None
+        if request is not None:
+            name = request.data.get('model') or request.query_params.get('model')
+            version = request.data.get('model_version') or request.query_params.get('model_version')
+        return get_predictor(name=name, version=version)
 
-    def _process_single_image(self, image_file, scale_factor, threshold, request):
+    def _process_single_image(self, predictor, image_file, scale_factor, threshold, request, tiling=None):
         """
         处理单张图片并返回结果URL
         """
         try:
-            predictor = self.get_predictor()
-            
-            # 预测
-            mask_image = predictor.predict(
-                image_file,
-                scale_factor=scale_factor,
-                out_threshold=threshold
-            )
+            with stage('read'):
+                data = image_file.read()
 
-            # 将预测结果转换为字节流
-            img_byte_arr = io.BytesIO()
-            mask_image.save(img_byte_arr, format='PNG')
-            img_byte_arr = img_byte_arr.getvalue()
+            # 相同图片、模型和参数的结果命中缓存时直接返回已保存的结果
+            cache_scope = get_cache_scope(predictor, scale_factor, threshold, tiling)
+            key = None
+            if cache_scope is not None:
+                key = cache_scope.key(data)
+                cached = cache_scope.get(key)
+                if cached is not None:
+                    return self._result_url(cached, request)
 
-            # 生成唯一的文件名
-            timestamp = Path(image_file.name).stem
-            temp_path = default_storage.save(
-                f'temp/predict_{timestamp}_{os.urandom(4).hex()}_result.png',
-                ContentFile(img_byte_arr)
+            # 预测, 开启批处理时经由批处理队列与其他图片合并推理
+            mask_image = get_runner(predictor).predict(
+                io.BytesIO(data),
+                scale_factor=scale_factor,
+                out_threshold=threshold,
+                tiling=tiling
             )
-            
-            # 构建完整的URL
-            result_url = request.build_absolute_uri(default_storage.url(temp_path))
-            logger.info(f"Generated result URL: {result_url}")
-            return result_url
+
+            png_bytes = encode_png(mask_image)
+            if key is not None:
+                return self._result_url(cache_scope.put(key, png_bytes), request)
+            return self._result_url(self._save_result(image_file.name, png_bytes), request)
         except Exception as e:
-            logger.error(f"Error processing image {image_file.name}: {str(e)}")
+            logger.error(f"Error processing image {getattr(image_file, 'name', '')}: {str(e)}")
             raise
 
-    def _is_valid_image(self, file_path):
+    def _process_single_image_inline(self, predictor, image_file, scale_factor, threshold, output_format,
+                                     polygon_tolerance, tiling=None):
         """
-        检查文件是否为有效的图片
+        处理单张图片并以紧凑格式(RLE/多边形/位打包)内联返回结果, 不保存结果文件
         """
         try:
-            # 首先使用imghdr检查文件类型
-            img_type = imghdr.what(file_path)
-            if img_type not in ['jpeg', 'png', 'bmp']:
-                return False
-
-            # 尝试打开和读取图片
-            with Image.open(file_path) as img:
-                img.load()  # 这会验证图片数据是否完整
-            return True
+            with stage('read'):
+                data = image_file.read()
+            labels = get_runner(predictor).predict_labels(
+                decode_image(data, image_file.name, scale_factor),
+                scale_factor=scale_factor,
+                out_threshold=threshold,
+                tiling=tiling
+            )
+            with stage('encode'):
+                return encode_labels(labels, output_format, predictor.n_classes, polygon_tolerance)
         except Exception as e:
-            logger.warning(f"Invalid image file {file_path}: {str(e)}")
-            return False
+            logger.error(f"Error processing image {getattr(image_file, 'name', '')}: {str(e)}")
+            raise
+
+    def _save_result(self, name, png_bytes):
+        """
+        保存预测结果PNG并返回存储路径
+        """
+        # 生成唯一的文件名
+        timestamp = Path(name).stem
+        with stage('save'):
+            return default_storage.save(
+                f'temp/predict_{timestamp}_{os.urandom(4).hex()}_result.png',
+                ContentFile(png_bytes)
+            )
+
+    @staticmethod
+    def _result_url(path, request):
+        """
+        构建结果文件完整的URL
+        """
+        result_url = request.build_absolute_uri(default_storage.url(path))
+        logger.info(f"Generated result URL: {result_url}")
+        return result_url
+
+    @staticmethod
+    def _batch_summary(action, pipeline, processed_files, failed_files):
+        """
+        ZIP批量处理的消息和重复图片统计, duplicates 为 {重复成员名: 复用其结果的成员名}
+        """
+        message = f'{action}成功，成功处理{processed_files}个文件，失败{failed_files}个文件'
+        if pipeline.duplicates:
+            message += f'，其中{len(pipeline.duplicates)}个重复文件复用了相同内容图片的结果'
+        return {
+            'message': message,
+            'duplicate_files': len(pipeline.duplicates),
+            'duplicates': pipeline.duplicates,
+        }
+
+    @staticmethod
+    def _get_tiling(request):
+        """
+        分块推理配置: 请求中指定 tile_size 时强制分块, 否则大图按 UNET_TILE_MIN_PIXELS 自动分块
+        """
+        return TileConfig.from_settings(request.data.get('tile_size'), request.data.get('tile_overlap'))
+
+    @staticmethod
+    def _open_upload(request):
+        """
+        获取上传的文件或 data 指定的数据集文件, 返回 (文件对象, 错误响应)
+        """
+        # 检查是否有文件上传或数据集路径
+        if 'file' in request.FILES:
+            return request.FILES['file'], None
+        if 'data' in request.data:
+            dataset_path = request.data['data']
+            # 确保路径是相对于media目录的
+            full_path = os.path.join(settings.MEDIA_ROOT, dataset_path)
+            if os.path.exists(full_path):
+                # 直接以文件对象打开, 不把整个数据集读入内存
+                return File(open(full_path, 'rb'), name=os.path.basename(full_path)), None
+            return None, Response(
+                {'error': f'找不到数据集文件: {dataset_path}'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        return None, Response(
+            {'error': '没有上传文件或提供有效的数据集路径'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
 
     @action(detail=False, methods=['POST'])
+    @admission_controlled
     def predict(self, request):
         """
         处理图片预测请求，支持单张图片或ZIP文件
         """
+        uploaded_file = None
         try:
-            # 检查是否有文件上传或数据集路径
-            uploaded_file = None
-            if 'file' in request.FILES:
-                uploaded_file = request.FILES['file']
-            elif 'data' in request.data:
-                dataset_path = request.data['data']
-                # 确保路径是相对于media目录的
-                full_path = os.path.join(settings.MEDIA_ROOT, dataset_path)
-                if os.path.exists(full_path):
-                    # 创建 File 对象
-                    with open(full_path, 'rb') as f:
-                        content = f.read()
-                        uploaded_file = ContentFile(content, name=os.path.basename(full_path))
-                else:
-                    return Response(
-                        {'error': f'找不到数据集文件: {dataset_path}'},
-                        status=status.HTTP_404_NOT_FOUND
-                    )
-            
-            if not uploaded_file:
-                return Response(
-                    {'error': '没有上传文件或提供有效的数据集路径'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
+            uploaded_file, error = self._open_upload(request)
+            if error is not None:
+                return error
             logger.info(f"Received file: {uploaded_file.name}")
             
             # 获取缩放因子和阈值参数（可选）
             scale_factor = float(request.data.get('scale_factor', 1.0))
             threshold = float(request.data.get('threshold', 0.5))
+            tiling = self._get_tiling(request)
+            output_format = request.data.get('output_format') or 'png'
+            polygon_tolerance = float(request.data.get(
+                'polygon_tolerance', getattr(settings, 'UNET_POLYGON_TOLERANCE', 1.0)
+            ))
+            try:
+                check_output_format(output_format)
+            except (ValueError, ImportError) as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+            # 解析模型, 模型名称或版本不存在时直接返回
+            try:
+                predictor = self.get_predictor(request)
+            except UnknownModelError as e:
+                return Response({'error': str(e.args[0])}, status=status.HTTP_404_NOT_FOUND)
 
             # 检查是否为ZIP文件
             if uploaded_file.name.lower().endswith('.zip'):
                 logger.info("Processing ZIP file")
-                result_urls = []
-                processed_files = 0
-                failed_files = 0
-                
-                # 创建临时目录
-                with tempfile.TemporaryDirectory() as temp_dir:
-                    logger.info(f"Created temp directory: {temp_dir}")
-                    
-                    # 保存ZIP文件
-                    zip_path = os.path.join(temp_dir, 'upload.zip')
-                    with open(zip_path, 'wb') as f:
-                        for chunk in uploaded_file.chunks():
-                            f.write(chunk)
-                    
-                    try:
-                        # 解压ZIP文件
-                        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                            # 获取所有文件列表
-                            file_list = [f for f in zip_ref.namelist() if not f.startswith('__MACOSX/')]
-                            logger.info(f"Files in ZIP: {file_list}")
-                            
-                            zip_ref.extractall(temp_dir)
-                            logger.info(f"Extracted ZIP file to {temp_dir}")
-                    except Exception as e:
-                        logger.error(f"Error extracting ZIP file: {str(e)}")
+                pipeline = ZipPredictionPipeline.from_settings(
+                    predictor,
+                    lambda name, png_bytes: self._save_result(os.path.basename(name), png_bytes),
+                    scale_factor=scale_factor,
+                    out_threshold=threshold,
+                    tiling=tiling,
+                    result_cache=get_cache_scope(predictor, scale_factor, threshold, tiling),
+                    output_format=output_format,
+                    polygon_tolerance=polygon_tolerance,
+                )
+                try:
+                    # 直接从压缩包读取图片成员, 不解压到临时目录
+                    results, processed_files, failed_files = pipeline.run(uploaded_file)
+                except zipfile.BadZipFile as e:
+                    logger.error(f"Error reading ZIP file: {str(e)}")
+                    return Response(
+                        {'error': f'ZIP文件解压失败: {str(e)}'},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                logger.info(f"ZIP processing complete. Processed: {processed_files}, Failed: {failed_files}")
+                set_image_count(request, processed_files + failed_files)
+
+                if output_format != 'png':
+                    inline_results = [{'name': name, **result} for name, result in results if result]
+                    if not inline_results:
                         return Response(
-                            {'error': f'ZIP文件解压失败: {str(e)}'},
+                            {'error': 'ZIP文件中没有有效的图片文件或处理过程中出错'},
                             status=status.HTTP_400_BAD_REQUEST
                         )
-                    
-                    # 处理所有图片
-                    image_extensions = {'.jpg', '.jpeg', '.png', '.bmp'}
-                    for root, _, files in os.walk(temp_dir):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            file_ext = os.path.splitext(file)[1].lower()
-                            
-                            # 跳过__MACOSX目录和其他非图片文件
-                            if '__MACOSX' in file_path or file_ext not in image_extensions:
-                                logger.info(f"Skipping non-image file: {file_path}")
-                                continue
-                                
-                            logger.info(f"Processing file: {file_path}")
-                            
-                            # 验证是否为有效图片
-                            if not self._is_valid_image(file_path):
-                                logger.warning(f"Invalid image file: {file_path}")
-                                failed_files += 1
-                                continue
-
-                            try:
-                                # 读取图片文件
-                                with open(file_path, 'rb') as img_file:
-                                    img_content = img_file.read()
-                                    
-                                # 创建Django文件对象
-                                django_file = ContentFile(img_content)
-                                django_file.name = os.path.basename(file_path)
-                                
-                                # 处理单张图片
-                                result_url = self._process_single_image(
-                                    django_file,
-                                    scale_factor,
-                                    threshold,
-                                    request
-                                )
-                                logger.info(f"Successfully processed {file_path}")
-                                result_urls.append(result_url)
-                                processed_files += 1
-                            except Exception as e:
-                                logger.error(f"Error processing {file_path}: {str(e)}")
-                                failed_files += 1
-                                continue
+                    return Response({
+                        **self._batch_summary('预测', pipeline, processed_files, failed_files),
+                        'output_format': output_format,
+                        'results': inline_results
+                    })
 
-                logger.info(f"ZIP processing complete. Processed: {processed_files}, Failed: {failed_files}")
-                
+                result_urls = [self._result_url(path, request) for _, path in results if path]
                 if not result_urls:
                     return Response(
                         {'error': 'ZIP文件中没有有效的图片文件或处理过程中出错'},
@@ -210,17 +247,34 @@ class UNetViewSet(viewsets.ViewSet):
                     )
                 
                 return Response({
-                    'message': f'预测成功，成功处理{processed_files}个文件，失败{failed_files}个文件',
+                    **self._batch_summary('预测', pipeline, processed_files, failed_files),
                     'result_urls': result_urls
                 })
             else:
                 # 处理单张图片
                 logger.info("Processing single image")
+                if output_format != 'png':
+                    result = self._process_single_image_inline(
+                        predictor,
+                        uploaded_file,
+                        scale_factor,
+                        threshold,
+                        output_format,
+                        polygon_tolerance,
+                        tiling
+                    )
+                    return Response({
+                        'message': '预测成功',
+                        'output_format': output_format,
+                        'result': result
+                    })
                 result_url = self._process_single_image(
+                    predictor,
                     uploaded_file,
                     scale_factor,
                     threshold,
-                    request
+                    request,
+                    tiling
                 )
                 
                 return Response({
@@ -228,9 +282,199 @@ class UNetViewSet(viewsets.ViewSet):
                     'result_url': result_url
                 })
 
+        except InferencePoolError as e:
+            logger.error(f"Inference pool error: {str(e)}")
+            return Response(
+                {'error': f'推理服务不可用: {str(e)}'},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
         except Exception as e:
             logger.error(f"Prediction error: {str(e)}")
             return Response(
                 {'error': f'预测过程发生错误: {str(e)}'},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
+        finally:
+            # 数据集文件由本视图打开, 上传文件关闭也无副作用
+            if uploaded_file is not None:
+                uploaded_file.close()
+
+    @action(detail=False, methods=['POST'])
+    @admission_controlled
+    def components(self, request):
+        """
+        预测后在服务端做连通域分析, 返回每个连通域的面积、外接框、质心和平均置信度, 不返回掩码
+        ZIP文件中的图片并行处理, 并附带整批的汇总统计
+        """
+        uploaded_file = None
+        try:
+            uploaded_file, error = self._open_upload(request)
+            if error is not None:
+                return error
+
+            scale_factor = float(request.data.get('scale_factor', 1.0))
+            threshold = float(request.data.get('threshold', 0.5))
+            tiling = self._get_tiling(request)
+            min_area = int(request.data.get('min_area', getattr(settings, 'UNET_COMPONENT_MIN_AREA', 0)))
+            connectivity = int(request.data.get(
+                'connectivity', getattr(settings, 'UNET_COMPONENT_CONNECTIVITY', 8)
+            ))
+            try:
+                check_connectivity(connectivity)
+                require_opencv()
+            except (ValueError, ImportError) as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+            try:
+                predictor = self.get_predictor(request)
+            except UnknownModelError as e:
+                return Response({'error': str(e.args[0])}, status=status.HTTP_404_NOT_FOUND)
+            analyze = partial(component_stats, n_classes=predictor.n_classes, min_area=min_area,
+                              connectivity=connectivity)
+
+            if uploaded_file.name.lower().endswith('.zip'):
+                pipeline = ZipPredictionPipeline.from_settings(
+                    predictor,
+                    None,
+                    scale_factor=scale_factor,
+                    out_threshold=threshold,
+                    tiling=tiling,
+                    analyze=analyze,
+                )
+                try:
+                    results, processed_files, failed_files = pipeline.run(uploaded_file)
+                except zipfile.BadZipFile as e:
+                    logger.error(f"Error reading ZIP file: {str(e)}")
+                    return Response(
+                        {'error': f'ZIP文件解压失败: {str(e)}'},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                set_image_count(request, processed_files + failed_files)
+                results = [{'name': name, **result} for name, result in results if result]
+                if not results:
+                    return Response(
+                        {'error': 'ZIP文件中没有有效的图片文件或处理过程中出错'},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                return Response({
+                    **self._batch_summary('分析', pipeline, processed_files, failed_files),
+                    'summary': summarize(results),
+                    'results': results
+                })
+
+            with stage('read'):
+                data = uploaded_file.read()
+            labels, confidence = get_runner(predictor).predict_labels(
+                decode_image(data, uploaded_file.name, scale_factor),
+                scale_factor=scale_factor,
+                out_threshold=threshold,
+                tiling=tiling,
+                with_confidence=True
+            )
+            with stage('analyze'):
+                result = analyze(labels, confidence)
+            return Response({'message': '分析成功', 'result': result})
+
+        except InferencePoolError as e:
+            logger.error(f"Inference pool error: {str(e)}")
+            return Response(
+                {'error': f'推理服务不可用: {str(e)}'},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+        except Exception as e:
+            logger.error(f"Component analysis error: {str(e)}")
+            return Response(
+                {'error': f'连通域分析过程发生错误: {str(e)}'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        finally:
+            # 数据集文件由本视图打开, 上传文件关闭也无副作用
+            if uploaded_file is not None:
+                uploaded_file.close()
+
+    @action(detail=False, methods=['GET'])
+    def models(self, request):
+        """
+        列出已注册的模型及其加载状态
+        """
+        try:
+            return Response({'models': describe_models()})
+        except InferencePoolError as e:
+            return Response(
+                {'error': f'推理服务不可用: {str(e)}'},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+
+
+class PredictionJobViewSet(CustomModelViewSet):
+    """
+    异步批量预测任务
+    list:查询
+    create:提交任务(上传ZIP文件或指定数据集id), 立即返回任务id
+    retrieve:任务状态
+    results:分页查询任务结果
+    destroy:删除
+    """
+    queryset = PredictionJob.objects.all()
+    serializer_class = PredictionJobSerializer
+    permission_classes = [IsAuthenticated]
+    extra_filter_class = []
+    filter_fields = ['status', 'dataset']
+    http_method_names = ['get', 'post', 'delete']
+
+    def get_queryset(self):
+        if self.request.user.is_superuser:
+            return super().get_queryset()
+        return super().get_queryset().filter(creator=self.request.user)
+
+    def create(self, request, *args, **kwargs):
+        dataset = None
+        if 'file' in request.FILES:
+            uploaded_file = request.FILES['file']
+            source = default_storage.save(f'unet_jobs/uploads/{os.urandom(8).hex()}_{uploaded_file.name}',
+                                          uploaded_file)
+        elif request.data.get('dataset'):
+            dataset = DatasetManagerModel.objects.filter(id=request.data.get('dataset')).first()
+            if dataset is None or not dataset.data or not default_storage.exists(dataset.data):
+                return ErrorResponse(msg=f"找不到数据集文件: {request.data.get('dataset')}")
+            source = dataset.data
+        else:
+            return ErrorResponse(msg='没有上传文件或提供有效的数据集id')
+
+        params = {
+            key: request.data.get(key)
+            for key in ('scale_factor', 'threshold', 'tile_size', 'tile_overlap')
+            if request.data.get(key) not in (None, '')
+        }
+        job = PredictionJob.objects.create(
+            source=source,
+            dataset=dataset,
+            model_name=request.data.get('model') or None,
+            model_version=request.data.get('model_version') or None,
+            params=params,
+            creator=request.user,
+            dept_belong_id=getattr(request.user, 'dept_id', None),
+        )
+        try:
+            run_prediction_job.delay(job.id)
+        except Exception as e:
+            logger.error(f"Failed to dispatch prediction job {job.id}: {str(e)}")
+            job.status = 3
+            job.message = f'任务派发失败: {str(e)}'[:250]
+            job.save()
+            return ErrorResponse(msg=job.message)
+        return DetailResponse(data=self.get_serializer(job).data, msg="预测任务已创建")
+
+    @action(detail=True, methods=['GET'])
+    def results(self, request, pk=None):
+        """
+        分页查询任务中每张图片的预测结果
+        """
+        job = self.get_object()
+        queryset = job.results.all()
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = PredictionJobResultSerializer(page, many=True, context={'request': request})
+            return self.get_paginated_response(serializer.data)
+        serializer = PredictionJobResultSerializer(queryset, many=True, context={'request': request})
+        return SuccessResponse(data=serializer.data, total=len(serializer.data))